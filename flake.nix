@@ -30,7 +30,7 @@
 
               propagatedBuildInputs = [
                 paho-mqtt
-                psutil
+                prometheus-client
                 setuptools
               ];
 
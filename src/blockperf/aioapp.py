@@ -0,0 +1,229 @@
+"""
+Asyncio runtime for blockperf.
+
+Instead of blocking threads, every stage of blockperf runs as a cooperative
+task on a single event loop:
+
+    * one task per relay that tails its logfile and assembles the samples
+    * the mqtt connection, whose socket is driven by the event loop
+    * the publisher that hands all samples to the mqtt client, the other
+      sinks (see blockperf.sinks) still run in their own threads
+    * the prometheus metrics endpoint
+    * periodic housekeeping (eviction of old hashes, store retention)
+
+Paho's own network thread and prometheus' http server thread are not used.
+"""
+
+import asyncio
+import logging
+import sys
+
+from blockperf.app import App
+from blockperf.memory import PAYLOAD_MEMORY, budget
+from blockperf.metrics import Metrics
+from blockperf.watchdog import watchdog
+
+logger = logging.getLogger(__name__)
+
+# How often the sources are checked for new lines
+TAIL_INTERVAL = 0.5
+HOUSEKEEPING_INTERVAL = 10
+# Samples waiting to be published, older ones are dropped once it is full
+PUBLISH_QUEUE_SIZE = 1000
+
+
+class MQTTLoopHelper:
+    """Drives the network loop of a paho client from an asyncio event loop.
+
+    Paho tells about its socket through the on_socket_* callbacks, which may
+    be called from an executor thread while connecting. All (un)registering
+    is therefore handed over to the loop thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client) -> None:
+        self.loop = loop
+        self.client = client
+        self.disconnected = asyncio.Event()
+        self.misc: "asyncio.Task | None" = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        def _open():
+            self.disconnected.clear()
+            self.loop.add_reader(sock, client.loop_read)
+            self.misc = self.loop.create_task(self.misc_loop())
+
+        self.loop.call_soon_threadsafe(_open)
+
+    def on_socket_close(self, client, userdata, sock):
+        def _close():
+            self.loop.remove_reader(sock)
+            self.loop.remove_writer(sock)
+            if self.misc:
+                self.misc.cancel()
+            self.disconnected.set()
+
+        self.loop.call_soon_threadsafe(_close)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        """Keepalive pings and retries, what paho does in loop_misc()"""
+        while self.client.loop_misc() == 0:
+            await asyncio.sleep(1)
+
+
+class AsyncRuntime:
+    """Runs the given apps as tasks on a single asyncio event loop. The apps
+    share the mqtt client (created from the first apps config) and the
+    metrics endpoint."""
+
+    apps: list
+
+    def __init__(self, apps: list) -> None:
+        self.apps = apps
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            sys.stdout.write("Closed")
+
+    async def main(self):
+        self.publish_queue: asyncio.Queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        budget.account(
+            "publish queue", lambda: self.publish_queue.qsize() * PAYLOAD_MEMORY
+        )
+        # Import late, paho is only needed when actually running
+        from blockperf.mqtt import MQTTClient
+
+        config = self.apps[0].app_config
+        # The mqtt connection is driven by the loop, all other sinks run in
+        # their own threads as with the threads runtime.
+        sinks = self.apps[0].open_sinks(exclude=("mqtt",))
+        for app in self.apps:
+            app.sinks = sinks
+        tasks = [self.housekeeping()]
+        self.mqtt_client = None
+        if "mqtt" in config.sinks:
+            self.mqtt_client = MQTTClient(
+                ca_certfile=config.amazon_ca,
+                client_certfile=config.client_cert,
+                client_keyfile=config.client_key,
+                host=config.broker_host,
+                port=config.broker_port,
+                keepalive=config.broker_keepalive,
+                loop_start=False,
+            )
+            tasks.extend([self.mqtt_connection(), self.publisher()])
+        if Metrics.port:
+            tasks.append(self.metrics_endpoint(Metrics.port))
+        tasks.extend(self.blocksamples(app) for app in self.apps)
+        # The watchdog runs in its own thread, so it notices a blocked loop
+        watchdog.start()
+        await asyncio.gather(*tasks)
+
+    async def blocksamples(self, app: App):
+        """Tails the source of app, assembles the samples and queues them to
+        be published."""
+        source = app.open_source()
+        while True:
+            logevents = app.read_logevents(source)
+            if app.slot_is_too_old(logevents):
+                await asyncio.sleep(250)
+                source.seek_end()
+                continue
+            if logevents and app.capture:
+                app.capture.append(logevents)
+            for new_sample in app.assembler.add_batch(logevents):
+                for message in app.messages_of(new_sample):
+                    app.publish(*message)
+                    if not self.mqtt_client:
+                        continue
+                    if self.publish_queue.full():
+                        logger.warning("Publish queue full, dropping oldest sample")
+                        self.publish_queue.get_nowait()
+                    self.publish_queue.put_nowait(message)
+            await asyncio.sleep(TAIL_INTERVAL)
+
+    async def mqtt_connection(self):
+        """Connects to the broker and reconnects whenever disconnected"""
+        loop = asyncio.get_running_loop()
+        helper = MQTTLoopHelper(loop, self.mqtt_client)
+        host, port, keepalive = self.mqtt_client.broker
+        while True:
+            logger.info("Connecting to %s:%s", host, port)
+            try:
+                # connect() does the dns lookup, tcp and tls handshake
+                # blocking, keep that off the event loop.
+                await loop.run_in_executor(
+                    None, self.mqtt_client.connect, host, port, keepalive
+                )
+            except OSError as exc:
+                logger.warning("Connecting to broker failed: %s", exc)
+                await asyncio.sleep(self.mqtt_client.backoff.next())
+                continue
+            await helper.disconnected.wait()
+            # on_connect() resets the backoff, the first retry is quick
+            await asyncio.sleep(self.mqtt_client.backoff.next())
+
+    async def publisher(self):
+        """Publishes the queued samples once connected to the broker"""
+        while True:
+            topic, payload = await self.publish_queue.get()
+            while not self.mqtt_client.connected.is_set():
+                await asyncio.sleep(0.1)
+            try:
+                message_info = self.mqtt_client.publish_nowait(topic, payload)
+            except (ValueError, RuntimeError) as exc:
+                logger.exception(exc, exc_info=True)
+                continue
+            if message_info.rc:
+                # Disconnected meanwhile, qos 0 messages are not resent
+                logger.warning("Lost sample for %s: %s", topic, message_info.rc)
+                self.mqtt_client.metrics.inc("sink_dropped")
+
+    async def housekeeping(self):
+        """Periodically evicts old blocks and expired store segments, even
+        when no new events arrive, and saves the published hashes."""
+        while True:
+            await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+            for app in self.apps:
+                app.assembler.evict(app.current_slot())
+                app.assembler.save_published()
+                if app.store:
+                    app.store.remove_expired()
+
+    async def metrics_endpoint(self, port: int):
+        """Serves the prometheus metrics on every request to port."""
+        from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                body = generate_latest()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    + f"Content-Type: {CONTENT_TYPE_LATEST}\r\n".encode()
+                    + f"Content-Length: {len(body)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                pass
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, port=port)
+        async with server:
+            await server.serve_forever()
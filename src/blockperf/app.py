@@ -1,72 +1,154 @@
-import collections
 import json
 import logging
-import os
 import queue
 import sys
 import threading
 import time
-from datetime import datetime, timedelta, timezone
-from pathlib import Path
+from datetime import datetime
+from typing import TYPE_CHECKING, Union
 
 from blockperf import __version__ as blockperf_version
-from blockperf.blocksample import BlockSample, slot_time_of
+from blockperf.assembler import SampleAssembler
+from blockperf import slotclock
+from blockperf.blocksample import BlockSample
+from blockperf.capture import EventCapture
 from blockperf.config import AppConfig
+from blockperf.memory import budget
+from blockperf.mempool import MempoolCounter
 from blockperf.metrics import Metrics
-from blockperf.mqtt import MQTTClient
-from blockperf.nodelogs import LogEvent, LogEventKind
+from blockperf.nodelogs import LogEvent, LogEventKind, LogFormat, detect_format
+from blockperf.peerstats import PeerStats
+from blockperf.published import PublishedFilter
+from blockperf.sinks import open_sink
+from blockperf.snapshots import SnapshotRing
+from blockperf.sources import open_source
+from blockperf.store import FLAG_INCOMPLETE, FLAG_SNAPSHOT, SampleStore
+from blockperf.summary import Summarizer
+from blockperf.watchdog import watchdog
+
+if TYPE_CHECKING:
+    from blockperf.mqtt import MQTTClient
+    from blockperf.parseworker import ParseWorker
 
 logger = logging.getLogger(__name__)
 
+# Seconds between two runs of the sweeper
+SWEEP_INTERVAL = 10
+# Slots older than this (12 hours) are not sampled, e.g. while syncing
+TOO_OLD_MS = 12 * 3600 * 1000
+
 
 class App:
     app_config: AppConfig
+    relay: str
+    slot_clock: slotclock.SlotClock
     node_config: dict
-    mqtt_client: MQTTClient
+    sinks: list
     start_time: int
     metrics: Metrics
-
-    # holds a dictionairy for each kind of events for each block_hash
-    logevents: dict = {}
-    # the list of all published hashes, to not publish a hash twice
-    published_blocks: list = []
-    # Stores the last X hashes before they are deleted from logevents and published_blocks
-    working_hashes: collections.deque = collections.deque()
+    peer_stats: PeerStats
+    assembler: SampleAssembler
+    store: Union[SampleStore, None] = None
+    capture: Union[EventCapture, None] = None
+    summarizer: Union[Summarizer, None] = None
+    log_format: Union[LogFormat, None] = None
 
     def __init__(self, config: AppConfig) -> None:
         self.q: queue.Queue = queue.Queue(maxsize=50)
         self.app_config = config
         self.start_time = int(datetime.now().timestamp())
-        self.metrics = Metrics()
+        self.relay = f"{config.relay_public_ip}:{config.relay_public_port}"
+        self.slot_clock = config.slot_clock
+        slotclock.register(config.network_magic, self.slot_clock)
+        self.metrics = Metrics(self.relay)
+        budget.limit = config.memory_budget
+        self.assembler = SampleAssembler(
+            config.network_magic,
+            config.max_block_age,
+            config.max_inflight_events,
+            self.metrics,
+            budget,
+            PublishedFilter(config.published_file),
+            self.store_incomplete,
+            f"{self.relay} events",
+        )
+        self.peer_stats = PeerStats(config.peer_stats_max_peers)
+        self.mempool = MempoolCounter()
+        # The mempool totals last exported as metrics
+        self.mempool_exported: tuple = (0, 0, 0)
+        self.snapshots = SnapshotRing()
+        # The read attempts of the parse worker at the last look
+        self.worker_reads = 0
+        self.read_stage = f"{self.relay} read"
+        self.sample_stage = f"{self.relay} sample"
+        watchdog.watch(self.read_stage, config.watchdog_read_timeout)
+        watchdog.watch(self.sample_stage, config.watchdog_sample_timeout)
+        if config.store_dir:
+            self.store = SampleStore(config.store_dir, config.store_retention_days)
+        if config.publish_mode != "samples":
+            self.summarizer = Summarizer(
+                self.summary_window_of, config.summary_window, config.network_magic
+            )
+        if config.capture_dir:
+            self.capture = EventCapture(
+                config.capture_dir, config.capture_retention_days
+            )
 
     def run(self):
-        """Runs the App by creating the mqtt client and two threads.
-        One thread produces reads from the node logs and produces blocksamples
-        while the other consumes these samples and publishes them to mqtt broker.
+        """Runs the App by starting the sinks, each in its own thread. This
+        thread reads the node logs and produces blocksamples, which the sinks
+        consume and publish.
         """
         try:
-            self.mqtt_client = MQTTClient(
-                ca_certfile=self.app_config.amazon_ca,
-                client_certfile=self.app_config.client_cert,
-                client_keyfile=self.app_config.client_key,
-                host=self.app_config.broker_host,
-                port=self.app_config.broker_port,
-                keepalive=self.app_config.broker_keepalive,
-            )
-
-            # Sometimes the connect took a moment to settle. To not have
-            # the consumer accept messages (and not be able to publish)
-            # i decided to ensure the connection is established this way
-            while not self.mqtt_client.is_connected:
-                logger.debug("Waiting for mqtt connection ... ")
-                time.sleep(0.5)  # Wait until connected to broker
-
+            Metrics.serve()
+            self.sinks = self.open_sinks()
+            watchdog.start()
             self.run_blocksample_loop()
         except KeyboardInterrupt:
             sys.stdout.write("Closed")
             return
 
-    def print_block_stats(self, blocksample: BlockSample) -> None:
+    def connect_mqtt(self) -> "MQTTClient":
+        """Creates the mqtt client which connects in the background. Publishing
+        waits for the connection to be established, so the logs can already
+        be read meanwhile."""
+        from blockperf.mqtt import MQTTClient
+
+        return MQTTClient(
+            ca_certfile=self.app_config.amazon_ca,
+            client_certfile=self.app_config.client_cert,
+            client_keyfile=self.app_config.client_key,
+            host=self.app_config.broker_host,
+            port=self.app_config.broker_port,
+            keepalive=self.app_config.broker_keepalive,
+        )
+
+    def open_sinks(self, exclude: tuple = ()) -> list:
+        """Starts the configured sinks, except the ones in exclude"""
+        sinks = []
+        for kind in self.app_config.sinks:
+            if kind in exclude:
+                continue
+            sink = open_sink(
+                kind,
+                connect_mqtt=self.connect_mqtt,
+                sink_file=self.app_config.sink_file,
+                sink_url=self.app_config.sink_url,
+            )
+            watchdog.watch(sink.stage, self.app_config.watchdog_sink_timeout)
+            sink.start()
+            sinks.append(sink)
+        logger.info("Publishing to %s", ", ".join(sink.name for sink in sinks))
+        return sinks
+
+    def publish(self, topic: str, payload: dict) -> None:
+        """Hands the sample to every sink, without waiting for any of them"""
+        for sink in self.sinks:
+            sink.submit(topic, payload)
+
+    def print_block_stats(
+        self, blocksample: BlockSample, snapshot: bool = False
+    ) -> None:
         """
         The Goal is to print a messages like this per BlockPerf
 
@@ -77,8 +159,10 @@ class App:
         RequestX. 2023-04-03 13:23:41,170 (+0 ms)
         Block.... 2023-04-03 13:23:41,190 (+20 ms) from 207.180.196.63:3001
         Adopted.. 2023-04-03 13:23:41,190 (+0 ms)
+        Validate. +0 ms, Select +0 ms (only if the node traced ValidCandidate)
         Size..... 870 bytes
         delay.... 0.192301717 sec
+        Snapshot. ledger snapshot during adoption (only if there was one)
         ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         """
         slot_delta = 0
@@ -96,9 +180,19 @@ class App:
             f"RequestX.. {blocksample.fetch_request_completed_block.atstr if blocksample.fetch_request_completed_block else 'X'} (+{blocksample.block_request_delta} ms)\n"
             f"Block..... {blocksample.first_completed_block.atstr if blocksample.first_completed_block else 'X'} (+{blocksample.block_response_delta} ms) from {blocksample.block_remote_addr}:{blocksample.block_remote_port}\n"
             f"Adopted... {blocksample.block_adopt.atstr if blocksample.block_adopt else 'X'} (+{blocksample.block_adopt_delta} ms)\n"
+        )
+        if blocksample.chain_selection:
+            msg += (
+                f"Validate.. +{blocksample.block_validate_delta} ms, "
+                f"Select +{blocksample.block_select_delta} ms\n"
+            )
+        msg += (
             f"Size...... {blocksample.block_size} bytes\n"
-            f"Delay..... {blocksample.block_delay} sec\n\n"
+            f"Delay..... {blocksample.block_delay} sec\n"
         )
+        if snapshot:
+            msg += "Snapshot.. ledger snapshot during adoption\n"
+        msg += "\n"
         logger.info("\n" + msg)
 
     def mqtt_payload_from(self, sample: BlockSample) -> dict:
@@ -122,259 +216,327 @@ class App:
             "blockLocalPort": str(self.app_config.relay_public_port),
             "blockG": str(sample.block_g),
         }
+        if self.app_config.fetch_counts and (fetch_counts := sample.fetch_counts):
+            payload["headerFanIn"] = str(fetch_counts.headers)
+            payload["blockFetches"] = str(fetch_counts.completed)
+            payload["wastedBytes"] = str(fetch_counts.wasted_bytes)
         return payload
 
-    def ensure_maxblocks(self):
-        """
-        * logevents holds all events recorded for all hashes seen.
-        * published_blocks holds hashes of all published blocks.
-
-        LogEvents hashes eventually get adopted (or not). But this may
-        take some time. I want to wait for some time (config.max_concurrent_blocks)
-        before i drop that hash.
-
-        Samples for blocks that already have a sample published should not get
-        republished. Thus the list of published_blocks.
-
-        To not have both lists grow indefinetly i use the deque in self.working_hashes.
-        Once it reaches a certain size, the hashes that are added first will
-        get popped of and delete from the other two lists.
-        """
-        if len(self.working_hashes) > self.app_config.max_concurrent_blocks:
-            removed_hash = self.working_hashes.popleft()
-            # Delete events for hash from logevents
-            if removed_hash in self.logevents:
-                del self.logevents[removed_hash]
-                logger.debug("Removed %s from working_hashes", removed_hash)
-            if removed_hash in self.published_blocks:
-                del self.published_blocks[self.published_blocks.index(removed_hash)]
-                logger.debug("Removed %s from published_blocks", removed_hash)
-
     def run_blocksample_loop(self):
         """Create samples for the blocks seen in the logfile and publishes them.
 
-        The for loop is supposed to run forever over the events from the logfile
-        produced by logevents_logfile(). Each event is a nodelogs.LogEvent.
-
-        From all the events that are possibly read from the logfile only
-        some are of interest.
-
-            * Must be of a specific kind
-                TRACE_DOWNLOADED_HEADER, SEND_FETCH_REQUEST, COMPLETED_BLOCK_FETCH,
-                ADDED_TO_CURRENT_CHAIN, SWITCHED_TO_A_FORK
-            * Must not be too old (invalid)
-            * Must have a blockhash
-        These are already filtered out in logevents_logfile()
-
-        A sample can only be created if all the required LogEvents have been
-        recorded for that given block. All required LogEvents means that
-        for each hash there must at least be one TRACE_DOWNLOADED_HEADER, one SEND_FETCH_REQUEST
-        and one COMPLETED_BLOCK_FETCH as well es one of the two possible adoption
-        kinds which are ADDED_TO_CURRENT_CHAIN and SWITCHED_TO_A_FORK.
-
-        To make that test somewhat simple there self.logevents holds all events
-        in dictionaries for their respective types. That makes it rather simple
-        to test if all required LogEvents have been collected yet.
-
-        Once that is the case a new sample is created by collecting all events
-        and instanciating BlockSample(). If the sample is complete it published.
-
+        The for loop is supposed to run forever over the batches of events in
+        the nodes logs produced by logevents_source(). Each batch is handed to
+        the assembler at once, see SampleAssembler.add_batch() for how the
+        samples are created.
         """
-
-        for event in self.logevents_logfile():
-            # Make sure lists dont fill up
-            self.ensure_maxblocks()
-
-            _block_hash = event.block_hash
-            _block_hash_short = event.block_hash_short
-
-            if _block_hash not in self.logevents:
-                logger.debug("New hash %s", _block_hash_short)
-                # A new hash is seen, make a new list to store its events in
-                self.logevents[_block_hash] = {}
-
-            if _block_hash not in self.working_hashes:
-                self.working_hashes.append(_block_hash)
-
-            # All events recoreded are stored in different lists based
-            # on the event kind within logevents
-            if event.kind not in self.logevents[_block_hash]:
-                self.logevents[_block_hash][event.kind] = []
-            self.logevents[_block_hash][event.kind].append(event)
-            logger.debug(event)
-
-            # Do not event try to republish
-            if _block_hash in self.published_blocks:
-                logger.debug("Already published %s", _block_hash)
-                continue
-
-            # Check that all needed events are recorded for current _block_hash
-            if not (
-                LogEventKind.TRACE_DOWNLOADED_HEADER
-                in self.logevents[_block_hash].keys()
-                and LogEventKind.SEND_FETCH_REQUEST
-                in self.logevents[_block_hash].keys()
-                and LogEventKind.COMPLETED_BLOCK_FETCH
-                in self.logevents[_block_hash].keys()
-                and (
-                    LogEventKind.ADDED_TO_CURRENT_CHAIN
-                    in self.logevents[_block_hash].keys()
-                    or LogEventKind.SWITCHED_TO_A_FORK
-                    in self.logevents[_block_hash].keys()
-                )
-            ):
-                logger.debug(
-                    "Not all event types collected for hash %s ", _block_hash_short
-                )
-                continue
-
-            # Flatten the events to feed all of them into BlockSample
-            all_events = []
-            for event_kind_list in self.logevents[_block_hash].values():
-                all_events.extend(event_kind_list)
-
-            new_sample = BlockSample(all_events, self.app_config.network_magic)
-
-            # Check BlockSample has all needed Events to produce sample
-            if not new_sample.is_complete():
-                logger.debug("Incomplete LogEvents for %s", _block_hash_short)
-                continue
-
-            # Check values are in acceptable ranges
-            if not new_sample.is_sane():
-                logger.debug("Insane values for sample %s", new_sample)
-                self.metrics.inc("invalid_samples")
-                continue
-
-            logger.info("Sample for %s created", _block_hash_short)
-            self.metrics.set("header_delta", new_sample.header_delta)
-            self.metrics.set("block_request_delta", new_sample.block_request_delta)
-            self.metrics.set("block_response_delta", new_sample.block_response_delta)
-            self.metrics.set("block_adopt_delta", new_sample.block_adopt_delta)
-            self.metrics.set(
-                "block_delay",
-                new_sample.header_delta
-                + new_sample.block_request_delta
-                + new_sample.block_response_delta
-                + new_sample.block_adopt_delta,
-            )
-            self.metrics.set("block_no", new_sample.block_num)
-            self.metrics.inc("valid_samples")
-
-            # The sample is ready to be published, create the payload for mqtt,
-            # determine the topic and publish that sample
-            self.print_block_stats(new_sample)
-            payload = self.mqtt_payload_from(new_sample)
+        self.start_sweeper()
+        for logevents in self.logevents_source():
+            for new_sample in self.assembler.add_batch(logevents):
+                for topic, payload in self.messages_of(new_sample):
+                    self.publish(topic, payload)
+
+    def current_slot(self) -> int:
+        return self.slot_clock.slot_at_ms(int(time.time() * 1000))
+
+    def start_sweeper(self) -> threading.Thread:
+        """Starts a thread that evicts old blocks from the assembler every
+        SWEEP_INTERVAL seconds, also when the logfile is quiet. It also saves
+        the published hashes."""
+
+        def sweep():
+            while True:
+                time.sleep(SWEEP_INTERVAL)
+                self.assembler.evict(self.current_slot())
+                self.assembler.save_published()
+
+        thread = threading.Thread(target=sweep, name="sweeper", daemon=True)
+        thread.start()
+        return thread
+
+    def handle_sample(self, new_sample: BlockSample) -> tuple:
+        """Records a newly created sample in metrics, peer stats and the
+        local store. Returns the topic and payload to publish it with."""
+        _block_hash_short = new_sample.block_hash_short
+        logger.info("Sample for %s created", _block_hash_short)
+        self.metrics.set("header_delta", new_sample.header_delta)
+        self.metrics.set("block_request_delta", new_sample.block_request_delta)
+        self.metrics.set("block_response_delta", new_sample.block_response_delta)
+        self.metrics.set("block_adopt_delta", new_sample.block_adopt_delta)
+        if new_sample.chain_selection:
+            self.metrics.set("block_validate_delta", new_sample.block_validate_delta)
+            self.metrics.set("block_select_delta", new_sample.block_select_delta)
+        self.metrics.set(
+            "block_delay",
+            new_sample.header_delta
+            + new_sample.block_request_delta
+            + new_sample.block_response_delta
+            + new_sample.block_adopt_delta,
+        )
+        self.metrics.set("block_no", new_sample.block_num)
+        if new_sample.fetch_counts:
+            self.metrics.set("header_fan_in", new_sample.fetch_counts.headers)
+        self.metrics.inc("valid_samples")
+        watchdog.beat(self.sample_stage, new_sample.slot_time_ms / 1000)
+        snapshot = self.snapshot_during(new_sample)
+        self.metrics.set(
+            "block_adopt_delta_by_snapshot",
+            new_sample.block_adopt_delta,
+            str(snapshot).lower(),
+        )
+        if snapshot:
+            self.metrics.inc("snapshot_samples")
+        self.peer_stats.add_sample(new_sample)
+        self.metrics.set_peers(self.peer_stats.top(self.app_config.peer_stats_top_k))
+
+        # The sample is ready to be published, create the payload for mqtt,
+        # determine the topic and publish that sample
+        self.print_block_stats(new_sample, snapshot)
+        if self.store:
+            self.store.append(new_sample, FLAG_SNAPSHOT if snapshot else 0)
+        payload = self.mqtt_payload_from(new_sample)
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 json.dumps(payload, indent=4, sort_keys=True, ensure_ascii=False)
             )
-            topic = f"{self.app_config.topic}/{new_sample.block_hash}"
-            self.mqtt_client.publish(topic, payload)
+        topic = f"{self.app_config.topic}/{new_sample.block_hash}"
 
-            self.published_blocks.append(_block_hash)
-            logger.info(
-                "LogEvents for %s blocks - Working on %s blocks, Published %s samples ",
-                len(self.logevents.keys()),
-                len(self.working_hashes),
-                len(self.published_blocks),
-            )
+        logger.info(
+            "LogEvents for %s blocks - Working on %s blocks, Published %s samples ",
+            len(self.assembler.logevents.keys()),
+            len(self.assembler.working_hashes),
+            len(self.assembler.published_blocks),
+        )
+        return topic, payload
 
-    def get_real_node_logfile(self) -> Path:
-        """Return the path to the logfile that node.log points to"""
-        while True:
-            node_log_link = self.app_config.node_logfile
-            # At this point there must not be an empty logfile
-            assert node_log_link, "Node logfile not found"
-            if not node_log_link.exists():
-                logger.warning("Node log file does not exist %s", node_log_link)
-                time.sleep(2)
-            try:
-                real_node_log = os.path.realpath(node_log_link, strict=True)
-                node_logdir = self.app_config.node_logdir
-                assert node_logdir, "Node logdir not found"
-                return node_logdir.joinpath(real_node_log)
-            except OSError:
-                logger.warning("Real node log not found from link %s", node_log_link)
-                time.sleep(2)
+    def snapshot_during(self, sample: BlockSample) -> bool:
+        """Whether the node took a ledger snapshot between receiving the
+        first header of the sample and adopting its block."""
+        fth, block_adopt = sample.first_trace_header, sample.block_adopt
+        if not fth or not block_adopt:
+            return False
+        return self.snapshots.overlaps(
+            int(fth.at.timestamp() * 1000), int(block_adopt.at.timestamp() * 1000)
+        )
+
+    def store_incomplete(self, incomplete: BlockSample) -> None:
+        """Stores what is known of a block evicted before it was adopted"""
+        if self.store:
+            self.store.append(incomplete, FLAG_INCOMPLETE)
+
+    def summary_window_of(self, sample: BlockSample) -> int:
+        """The window of the sample, either its epoch or the start of its
+        window (in seconds since the epoch)"""
+        summary_window = self.app_config.summary_window
+        if summary_window == "epoch":
+            return self.slot_clock.epoch_of(
+                sample.slot_num, self.app_config.epoch_length
+            )
+        window_ms = int(summary_window) * 1000
+        return sample.slot_time_ms // window_ms * window_ms // 1000
+
+    def messages_of(self, new_sample: BlockSample) -> list:
+        """Handles the new sample, returns the (topic, payload) tuples to
+        publish for it. Depending on the publish mode that is the sample,
+        the summary of the window it closed (if any) or both."""
+        topic, payload = self.handle_sample(new_sample)
+        messages = []
+        if self.app_config.publish_mode != "summary":
+            messages.append((topic, payload))
+        if self.summarizer and (summary := self.summarizer.add(new_sample)):
+            messages.append((f"{self.app_config.topic}/summary", summary))
+        return messages
 
     def slot_is_too_old(self, logevents: list) -> bool:
         """Given a list of logevents it finds the TraceDownloadedHeader event
         and determines whether the current slot_num is too old for us.
         """
-        trace_headers = [
-            event
-            for event in logevents
-            if event.kind == LogEventKind.TRACE_DOWNLOADED_HEADER
-        ]
+        trace_header = next(
+            (
+                event
+                for event in logevents
+                if event.kind == LogEventKind.TRACE_DOWNLOADED_HEADER
+            ),
+            None,
+        )
 
         # Without TraceHeaders we cant even calcualte the slot_time
-        if not trace_headers:
+        if not trace_header:
             return False
 
         # If there is one, check its slot_time
-        trace_header = trace_headers.pop(0)
-        slot_time = slot_time_of(trace_header.slot_num, self.app_config.network_magic)
-        if slot_time < datetime.now(tz=timezone.utc) - timedelta(hours=12):
+        slot_time_ms = self.slot_clock.slot_time_ms(trace_header.slot_num)
+        if slot_time_ms < time.time() * 1000 - TOO_OLD_MS:
+            # The caller pauses reading, which the watchdog should not take
+            # for a stall. Neither the lack of new samples meanwhile.
+            watchdog.idle(self.read_stage)
+            watchdog.idle(self.sample_stage)
             logger.info(
                 "Slot %s is too old (%s)",
                 trace_header.slot_num,
-                slot_time,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(slot_time_ms / 1000)),
             )
             return True
         return False
 
-    def logevents_logfile(self):
-        """Generator that "tails" the nodes log file and produces LogEvents
-        for each new line. The nodes logfile is actually a symlink and just
-        opening up that symlink will not work since it eventually will be
-        relinked to a new file and the file handle will be invalid.
+    def logevents_of(self, lines: list) -> list:
+        """Create logevents from lines, filtering out the ones not of interest.
+        The format of the lines is detected from the first ones that tell.
+        Mempool traces are only counted and snapshots only tracked, they
+        never become logevents."""
+        lines = self.snapshots.filter(self.mempool.filter(lines))
+        self.export_mempool(self.mempool.totals())
+        if not self.log_format and (log_format := detect_format(lines)):
+            logger.info("Node logs in %s format", log_format.value)
+            self.log_format = log_format
+        _log_format = self.log_format or LogFormat.LEGACY
+        logevents = map(
+            lambda line: LogEvent.from_logline(
+                line, self.app_config.masked_addresses, self.start_time, _log_format
+            ),
+            lines,
+        )
+        # Filter out None's
+        return [event for event in logevents if event is not None]
+
+    @property
+    def uses_parse_worker(self) -> bool:
+        """The parse worker only tails the logfile, not the other sources"""
+        return self.app_config.parse_worker and self.app_config.source == "file"
+
+    def open_source(self):
+        """Opens the source of the nodes log lines, see blockperf.sources. If
+        the parse worker is used, that is returned instead."""
+        if self.uses_parse_worker:
+            return self.parse_worker()
+        if self.app_config.parse_worker:
+            logger.warning(
+                "Parse worker only reads the logfile, parsing %s in process",
+                self.app_config.source,
+            )
+        return open_source(
+            self.app_config.source,
+            node_logfile=self.app_config.node_logfile,
+            node_service_unit=self.app_config.node_service_unit,
+            journald_cursor_file=self.app_config.journald_cursor_file,
+            source_socket=self.app_config.source_socket,
+        )
 
-        Thats why i open the file the symlink points to. If no newlines
-        are being written to that file the symlink is checked again whether
-        it has a new target. If so the new logfile is opened and again read
-        line by line producing LogEvent instances.
+    def read_logevents(self, source) -> list:
+        """Returns the logevents of all lines the source received since the
+        last call."""
+        if self.uses_parse_worker:
+            # Whether the node logged anything is up to the sample stage,
+            # the read stage only tells the worker is still reading
+            if (reads := source.reads()) != self.worker_reads:
+                watchdog.beat(self.read_stage)
+                self.worker_reads = reads
+            self.export_mempool(source.mempool_totals())
+            self.snapshots.update(source.snapshots())
+            return source.read_events()
+        lines = source.read_lines()
+        watchdog.beat(self.read_stage)
+        return self.logevents_of(lines)
+
+    def export_mempool(self, totals: tuple) -> None:
+        """Exports the totals of a MempoolCounter as metrics"""
+        if not self.app_config.mempool_metrics:
+            return
+        added, rejected, removed, txs, _bytes = totals
+        counts = (added, rejected, removed)
+        if counts == self.mempool_exported:
+            return
+        for metric, count, exported in zip(
+            ("mempool_added_txs", "mempool_rejected_txs", "mempool_removed_txs"),
+            counts,
+            self.mempool_exported,
+        ):
+            if count > exported:
+                self.metrics.inc(metric, count - exported)
+        self.metrics.set("mempool_txs", txs)
+        self.metrics.set("mempool_bytes", _bytes)
+        self.mempool_exported = counts
+
+    def logevents_source(self):
+        """Generator that "tails" the source of the nodes log lines and
+        produces a list of LogEvents for all new lines read at once. See
+        blockperf.sources and ParseWorker for how the lines are read.
         """
-        seek_file = True
-        while True:
-            real_node_log = self.get_real_node_logfile()
-            lines_read = 0
-            with open(real_node_log, "r", 1, "utf-8") as fp:
-                logger.info("Opened %s", real_node_log)
-                # Avoid reading through old node.log on fresh start
-                if seek_file:
-                    logger.debug("Seek to end of file")
-                    fp.seek(0, 2)
-                    seek_file = False
-                while True:
-                    new_lines = fp.readlines()
-                    # Create logevents from lines
-                    logevents = map(
-                        lambda line: LogEvent.from_logline(
-                            line, self.app_config.masked_addresses, self.start_time
-                        ),
-                        new_lines,
-                    )
-                    # Filter out None's
-                    logevents = [event for event in logevents if event is not None]
-
-                    # Check if the current slot is too old. If it is, sleep
-                    # a while and start over. This is important for when the node
-                    # is syncing from scratch and producing alot of old logevents.
-                    if self.slot_is_too_old(logevents):
-                        time.sleep(250)
-                        seek_file = True
-                        break
-
-                    # Yield all events
-                    logger.debug(f"Found {len(logevents)} logevents")
-                    yield from logevents
-
-                    # If no new_lines are returned check if the symlink changed
-                    # If it did not change, wait and retry readlines()
-                    # If it did change, return to outer while and restart
-                    if not new_lines and (
-                        real_node_log.name != self.get_real_node_logfile().name
-                    ):
-                        logger.info("Symlink changed")
-                        break
+        source = self.open_source()
+        try:
+            while True:
+                logevents = self.read_logevents(source)
+
+                # Check if the current slot is too old. If it is, sleep
+                # a while and start over. This is important for when the node
+                # is syncing from scratch and producing alot of old logevents.
+                if self.slot_is_too_old(logevents):
+                    time.sleep(250)
+                    source.seek_end()
+                    continue
+
+                # Yield all events
+                logger.debug("Found %s logevents", len(logevents))
+                if logevents:
+                    if self.capture:
+                        self.capture.append(logevents)
+                    yield logevents
+                else:
                     time.sleep(0.5)
+        finally:
+            source.close()
+
+    def parse_worker(self) -> "ParseWorker":
+        """Starts the process that tails and parses the logfile"""
+        from blockperf.parseworker import ParseWorker
+
+        assert self.app_config.node_logfile, "Node logfile not found"
+        worker = ParseWorker(
+            self.app_config.node_logfile,
+            self.app_config.masked_addresses,
+            self.start_time,
+        )
+        size = worker.ring.shm.size
+        budget.account(f"{self.relay} parse ring", lambda: size, fixed=True)
+        return worker
+
+
+class AppGroup:
+    """Runs an App for each of several relays within a single process.
+
+    All apps share the sinks (e.g. the mqtt connection, whose broker settings
+    and certificates are taken from the first relay) and the metrics server. Each app runs
+    its blocksample loop in its own thread, so one busy relay does not delay
+    the others.
+    """
+
+    apps: list
+
+    def __init__(self, configs: list) -> None:
+        self.apps = [App(config) for config in configs]
+
+    def run(self):
+        try:
+            Metrics.serve()
+            sinks = self.apps[0].open_sinks()
+            watchdog.start()
+            threads = []
+            for app in self.apps:
+                app.sinks = sinks
+                thread = threading.Thread(
+                    target=app.run_blocksample_loop,
+                    name=app.app_config.section,
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+            # The loops are supposed to run forever, if one of them stops
+            # exit to have the whole process restarted
+            while all(thread.is_alive() for thread in threads):
+                time.sleep(1)
+            stopped = [thread.name for thread in threads if not thread.is_alive()]
+            sys.exit(f"Blocksample loop of {', '.join(stopped)} stopped")
+        except KeyboardInterrupt:
+            sys.stdout.write("Closed")
+            return
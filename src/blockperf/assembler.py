@@ -0,0 +1,431 @@
+"""
+The SampleAssembler collects LogEvents per block hash and creates BlockSamples
+once all the events needed for a given hash have been recorded.
+"""
+
+import itertools
+import logging
+import threading
+from typing import Callable, Iterable, Iterator, Union
+
+from blockperf.blocksample import BlockSample, FetchCounts
+from blockperf.memory import EVENT_MEMORY, MemoryBudget
+from blockperf.metrics import Metrics
+from blockperf.nodelogs import LogEvent, LogEventKind
+from blockperf.published import PublishedFilter
+from blockperf.slotclock import clock_of
+
+logger = logging.getLogger(__name__)
+
+# Number of events samples() applies at once
+BATCH_SIZE = 1000
+# Blocks more slots than this behind the tip are evicted
+MAX_BLOCK_AGE = 3600
+# Upper bound of events held for all blocks together
+MAX_EVENTS = 20000
+
+
+def _ms(event: LogEvent) -> int:
+    return int(event.at.timestamp() * 1000)
+
+
+class SampleAssembler:
+    network_magic: int
+    max_block_age: int
+    max_events: int
+    memory_budget: Union[MemoryBudget, None]
+    # The name of this assemblers share of the memory budget
+    budget_share: str
+    metrics: Union[Metrics, None]
+    # Called with a sample of what is known of blocks evicted incomplete
+    on_incomplete: Union[Callable[[BlockSample], None], None]
+
+    # holds a dictionairy for each kind of events for each block_hash
+    logevents: dict
+    # the list of published hashes still in working_hashes
+    published_blocks: list
+    # all hashes published, to not publish a hash twice
+    published: PublishedFilter
+    # The slot of every hash in logevents, None until the next evict()
+    # for hashes whose header has not been seen (yet).
+    working_hashes: dict
+    # The highest slot seen in any header
+    tip_slot: int
+    # The slot of the first header seen, blocks after it were seen by this
+    # assembler from their start
+    first_slot: int
+    # Number of events held in logevents
+    events_held: int
+    # The FetchCounts of every hash in logevents
+    fetch_counts: dict
+
+    def __init__(
+        self,
+        network_magic: int,
+        max_block_age: int = MAX_BLOCK_AGE,
+        max_events: int = MAX_EVENTS,
+        metrics: Union[Metrics, None] = None,
+        memory_budget: Union[MemoryBudget, None] = None,
+        published: Union[PublishedFilter, None] = None,
+        on_incomplete: Union[Callable[[BlockSample], None], None] = None,
+        budget_share: str = "events",
+    ) -> None:
+        self.network_magic = network_magic
+        self.max_block_age = max_block_age
+        self.max_events = max_events
+        self.memory_budget = memory_budget
+        self.budget_share = budget_share
+        if memory_budget:
+            memory_budget.share(budget_share, lambda: self.memory_used)
+        self.metrics = metrics
+        self.on_incomplete = on_incomplete
+        self.logevents = {}
+        self.published_blocks = []
+        self.published = published if published is not None else PublishedFilter()
+        self.working_hashes = {}
+        self.tip_slot = 0
+        self.first_slot = 0
+        self.events_held = 0
+        self.fetch_counts = {}
+        # The sweeper evicts from another thread than the one adding events
+        self.lock = threading.RLock()
+
+    def evict(self, now_slot: int = 0) -> None:
+        """
+        * logevents holds all events recorded for all hashes seen.
+        * published_blocks holds hashes of the published blocks among them.
+
+        LogEvents hashes eventually get adopted (or not). But this may
+        take some time. I want to wait until the block is max_block_age slots
+        older than the tip before i drop that hash. The tip is the highest
+        slot seen in any header, or now_slot if that is higher. The latter
+        allows a sweeper to evict stale blocks when no new events come in.
+
+        Hashes without a header yet start to age once they are seen here.
+
+        Samples for blocks that already have a sample published should not get
+        republished. Thats what self.published is for, which is not bound to
+        the blocks in working_hashes. The list of published_blocks, which
+        are still in working_hashes is cleaned up here as well.
+
+        Independent of their age the number of events held is bound by
+        max_events and its share of the memory budget. If either is exceeded,
+        the assembler degrades in this order until it is within bounds again:
+
+            * Only the first header of each block is kept. The others are
+              not needed for the sample, only the peer statistics lack them.
+            * Published blocks are dropped.
+            * The oldest incomplete blocks are dropped.
+        """
+        with self.lock:
+            tip = max(self.tip_slot, now_slot)
+            expired = []
+            for block_hash, slot in self.working_hashes.items():
+                if slot is None:
+                    # Without any tip yet, keep waiting for one
+                    self.working_hashes[block_hash] = tip or None
+                elif tip - slot > self.max_block_age:
+                    expired.append(block_hash)
+            for block_hash in expired:
+                self._remove(block_hash)
+
+            if self.over_budget():
+                self._drop_redundant_headers()
+            if self.over_budget():
+                logger.warning(
+                    "Holding %s events (~%s bytes), dropping blocks",
+                    self.events_held,
+                    self.memory_used,
+                )
+                by_age = sorted(
+                    self.working_hashes,
+                    key=lambda block_hash: (
+                        block_hash not in self.published_blocks,
+                        self.working_hashes[block_hash] or tip,
+                    ),
+                )
+                for block_hash in by_age:
+                    if not self.over_budget():
+                        break
+                    self._remove(block_hash)
+
+            if self.metrics:
+                self.metrics.set("inflight_blocks", len(self.working_hashes))
+                self.metrics.set("memory_accounted", self.memory_used)
+
+    def save_published(self) -> None:
+        """Saves the published hashes, if due (see PublishedFilter.save_due).
+        Only the copy is taken under the lock, add_batch() does not have to
+        wait for the file to be written."""
+        with self.lock:
+            data = self.published.snapshot()
+        if data:
+            self.published.write(data)
+
+    @property
+    def memory_used(self) -> int:
+        """Approximate bytes held by the recorded events"""
+        return self.events_held * EVENT_MEMORY
+
+    def over_budget(self) -> bool:
+        if self.events_held > self.max_events:
+            return True
+        # Only its own events count, not the memory of other relays or
+        # what can not be freed at all
+        return bool(
+            self.memory_budget and self.memory_budget.exceeded(self.budget_share)
+        )
+
+    def _drop_redundant_headers(self) -> None:
+        """Keeps only the first header of every block"""
+        dropped = 0
+        for hash_events in self.logevents.values():
+            headers = hash_events.get(LogEventKind.TRACE_DOWNLOADED_HEADER, [])
+            if len(headers) > 1:
+                dropped += len(headers) - 1
+                del headers[1:]
+        self.events_held -= dropped
+        if dropped:
+            logger.warning("Dropped %s redundant headers", dropped)
+            if self.metrics:
+                self.metrics.inc("dropped_headers", dropped)
+
+    def _remove(self, block_hash: str) -> None:
+        """Deletes everything recorded for block_hash"""
+        hash_events = self.logevents.pop(block_hash)
+        self.events_held -= sum(map(len, hash_events.values()))
+        published_before = self._published_before(block_hash)
+        del self.working_hashes[block_hash]
+        fetch_counts = self.fetch_counts.pop(block_hash)
+        if block_hash in self.published_blocks:
+            self.published_blocks.remove(block_hash)
+            logger.debug("Removed %s", block_hash)
+        elif not published_before:
+            logger.info("Evicted incomplete block %s", block_hash[0:10])
+            if self.metrics:
+                self.metrics.inc("evicted_incomplete")
+            # Without a header not even the slot of the block is known
+            if self.on_incomplete and hash_events.get(
+                LogEventKind.TRACE_DOWNLOADED_HEADER
+            ):
+                incomplete = BlockSample(
+                    list(itertools.chain(*hash_events.values())), self.network_magic
+                )
+                incomplete.fetch_counts = fetch_counts
+                self.on_incomplete(incomplete)
+
+    def _published_before(self, block_hash: str) -> bool:
+        """Whether block_hash was published, but is not in published_blocks.
+        That is only possible for blocks from before the first header this
+        assembler has seen (e.g. published before a restart) or evicted
+        since, only for those the filter is asked. Any other block would be
+        in published_blocks, the filter could only be wrong about it."""
+        slot = self.working_hashes.get(block_hash)
+        if (
+            slot
+            and slot > self.first_slot
+            and max(self.tip_slot, slot) - slot <= self.max_block_age
+        ):
+            return False
+        return block_hash in self.published
+
+    def _observe_stages(self, hash_events: dict, seen: tuple) -> None:
+        """Exports the delta of every stage that was completed for the first
+        time with the events just recorded. seen are the headers, requests
+        and completions counted before them. The sample (if there ever is one)
+        may differ slightly, it looks at the events ordered by time."""
+        headers = hash_events.get(LogEventKind.TRACE_DOWNLOADED_HEADER)
+        requests = hash_events.get(LogEventKind.SEND_FETCH_REQUEST)
+        completed = hash_events.get(LogEventKind.COMPLETED_BLOCK_FETCH)
+        if headers and not seen[0]:
+            slot_time_ms = clock_of(self.network_magic).slot_time_ms(
+                headers[0].slot_num
+            )
+            self._observe("header", _ms(headers[0]) - slot_time_ms)
+        if requests and not seen[1] and headers:
+            self._observe("request", _ms(requests[0]) - _ms(headers[0]))
+        if completed and not seen[2] and requests:
+            fcb = completed[0]
+            for request in requests:
+                if (request.remote_addr, request.remote_port) == (
+                    fcb.remote_addr,
+                    fcb.remote_port,
+                ):
+                    self._observe("response", _ms(fcb) - _ms(request))
+                    break
+
+    def _observe(self, stage: str, delta: int) -> None:
+        logger.debug("Stage %s +%s ms", stage, delta)
+        if self.metrics:
+            self.metrics.set("stage_delta", delta, stage)
+
+    def samples(
+        self, events: Iterable[LogEvent], batch_size: int = BATCH_SIZE
+    ) -> Iterator[BlockSample]:
+        """Yields a BlockSample for every block that all needed events have
+        been seen for in the given events. The events are applied in batches
+        of batch_size, see add_batch()."""
+        events = iter(events)
+        while batch := list(itertools.islice(events, batch_size)):
+            yield from self.add_batch(batch)
+
+    def add(self, event: LogEvent) -> Union[BlockSample, None]:
+        """Records the given event and returns a new BlockSample if the event
+        completed the set of events needed for its block."""
+        new_samples = self.add_batch([event])
+        return new_samples[0] if new_samples else None
+
+    def add_batch(self, events: list) -> list:
+        """Records the given events and returns the new BlockSamples of all
+        blocks the events completed the set of needed events for.
+
+        From all the events that are possibly read from the logfile only
+        some are of interest.
+
+            * Must be of a specific kind
+                TRACE_DOWNLOADED_HEADER, SEND_FETCH_REQUEST, COMPLETED_BLOCK_FETCH,
+                TRY_SWITCH_TO_A_FORK, ADD_BLOCK_VALIDATION,
+                ADDED_TO_CURRENT_CHAIN, SWITCHED_TO_A_FORK
+            * Must not be too old (invalid)
+            * Must have a blockhash
+        These are already filtered out by LogEvent.from_logline()
+
+        A sample can only be created if all the required LogEvents have been
+        recorded for that given block. All required LogEvents means that
+        for each hash there must at least be one TRACE_DOWNLOADED_HEADER, one SEND_FETCH_REQUEST
+        and one COMPLETED_BLOCK_FETCH as well es one of the two possible adoption
+        kinds which are ADDED_TO_CURRENT_CHAIN and SWITCHED_TO_A_FORK.
+        The chain selection events are optional, they only split the adoption
+        into validation and selection if the node traces them.
+
+        To make that test somewhat simple there self.logevents holds all events
+        in dictionaries for their respective types. That makes it rather simple
+        to test if all required LogEvents have been collected yet.
+
+        A batch (e.g. everything read from the logfile at once) often holds
+        many events of the same few blocks. So the events are grouped by hash
+        first and each group is recorded in one go. Whether a block is
+        complete is only checked once per hash and batch.
+
+        Once that is the case a new sample is created by collecting all events
+        and instanciating BlockSample(). If the sample is complete and sane it
+        is returned and its hash is marked as published.
+        """
+        # Group the events by hash, keeping the order they were logged in
+        grouped: dict = {}
+        for event in events:
+            block_hash = event.block_hash
+            if block_hash not in grouped:
+                grouped[block_hash] = []
+            grouped[block_hash].append(event)
+
+        new_samples = []
+        with self.lock:
+            for _block_hash, hash_events in grouped.items():
+                if new_sample := self._add_hash_events(_block_hash, hash_events):
+                    new_samples.append(new_sample)
+
+            # Make sure lists dont fill up
+            self.evict()
+        return new_samples
+
+    def _add_hash_events(
+        self, _block_hash: str, events: list
+    ) -> Union[BlockSample, None]:
+        """Records the events of a single hash, see add_batch()"""
+        _block_hash_short = _block_hash[0:10]
+
+        if _block_hash not in self.logevents:
+            logger.debug("New hash %s", _block_hash_short)
+            # A new hash is seen, make a new dict to store its events in.
+            # Hashes are removed from logevents and working_hashes together,
+            # so it can not be in working_hashes already.
+            self.logevents[_block_hash] = {}
+            self.working_hashes[_block_hash] = None
+            self.fetch_counts[_block_hash] = FetchCounts()
+
+        # All events recoreded are stored in different lists based
+        # on the event kind within logevents
+        hash_events = self.logevents[_block_hash]
+        fetch_counts = self.fetch_counts[_block_hash]
+        seen = (fetch_counts.headers, fetch_counts.requests, fetch_counts.completed)
+        redundant, wasted_bytes = (
+            fetch_counts.redundant_fetches,
+            fetch_counts.wasted_bytes,
+        )
+        for event in events:
+            if event.kind not in hash_events:
+                hash_events[event.kind] = []
+            hash_events[event.kind].append(event)
+            fetch_counts.count(event)
+            logger.debug(event)
+            if event.kind == LogEventKind.TRACE_DOWNLOADED_HEADER and event.slot_num:
+                self.working_hashes[_block_hash] = event.slot_num
+                self.tip_slot = max(self.tip_slot, event.slot_num)
+                if not self.first_slot:
+                    self.first_slot = event.slot_num
+        self.events_held += len(events)
+        if seen != (
+            fetch_counts.headers,
+            fetch_counts.requests,
+            fetch_counts.completed,
+        ):
+            self._observe_stages(hash_events, seen)
+        if self.metrics and fetch_counts.redundant_fetches > redundant:
+            # Also counts the downloads after the sample was published
+            self.metrics.inc(
+                "redundant_fetches", fetch_counts.redundant_fetches - redundant
+            )
+            self.metrics.inc("wasted_bytes", fetch_counts.wasted_bytes - wasted_bytes)
+
+        # Do not event try to republish
+        if _block_hash in self.published_blocks:
+            logger.debug("Already published %s", _block_hash)
+            return None
+
+        # Check that all needed events are recorded for current _block_hash
+        if not (
+            LogEventKind.TRACE_DOWNLOADED_HEADER in hash_events
+            and LogEventKind.SEND_FETCH_REQUEST in hash_events
+            and LogEventKind.COMPLETED_BLOCK_FETCH in hash_events
+            and (
+                LogEventKind.ADDED_TO_CURRENT_CHAIN in hash_events
+                or LogEventKind.SWITCHED_TO_A_FORK in hash_events
+            )
+        ):
+            logger.debug(
+                "Not all event types collected for hash %s ", _block_hash_short
+            )
+            return None
+
+        # Flatten the events to feed all of them into BlockSample
+        all_events = []
+        for event_kind_list in hash_events.values():
+            all_events.extend(event_kind_list)
+
+        new_sample = BlockSample(all_events, self.network_magic)
+        new_sample.fetch_counts = fetch_counts.copy()
+
+        # Check BlockSample has all needed Events to produce sample
+        if not new_sample.is_complete():
+            logger.debug("Incomplete LogEvents for %s", _block_hash_short)
+            return None
+
+        # Check values are in acceptable ranges
+        if not new_sample.is_sane():
+            logger.debug("Insane values for sample %s", new_sample)
+            if self.metrics:
+                self.metrics.inc("invalid_samples")
+            return None
+
+        # Asked only for a complete sample, the filter may be wrong
+        if self._published_before(_block_hash):
+            logger.info("Not publishing %s, published before", _block_hash_short)
+            self.published_blocks.append(_block_hash)
+            if self.metrics:
+                self.metrics.inc("published_suppressed")
+            return None
+
+        self.published_blocks.append(_block_hash)
+        self.published.add(_block_hash)
+        return new_sample
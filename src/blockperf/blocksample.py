@@ -9,30 +9,55 @@ from blockperf import __version__ as blockperf_version
 
 # from blockperf.config import AppConfig
 from blockperf.nodelogs import LogEvent, LogEventKind
+from blockperf.slotclock import MAINNET_MAGIC, clock_of
 
 # logging.basicConfig(level=logging.DEBUG, format="(%(threadName)-9s) %(message)s")
 logger = logging.getLogger(__name__)
 
-NETWORK_STARTTIMES = {
-    # mainnet
-    764824073: 1591566291,
-    # preprod
-    1: 1655683200,
-}
 
-
-def slot_time_of(slot_num: int, network: int) -> datetime:
+def slot_time_of(slot_num: int, network: Union[int, str]) -> datetime:
     """Calculate the timestamp that given slot should have occured.
-    Works only if the networks slots are 1 second lenghts!
+    See SlotClock for how, network is either its magic or name.
     """
-    logger.debug("slot_time_of(%s, %s", slot_num, network)
-    if network not in NETWORK_STARTTIMES:
-        raise ValueError(f"No starttime for {network} available")
+    _slot_time_ms = clock_of(network).slot_time_ms(slot_num)
+    return datetime.fromtimestamp(_slot_time_ms / 1000, tz=timezone.utc)
+
 
-    _network_start = NETWORK_STARTTIMES.get(network, 0)
-    _slot_time = _network_start + slot_num
-    slot_time = datetime.fromtimestamp(_slot_time, tz=timezone.utc)
-    return slot_time
+class FetchCounts:
+    """How often a block was announced, requested and downloaded.
+
+    Counted by the assembler as the events come in, so they are right even
+    if events are dropped to save memory. Every download after the first one
+    is redundant, its bytes are wasted.
+    """
+
+    __slots__ = ("headers", "requests", "completed", "wasted_bytes")
+
+    def __init__(self) -> None:
+        self.headers = 0
+        self.requests = 0
+        self.completed = 0
+        self.wasted_bytes = 0
+
+    @property
+    def redundant_fetches(self) -> int:
+        return max(0, self.completed - 1)
+
+    def count(self, event: LogEvent) -> None:
+        if event.kind == LogEventKind.TRACE_DOWNLOADED_HEADER:
+            self.headers += 1
+        elif event.kind == LogEventKind.SEND_FETCH_REQUEST:
+            self.requests += 1
+        elif event.kind == LogEventKind.COMPLETED_BLOCK_FETCH:
+            self.completed += 1
+            if self.completed > 1:
+                self.wasted_bytes += event.size
+
+    def copy(self) -> "FetchCounts":
+        counts = FetchCounts()
+        for name in self.__slots__:
+            setattr(counts, name, getattr(self, name))
+        return counts
 
 
 class BlockSample:
@@ -67,6 +92,15 @@ class BlockSample:
                             adopt a block after it has completed receiving it
                             first AddToCurrentChain.at - first CompletedBlock.at
 
+        * blockValidateDelta  The part of blockAdoptDelta until chain selection
+                            validated the block (waiting in the queue and
+                            validating it)
+                            first ValidCandidate.at - first CompletedBlock.at
+
+        * blockSelectDelta  The rest of blockAdoptDelta, switching to the
+                            chain with the validated block
+                            first AddToCurrentChain.at - first ValidCandidate.at
+
         * blockRemoteAddress  # fill in from peer that first resulted in CompletedBlock
         * blockRemotePort     # fill in from peer that first resulted in CompletedBlock
         * blockLocalAddress   # Taken from blockperf config
@@ -76,8 +110,10 @@ class BlockSample:
     """
 
     trace_events: list = []
+    # Set by the assembler, as they were when the sample was created
+    fetch_counts: Union[FetchCounts, None] = None
 
-    def __init__(self, events: list, network_magic: int) -> None:
+    def __init__(self, events: list, network_magic: int = MAINNET_MAGIC) -> None:
         """Creates LogEvent and orders the events by at field"""
         events.sort(key=lambda x: x.at)
         self.trace_events = events
@@ -140,6 +176,20 @@ class BlockSample:
                 return event
         return None
 
+    @property
+    def chain_selection(self) -> Union[LogEvent, None]:
+        """Returns the first ADD_BLOCK_VALIDATION (ValidCandidate). Nodes that
+        do not trace that may still trace TRY_SWITCH_TO_A_FORK when
+        switching to a fork, which is taken instead. That is before the
+        validation though, so the validation is part of the selection then."""
+        try_switch = None
+        for event in self.trace_events:
+            if event.kind == LogEventKind.ADD_BLOCK_VALIDATION:
+                return event
+            if event.kind == LogEventKind.TRY_SWITCH_TO_A_FORK and not try_switch:
+                try_switch = event
+        return try_switch
+
     @property
     def block_adopt(self) -> Union[LogEvent, None]:
         """Return TraceEvent that this block was adopted with"""
@@ -169,11 +219,15 @@ class BlockSample:
             return 0
         return fth.slot_num
 
+    @property
+    def slot_time_ms(self) -> int:
+        """Determine the time (ms) that current slot_num should have happened."""
+        return clock_of(self.network_magic).slot_time_ms(self.slot_num)
+
     @property
     def slot_time(self) -> datetime:
         """Determine the time that current slot_num should have happened."""
-        _slot_time = slot_time_of(self.slot_num, self.network_magic)
-        return _slot_time
+        return datetime.fromtimestamp(self.slot_time_ms / 1000, tz=timezone.utc)
 
     @property
     def header_delta(self) -> int:
@@ -185,8 +239,7 @@ class BlockSample:
         """
         if not (fth := self.first_trace_header):
             return 0
-        header_delta = fth.at - self.slot_time
-        return int(header_delta.total_seconds() * 1000)
+        return int(fth.at.timestamp() * 1000) - self.slot_time_ms
 
     @property
     def block_num(self) -> int:
@@ -261,6 +314,30 @@ class BlockSample:
         else:
             return block_adopt_delta
 
+    @property
+    def block_validate_delta(self) -> int:
+        """Block validate delta in miliseconds
+
+        The part of the block adopt delta until chain selection validated the
+        block, 0 if the node did not trace that.
+        """
+        selection, fcb = self.chain_selection, self.first_completed_block
+        if not selection or not fcb:
+            return 0
+        return max(0, int((selection.at - fcb.at).total_seconds() * 1000))
+
+    @property
+    def block_select_delta(self) -> int:
+        """Block select delta in miliseconds
+
+        The part of the block adopt delta after chain selection validated the
+        block, 0 if the node did not trace that.
+        """
+        block_adopt, selection = self.block_adopt, self.chain_selection
+        if not block_adopt or not selection:
+            return 0
+        return max(0, int((block_adopt.at - selection.at).total_seconds() * 1000))
+
     @property
     def block_g(self) -> float:
         if not (frcb := self.fetch_request_completed_block):
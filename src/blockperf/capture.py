@@ -0,0 +1,117 @@
+"""
+Capture of the block events blockperf derives its samples from.
+
+Of all the lines the node logs, blockperf only uses the events of five
+kinds. With a capture directory configured, these events are appended to
+segment files as the same fixed width records the parse worker passes
+around (see parseworker.EVENT), 113 bytes each instead of the
+kilobyte of json the node logged. Segments cover a day (by the time of the
+event) and are named after the start of that day, e.g.
+events-1693526400.bin. Segments that fall out of the retention window are
+deleted.
+
+Every segment starts with MAGIC, which is how replay tells capture files
+from node logfiles. As the records are fixed width, a segment can also be
+loaded straight into a numpy structured array.
+"""
+
+import logging
+import mmap
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterator, Union
+
+from blockperf.parseworker import EPOCH, EVENT, pack_event, unpack_event
+from blockperf.store import SEGMENT_SECONDS, truncate_partial
+
+logger = logging.getLogger(__name__)
+
+# File magic and version of the record layout
+MAGIC = b"BPEVENT1"
+SEGMENT_PREFIX = "events-"
+SEGMENT_SUFFIX = ".bin"
+
+
+def is_capture(path: Path) -> bool:
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def read_capture(path: Path) -> Iterator:
+    """Yields the LogEvents of all complete records in the capture file"""
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        end = fp.seek(0, 2)
+        count = (end - len(MAGIC)) // EVENT.size
+        if not count:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # A partially written record at the end is ignored
+            for index in range(count):
+                yield unpack_event(mm, len(MAGIC) + index * EVENT.size)
+
+
+class EventCapture:
+    """Appends events to the segments in capture_dir"""
+
+    capture_dir: Path
+    retention: int
+    segment: Union[Path, None] = None
+    fp: Union[BinaryIO, None] = None
+
+    def __init__(self, capture_dir: Path, retention_days: int = 30) -> None:
+        self.capture_dir = Path(capture_dir)
+        self.retention = retention_days * 86400
+
+    def segment_of(self, timestamp: float) -> Path:
+        start = int(timestamp) // SEGMENT_SECONDS * SEGMENT_SECONDS
+        return self.capture_dir.joinpath(f"{SEGMENT_PREFIX}{start}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list:
+        """Returns (start, path) of all segments, oldest first"""
+        segments = []
+        for path in self.capture_dir.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"):
+            start = path.name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]
+            if start.isdigit():
+                segments.append((int(start), path))
+        return sorted(segments)
+
+    def open(self, segment: Path) -> BinaryIO:
+        self.close()
+        self.capture_dir.mkdir(parents=True, exist_ok=True)
+        truncate_partial(segment, EVENT.size, header=len(MAGIC))
+        self.fp = open(segment, "ab")
+        if not self.fp.tell():
+            self.fp.write(MAGIC)
+        self.segment = segment
+        # Rotating into a new segment is a good time to clean up old ones
+        self.remove_expired()
+        return self.fp
+
+    def append(self, logevents: list) -> None:
+        """Appends the events, all records of a segment in a single write"""
+        records: dict = {}
+        for event in logevents:
+            if record := pack_event(event):
+                segment = self.segment_of((event.at - EPOCH).total_seconds())
+                records.setdefault(segment, []).append(record)
+        for segment, _records in records.items():
+            fp = self.fp if segment == self.segment else self.open(segment)
+            assert fp, "No segment opened"
+            fp.write(b"".join(_records))
+            fp.flush()
+
+    def remove_expired(self, now: Union[float, None] = None) -> None:
+        """Removes all segments that are entirely outside the retention"""
+        oldest = (now or time.time()) - self.retention
+        for start, path in self.segments():
+            if start + SEGMENT_SECONDS < oldest and path != self.segment:
+                logger.info("Removing expired capture segment %s", path)
+                path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+            self.segment = None
@@ -1,31 +1,115 @@
 """CLI Entrypoint for blockperf"""
 
 import argparse
+import atexit
+import fcntl
+import itertools
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
 from logging.config import dictConfig
+from pathlib import Path
+from typing import Iterator, Union
 
-import psutil
-
-from blockperf.app import App
+from blockperf.assembler import SampleAssembler
+from blockperf.capture import is_capture, read_capture
 from blockperf.config import AppConfig
+from blockperf.nodelogs import LogEvent, LogFormat, detect_format
+from blockperf.store import SampleRecord, SampleStore
 
 logger = logging.getLogger(__name__)
 
+# Debug records per second let through for every line that logs
+DEBUG_RATE_LIMIT = 20
+# Lines the format of a replayed logfile is detected from
+FORMAT_LINES = 100
+
+LOCKFILE = Path(os.getenv("XDG_RUNTIME_DIR", tempfile.gettempdir()), "blockperf.lock")
+# The file descriptor holding the lock, it must stay open while running
+_lock_fd = None
 
-def already_running() -> bool:
-    """Checks if blockperf is already running."""
-    blockperfs = []
-    for proc in psutil.process_iter():
-        if "blockperf" in proc.name():
-            blockperfs.append(proc)
-    if len(blockperfs) > 1:
+
+def already_running(lockfile: Path = LOCKFILE) -> bool:
+    """Checks if blockperf is already running by trying to acquire an exclusive
+    lock on the lockfile. Once acquired, the lock is held until the process
+    exits, the kernel releases it no matter how the process ended.
+    """
+    global _lock_fd
+    fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
         return True
+    # Write the pid to have the lockfile tell who is holding it
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    _lock_fd = fd
     return False
 
 
-def setup_logger(debug: bool):
-    """Configures logging"""
+class RateLimitFilter(logging.Filter):
+    """Lets at most rate records per second through for every line that logs.
+
+    Meant for the debug logs written for every single event, which would
+    otherwise flood the handlers when catching up. How many records were
+    dropped is added to the next record of that line that passes.
+    """
+
+    def __init__(self, rate: int = DEBUG_RATE_LIMIT, level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        # (pathname, lineno) -> [second, records in that second, suppressed]
+        self.sites: dict = {}
+        # The second the sites were last pruned in
+        self.pruned = 0
+        # Records are filtered in every thread that logs
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+        second = int(record.created)
+        with self.lock:
+            if second > self.pruned:
+                self._prune(second)
+            key = (record.pathname, record.lineno)
+            site = self.sites.setdefault(key, [second, 0, 0])
+            if site[0] != second:
+                site[0], site[1] = second, 0
+            site[1] += 1
+            if site[1] > self.rate:
+                site[2] += 1
+                return False
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar suppressed)"
+        return True
+
+    def _prune(self, second: int) -> None:
+        """Forgets the sites of past seconds, unless they still have to tell
+        how many records were suppressed"""
+        self.sites = {
+            key: site
+            for key, site in self.sites.items()
+            if site[0] >= second or site[2]
+        }
+        self.pruned = second
+
+
+def setup_logger(debug: bool, logfile: Union[str, None] = None):
+    """Configures logging.
+
+    All records are put into a queue by the calling thread and written by
+    the handlers in the thread of a QueueListener. That way a slow stdout
+    (e.g. journald) or disk never stalls the processing of events.
+    """
     level = "DEBUG" if debug else "INFO"
     logger_config = {
         "version": 1,
@@ -46,47 +130,222 @@ def setup_logger(debug: bool):
                 "formatter": "simple",
                 "stream": "ext://sys.stdout",
             },
-            # "logfile": {
-            #    "class": "logging.handlers.RotatingFileHandler",
-            #    "level": "DEBUG",
-            #    "filename": "blockperf.log",
-            #    "formatter": "extra",
-            #    "mode": "a",
-            #    "maxBytes": 1000000,
-            #    "backupCount": 2,
-            # }
         },
-        "loggers": {"blockperf": {"level": "DEBUG", "handlers": []}},
+        # Only create debug records if any handler writes them
+        "loggers": {
+            "blockperf": {"level": "DEBUG" if logfile else level, "handlers": []}
+        },
         "root": {"level": level, "handlers": ["console"]},
     }
+    if logfile:
+        logger_config["handlers"]["logfile"] = {
+            "class": "logging.handlers.RotatingFileHandler",
+            "level": "DEBUG",
+            "filename": logfile,
+            "formatter": "extra",
+            "mode": "a",
+            "maxBytes": 1000000,
+            "backupCount": 2,
+        }
+        logger_config["root"]["handlers"].append("logfile")
     dictConfig(logger_config)
 
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Do not even enqueue (and format) what no handler would write
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    queue_handler.addFilter(RateLimitFilter())
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    listener.start()
+    # Write out whatever is still queued on exit
+    atexit.register(listener.stop)
+
 
 def setup_argparse():
     """Configures argparse"""
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "command", help="Command to run blockperf with", choices=["run"]
+        "command",
+        help="Command to run blockperf with",
+        choices=["run", "query", "replay", "stats"],
+    )
+    parser.add_argument(
+        "config_file",
+        help="Config file, each section other than DEFAULT configures a relay (run)",
+        nargs="?",
+        type=Path,
     )
     parser.add_argument("--debug", help="Write more debug output", action="store_true")
+    parser.add_argument(
+        "--store-dir",
+        help="Directory of the local sample store (query, replay, stats)",
+        default=os.getenv("BLOCKPERF_STORE_DIR"),
+    )
+    parser.add_argument(
+        "--since",
+        help="Only samples with a slot time since (query, stats)",
+        type=timestamp,
+    )
+    parser.add_argument(
+        "--until",
+        help="Only samples with a slot time before (query, stats)",
+        type=timestamp,
+    )
+    parser.add_argument(
+        "--peer", help="Only samples with header or block from this ip (query, stats)"
+    )
+    parser.add_argument(
+        "--logfile",
+        help="Node logfile or capture file to derive samples from, may be given "
+        "multiple times (replay)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--network-magic",
+        help="Network magic of the node that wrote the logfile (replay)",
+        type=int,
+        default=764824073,
+    )
+    parser.add_argument(
+        "--export",
+        help="Write the tables to PATH-hourly.csv and PATH-peers.csv, "
+        "or .parquet if PATH ends in .parquet (stats)",
+    )
     return parser.parse_args()
 
 
+def timestamp(value: str) -> float:
+    """Parses either a unix timestamp or an iso formatted date, which is
+    taken as utc if it does not specify a timezone."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        _datetime = datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Invalid time {value}") from exc
+    if not _datetime.tzinfo:
+        _datetime = _datetime.replace(tzinfo=timezone.utc)
+    return _datetime.timestamp()
+
+
+def query(args: argparse.Namespace):
+    """Prints all samples from the local store matching the given filters"""
+    if not args.store_dir:
+        sys.exit("No store directory given, use --store-dir or BLOCKPERF_STORE_DIR")
+    store = SampleStore(args.store_dir)
+    for record in store.query(since=args.since, until=args.until, peer=args.peer):
+        sys.stdout.write(f"{record}\n")
+
+
+def logfile_events(logfile: Path) -> Iterator[LogEvent]:
+    """Yields the events of interest in a node logfile or capture file"""
+    if is_capture(logfile):
+        yield from read_capture(logfile)
+        return
+    with open(logfile, "r", 1, "utf-8") as fp:
+        # Detect the format from the first lines, then read on from them
+        head = list(itertools.islice(fp, FORMAT_LINES))
+        log_format = detect_format(head) or LogFormat.LEGACY
+        for line in itertools.chain(head, fp):
+            if event := LogEvent.from_logline(line, log_format=log_format):
+                yield event
+
+
+def replay(args: argparse.Namespace):
+    """Derives samples from the given node logfiles (or capture files) from
+    start to end. The samples are appended to the store if given, printed
+    otherwise."""
+    store = SampleStore(args.store_dir) if args.store_dir else None
+    # The tip is taken from the replayed headers, so eviction by slot age
+    # works the same as when running live
+    assembler = SampleAssembler(args.network_magic)
+    samples = 0
+    for logfile in args.logfile:
+        for sample in assembler.samples(logfile_events(Path(logfile))):
+            samples += 1
+            if store:
+                store.append(sample)
+            else:
+                sys.stdout.write(f"{SampleRecord.from_sample(sample)}\n")
+    logger.info("Replayed %s samples from %s", samples, ", ".join(args.logfile))
+
+
+def stats(args: argparse.Namespace):
+    """Prints (and exports) aggregates over the samples in the store"""
+    if not args.store_dir:
+        sys.exit("No store directory given, use --store-dir or BLOCKPERF_STORE_DIR")
+    # numpy is optional, only import it when actually needed
+    from blockperf import stats as _stats
+
+    samples = _stats.load(
+        SampleStore(args.store_dir), since=args.since, until=args.until, peer=args.peer
+    )
+    hourly, peers = _stats.hourly(samples), _stats.peers(samples)
+    sys.stdout.write(
+        f"Samples: {len(samples)}\n"
+        f"Correlation block_size/block_response_delta: "
+        f"{_stats.size_correlation(samples):.3f}\n\n"
+        f"{_stats.format_table(hourly)}\n\n"
+        f"{_stats.format_table(peers)}\n"
+    )
+    if args.export:
+        export = Path(args.export)
+        suffix = export.suffix if export.suffix == ".parquet" else ".csv"
+        base = (
+            export.with_suffix("") if export.suffix in (".csv", ".parquet") else export
+        )
+        _stats.export(hourly, Path(f"{base}-hourly{suffix}"))
+        _stats.export(peers, Path(f"{base}-peers{suffix}"))
+
+
 def main():
     """
     This script is based on blockperf.sh which collects data from the cardano-node
     and sends it to an aggregation services for further analysis.
     """
     args = setup_argparse()
-    setup_logger(args.debug)
+    setup_logger(args.debug, os.getenv("BLOCKPERF_LOG_FILE"))
+    if args.command == "query":
+        query(args)
+        return
+    if args.command == "replay":
+        replay(args)
+        return
+    if args.command == "stats":
+        stats(args)
+        return
+
     # Ensure there is only one instance of blockperf running
-    if already_running():
+    if already_running(Path(os.getenv("BLOCKPERF_LOCKFILE", LOCKFILE))):
         sys.exit("Blockperf is already running")
 
-    app_config = AppConfig()
-    app = App(app_config)
+    # Import late, the app pulls in paho and prometheus which the other
+    # commands do not need
+    from blockperf.app import App, AppGroup
+    from blockperf.memory import install_signal_handler
+
+    app_configs = AppConfig.relays(args.config_file)
+    if app_configs[0].runtime == "asyncio":
+        from blockperf.aioapp import AsyncRuntime
+
+        app = AsyncRuntime([App(app_config) for app_config in app_configs])
+    elif len(app_configs) == 1:
+        app = App(app_configs[0])
+    else:
+        app = AppGroup(app_configs)
 
     if args.command == "run":
+        install_signal_handler(app_configs[0].tracemalloc)
         app.run()
     else:
         sys.exit(f"I dont know what {args.command} means")
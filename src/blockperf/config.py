@@ -7,11 +7,17 @@ import ipaddress
 import json
 import logging
 import os
+import re
 import sys
 from configparser import ConfigParser
+from functools import cached_property
 from pathlib import Path
 from typing import Union
 
+from blockperf.slotclock import KNOWN_NETWORKS, SlotClock
+from blockperf.sinks import SINKS
+from blockperf.sources import SOURCES
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,6 +28,12 @@ class ConfigError(Exception):
 BROKER_HOST = "a12j2zhynbsgdv-ats.iot.eu-central-1.amazonaws.com"
 BROKER_PORT = 8883
 BROKER_KEEPALIVE = 180
+# Options that are paths a relay writes to, every relay needs its own
+RELAY_PATHS = ("store_dir", "journald_cursor_file", "published_file", "capture_dir")
+# The section in the config file that holds the settings shared by all relays.
+# Its not configparsers default section, so that options in a relays section
+# can be told apart from the ones inherited from the shared section.
+SHARED_SECTION = "DEFAULT"
 ROOTDIR = Path(__file__).parent
 
 
@@ -31,15 +43,23 @@ class AppConfig:
     """
 
     config_parser: ConfigParser
-
-    def __init__(self, config_file: Union[Path, None] = None, verbose=False):
-        self.config_parser = ConfigParser()
+    section: str
+
+    def __init__(
+        self,
+        config_file: Union[Path, None] = None,
+        verbose=False,
+        section: str = SHARED_SECTION,
+    ):
+        self.config_parser = ConfigParser(default_section="blockperf:none")
         if config_file:
             self.config_parser.read(config_file)
         self.verbose = verbose
+        self.section = section
         self.check_blockperf_config()
         msg = (
             f"\n----------------------------------------------------\n"
+            f"Relay:         {self.section}\n"
             f"Node config:   {self.node_config_file}\n"
             f"Node logfile:  {self.node_logfile}\n"
             f"Client Name:   {self.name}\n"
@@ -50,6 +70,54 @@ class AppConfig:
         )
         sys.stdout.write(msg)
 
+    @classmethod
+    def relays(cls, config_file: Union[Path, None] = None, verbose=False) -> list:
+        """Returns an AppConfig for each relay configured in config_file.
+
+        Every section other than DEFAULT in the config file is a relay. The
+        options in DEFAULT are shared by all relays. Without any such section
+        there is only a single relay configured by DEFAULT (and the environment).
+        """
+        config_parser = ConfigParser(default_section="blockperf:none")
+        if config_file:
+            config_parser.read(config_file)
+        sections = [s for s in config_parser.sections() if s != SHARED_SECTION]
+        if not sections:
+            return [cls(config_file, verbose)]
+        relays = [cls(config_file, verbose, section) for section in sections]
+        # Paths from the relays own sections are used as they are, two relays
+        # writing the same store or state file would garble it.
+        for option in RELAY_PATHS:
+            paths = [path for relay in relays if (path := getattr(relay, option))]
+            if len(set(paths)) < len(paths):
+                raise ConfigError(f"Several relays use the same {option}")
+        return relays
+
+    def _get(self, option: str, env: str, fallback):
+        """Returns the value for option of a relay. The relays section in the
+        config file takes precedence over the environment variable env, which
+        takes precedence over the DEFAULT section."""
+        if self.section != SHARED_SECTION and self.config_parser.has_option(
+            self.section, option
+        ):
+            return self.config_parser.get(self.section, option)
+        return os.getenv(
+            env, self.config_parser.get(SHARED_SECTION, option, fallback=fallback)
+        )
+
+    def _relay_path(self, option: str, path: Path, directory: bool = False) -> Path:
+        """Returns path for this relay. A path not set in the relays own
+        section is shared by all relays, each relay gets its own directory in
+        it or its own file next to it (with the relays name appended)."""
+        if self.section == SHARED_SECTION or self.config_parser.has_option(
+            self.section, option
+        ):
+            return path
+        relay = re.sub(r"[^\w.-]", "_", self.section)
+        if directory:
+            return path.joinpath(relay)
+        return path.with_name(f"{path.stem}-{relay}{path.suffix}")
+
     def check_blockperf_config(self):
         """Try to check whether or not everything that is fundamentally needed
         is actually configured, by asking for its value and triggering
@@ -61,14 +129,16 @@ class AppConfig:
             )
             sys.exit()
 
-        if not self.node_logfile or not self.node_logfile.exists():
-            logger.error("Node logfile '%s' does not exist", self.node_logfile)
-            sys.exit()
+        # The other sources do not read the logfile
+        if self.source == "file":
+            if not self.node_logfile or not self.node_logfile.exists():
+                logger.error("Node logfile '%s' does not exist", self.node_logfile)
+                sys.exit()
 
-        # logdir is taken from the .parent of node_logfile
-        if not self.node_logdir or not self.node_logdir.exists():
-            logger.error("Node logdir '%s' does not exist", self.node_logdir)
-            sys.exit()
+            # logdir is taken from the .parent of node_logfile
+            if not self.node_logdir or not self.node_logdir.exists():
+                logger.error("Node logdir '%s' does not exist", self.node_logdir)
+                sys.exit()
 
         if not self.name:
             logger.error("NAME is not set")
@@ -78,17 +148,19 @@ class AppConfig:
             logger.error("RELAY_PUBLIC_IP is not set")
             sys.exit()
 
-        if not Path(self.client_cert).exists():
-            logger.error("Client cert '%s' does not exist", self.client_cert)
-            sys.exit()
+        # The certificates are only needed to publish to the broker
+        if "mqtt" in self.sinks:
+            if not Path(self.client_cert).exists():
+                logger.error("Client cert '%s' does not exist", self.client_cert)
+                sys.exit()
 
-        if not Path(self.client_key).exists():
-            logger.error("Client key '%s' does not exist", self.client_key)
-            sys.exit()
+            if not Path(self.client_key).exists():
+                logger.error("Client key '%s' does not exist", self.client_key)
+                sys.exit()
 
-        if not Path(self.amazon_ca).exists():
-            logger.error("Amazon CA '%s' does not exist", self.amazon_ca)
-            sys.exit()
+            if not Path(self.amazon_ca).exists():
+                logger.error("Amazon CA '%s' does not exist", self.amazon_ca)
+                sys.exit()
 
         if self.active_slot_coef <= 0.0:
             logger.error("Could not retrieve active_slot_coef")
@@ -112,7 +184,7 @@ class AppConfig:
         broker_host = os.getenv(
             "BLOCKPERF_BROKER_HOST",
             self.config_parser.get(
-                "DEFAULT",
+                SHARED_SECTION,
                 "broker_host",
                 fallback=BROKER_HOST,
             ),
@@ -124,7 +196,7 @@ class AppConfig:
         broker_port = os.getenv(
             "BLOCKPERF_BROKER_PORT",
             self.config_parser.get(
-                "DEFAULT",
+                SHARED_SECTION,
                 "broker_port",
                 fallback=BROKER_PORT,
             ),
@@ -137,17 +209,14 @@ class AppConfig:
 
     @property
     def node_config_file(self) -> Path:
-        node_config_file = os.getenv(
+        node_config_file = self._get(
+            "node_config",
             "BLOCKPERF_NODE_CONFIG",
-            self.config_parser.get(
-                "DEFAULT",
-                "node_config",
-                fallback="/opt/cardano/cnode/files/config.json",
-            ),
+            fallback="/opt/cardano/cnode/files/config.json",
         )
         return Path(node_config_file)
 
-    @property
+    @cached_property
     def node_config(self) -> dict:
         """Return Path to config.json file from env var, ini file or builtin default"""
         return json.loads(self.node_config_file.read_text())
@@ -174,7 +243,7 @@ class AppConfig:
                node_logfile = Path(ss.get("scName"))
                break
         """
-        node_logfile = os.getenv("BLOCKPERF_NODE_LOGFILE", None)
+        node_logfile = self._get("node_logfile", "BLOCKPERF_NODE_LOGFILE", None)
         if not node_logfile:
             return None
         return Path(node_logfile)
@@ -183,16 +252,51 @@ class AppConfig:
     def _shelley_genesis_file(self) -> Path:
         return self.node_config.get("ShelleyGenesisFile", None)
 
-    @property
+    @cached_property
     def _shelley_genesis_data(self) -> dict:
         _f = self.node_configdir.joinpath(self._shelley_genesis_file)
         return json.loads(_f.read_text())
 
+    @cached_property
+    def _byron_genesis_data(self) -> Union[dict, None]:
+        _byron_genesis_file = self.node_config.get("ByronGenesisFile", None)
+        if not _byron_genesis_file:
+            return None
+        _f = self.node_configdir.joinpath(_byron_genesis_file)
+        return json.loads(_f.read_text())
+
+    @property
+    def shelley_transition_epoch(self) -> int:
+        """The epoch the Shelley era started in. Known for the public networks,
+        private testnets set it in the node config."""
+        if "TestShelleyHardForkAtEpoch" in self.node_config:
+            return int(self.node_config["TestShelleyHardForkAtEpoch"])
+        if self.network_magic in KNOWN_NETWORKS:
+            return KNOWN_NETWORKS[self.network_magic][3]
+        logger.warning("Shelley transition epoch unknown, assuming 0")
+        return 0
+
+    @cached_property
+    def slot_clock(self) -> SlotClock:
+        """Clock to convert slots to time, derived from the genesis files"""
+        if not self._byron_genesis_data and self.network_magic in KNOWN_NETWORKS:
+            return SlotClock.for_network(self.network_magic)
+        return SlotClock.from_genesis(
+            self._byron_genesis_data,
+            self._shelley_genesis_data,
+            self.shelley_transition_epoch,
+        )
+
     @property
     def network_magic(self) -> int:
         """Retrieve network magic from ShelleyGenesisFile"""
         return int(self._shelley_genesis_data.get("networkMagic", 0))
 
+    @property
+    def epoch_length(self) -> int:
+        """Number of slots of a Shelley epoch"""
+        return int(self._shelley_genesis_data.get("epochLength", 432000))
+
     @property
     def active_slot_coef(self) -> float:
         active_slot_coef = self._shelley_genesis_data.get("activeSlotsCoeff", 0.0)
@@ -200,19 +304,15 @@ class AppConfig:
 
     @property
     def relay_public_ip(self) -> str:
-        relay_public_ip = os.getenv(
-            "BLOCKPERF_RELAY_PUBLIC_IP",
-            self.config_parser.get("DEFAULT", "relay_public_ip", fallback=""),
+        relay_public_ip = self._get(
+            "relay_public_ip", "BLOCKPERF_RELAY_PUBLIC_IP", fallback=""
         )
         return relay_public_ip
 
     @property
     def relay_public_port(self) -> int:
         relay_public_port = int(
-            os.getenv(
-                "BLOCKPERF_RELAY_PUBLIC_PORT",
-                self.config_parser.get("DEFAULT", "relay_public_port", fallback=3001),
-            )
+            self._get("relay_public_port", "BLOCKPERF_RELAY_PUBLIC_PORT", fallback=3001)
         )
         return relay_public_port
 
@@ -220,7 +320,7 @@ class AppConfig:
     def client_cert(self) -> str:
         client_cert = os.getenv(
             "BLOCKPERF_CLIENT_CERT",
-            self.config_parser.get("DEFAULT", "client_cert", fallback=""),
+            self.config_parser.get(SHARED_SECTION, "client_cert", fallback=""),
         )
         return client_cert
 
@@ -228,7 +328,7 @@ class AppConfig:
     def client_key(self) -> str:
         client_key = os.getenv(
             "BLOCKPERF_CLIENT_KEY",
-            self.config_parser.get("DEFAULT", "client_key", fallback=""),
+            self.config_parser.get(SHARED_SECTION, "client_key", fallback=""),
         )
         return client_key
 
@@ -236,46 +336,313 @@ class AppConfig:
     def amazon_ca(self) -> str:
         amazon_ca = os.getenv(
             "BLOCKPERF_AMAZON_CA",
-            self.config_parser.get("DEFAULT", "amazon_ca", fallback=""),
+            self.config_parser.get(SHARED_SECTION, "amazon_ca", fallback=""),
         )
         return amazon_ca
 
     @property
     def name(self) -> str:
-        name = os.getenv(
-            "BLOCKPERF_NAME",
-            self.config_parser.get("DEFAULT", "name", fallback=""),
-        )
+        name = self._get("name", "BLOCKPERF_NAME", fallback="")
         return name
 
     @property
     def topic_version(self) -> str:
         topic_base = os.getenv(
             "BLOCKPERF_TOPIC_VERSION",
-            self.config_parser.get("DEFAULT", "topic_version", fallback="v1"),
+            self.config_parser.get(SHARED_SECTION, "topic_version", fallback="v1"),
         )
         return topic_base
 
     @property
     def topic(self) -> str:
-        """"""
+        """The topic samples are published to, unless configured explicitly for
+        a relay its build from the network magic, name and relay ip."""
+        topic = self._get("topic", "BLOCKPERF_TOPIC", fallback="")
+        if topic:
+            return topic
         return f"cf/blockperf/{self.topic_version}/{self.network_magic}/{self.name}/{self.relay_public_ip}"
 
     @property
     def node_service_unit(self) -> str:
-        node_service_unit = os.getenv(
+        node_service_unit = self._get(
+            "node_service_unit",
             "BLOCKPERF_NODE_SERVICE_UNIT",
+            fallback="cardano-node.service",
+        )
+        return node_service_unit
+
+    @property
+    def source(self) -> str:
+        """Where the nodes log lines are read from, see blockperf.sources"""
+        source = self._get("source", "BLOCKPERF_SOURCE", fallback="file")
+        if source not in SOURCES:
+            raise ConfigError(f"Unknown source {source}, use {', '.join(SOURCES)}")
+        return source
+
+    @property
+    def source_socket(self) -> Path:
+        """Unix socket the socket source listens on"""
+        source_socket = self._get(
+            "source_socket",
+            "BLOCKPERF_SOURCE_SOCKET",
+            fallback=f"/run/blockperf/{self.relay_public_ip}.sock",
+        )
+        return Path(source_socket)
+
+    @property
+    def journald_cursor_file(self) -> Union[Path, None]:
+        """File the journald source remembers how far it read in. Defaults to
+        journald.cursor in the store_dir, if set."""
+        cursor_file = self._get(
+            "journald_cursor_file", "BLOCKPERF_JOURNALD_CURSOR_FILE", fallback=""
+        )
+        if cursor_file:
+            return self._relay_path("journald_cursor_file", Path(cursor_file))
+        if self.store_dir:
+            return self.store_dir.joinpath("journald.cursor")
+        return None
+
+    @property
+    def max_block_age(self) -> int:
+        """Number of slots a block may be behind the tip before it is evicted"""
+        max_block_age = os.getenv(
+            "BLOCKPERF_MAX_BLOCK_AGE",
+            self.config_parser.get(SHARED_SECTION, "max_block_age", fallback=3600),
+        )
+        return int(max_block_age)
+
+    @property
+    def max_inflight_events(self) -> int:
+        """Maximum number of events held for blocks not yet evicted"""
+        max_inflight_events = os.getenv(
+            "BLOCKPERF_MAX_INFLIGHT_EVENTS",
             self.config_parser.get(
-                "DEFAULT",
-                "node_service_unit",
-                fallback="cardano-node.service",
+                SHARED_SECTION, "max_inflight_events", fallback=20000
             ),
         )
-        return node_service_unit
+        return int(max_inflight_events)
+
+    @property
+    def peer_stats_max_peers(self) -> int:
+        """Maximum number of peers statistics are kept for"""
+        peer_stats_max_peers = os.getenv(
+            "BLOCKPERF_PEER_STATS_MAX_PEERS",
+            self.config_parser.get(
+                SHARED_SECTION, "peer_stats_max_peers", fallback=200
+            ),
+        )
+        return int(peer_stats_max_peers)
+
+    @property
+    def peer_stats_top_k(self) -> int:
+        """Number of peers that are exported as metrics"""
+        peer_stats_top_k = os.getenv(
+            "BLOCKPERF_PEER_STATS_TOP_K",
+            self.config_parser.get(SHARED_SECTION, "peer_stats_top_k", fallback=10),
+        )
+        return int(peer_stats_top_k)
+
+    @property
+    def store_dir(self) -> Union[Path, None]:
+        """Directory of the local sample store, the store is disabled if not
+        set. With several relays each has its own directory in it."""
+        store_dir = self._get("store_dir", "BLOCKPERF_STORE_DIR", fallback="")
+        if not store_dir:
+            return None
+        return self._relay_path("store_dir", Path(store_dir), directory=True)
+
+    @property
+    def published_file(self) -> Union[Path, None]:
+        """File the hashes of published blocks are remembered in across
+        restarts. Defaults to published.bin in the store_dir, if set."""
+        published_file = self._get(
+            "published_file", "BLOCKPERF_PUBLISHED_FILE", fallback=""
+        )
+        if published_file:
+            return self._relay_path("published_file", Path(published_file))
+        if self.store_dir:
+            return self.store_dir.joinpath("published.bin")
+        return None
+
+    @property
+    def store_retention_days(self) -> int:
+        store_retention_days = os.getenv(
+            "BLOCKPERF_STORE_RETENTION_DAYS",
+            self.config_parser.get(SHARED_SECTION, "store_retention_days", fallback=30),
+        )
+        return int(store_retention_days)
+
+    @property
+    def mempool_metrics(self) -> bool:
+        """Export the counts of the mempool traces as metrics"""
+        mempool_metrics = os.getenv(
+            "BLOCKPERF_MEMPOOL_METRICS",
+            self.config_parser.get(SHARED_SECTION, "mempool_metrics", fallback="false"),
+        )
+        return mempool_metrics.lower() in ("1", "true", "yes", "on")
+
+    @property
+    def fetch_counts(self) -> bool:
+        """Add the header fan-in and redundant fetches of the block to the
+        published sample, see FetchCounts"""
+        fetch_counts = os.getenv(
+            "BLOCKPERF_FETCH_COUNTS",
+            self.config_parser.get(SHARED_SECTION, "fetch_counts", fallback="false"),
+        )
+        return fetch_counts.lower() in ("1", "true", "yes", "on")
+
+    @property
+    def publish_mode(self) -> str:
+        """Publish every "samples" (default), only a "summary" per window
+        or "both", see blockperf.summary"""
+        publish_mode = self._get(
+            "publish_mode", "BLOCKPERF_PUBLISH_MODE", fallback="samples"
+        )
+        if publish_mode not in ("samples", "summary", "both"):
+            raise ConfigError(
+                f"Unknown publish mode {publish_mode}, use samples, summary or both"
+            )
+        return publish_mode
+
+    @property
+    def summary_window(self) -> str:
+        """Length of the summary windows in seconds, or "epoch" """
+        summary_window = self._get(
+            "summary_window", "BLOCKPERF_SUMMARY_WINDOW", fallback="60"
+        )
+        if summary_window != "epoch" and not (
+            summary_window.isdigit() and int(summary_window) > 0
+        ):
+            raise ConfigError(
+                f"Invalid summary window {summary_window}, use seconds or epoch"
+            )
+        return summary_window
+
+    @property
+    def capture_dir(self) -> Union[Path, None]:
+        """Directory the block events are captured to, disabled if not set"""
+        capture_dir = self._get("capture_dir", "BLOCKPERF_CAPTURE_DIR", fallback="")
+        if not capture_dir:
+            return None
+        return self._relay_path("capture_dir", Path(capture_dir), directory=True)
 
     @property
-    def max_concurrent_blocks(self) -> float:
-        return self.active_slot_coef * 3600
+    def capture_retention_days(self) -> int:
+        capture_retention_days = os.getenv(
+            "BLOCKPERF_CAPTURE_RETENTION_DAYS",
+            self.config_parser.get(
+                SHARED_SECTION, "capture_retention_days", fallback=30
+            ),
+        )
+        return int(capture_retention_days)
+
+    @property
+    def memory_budget(self) -> int:
+        """Approximate memory (in MiB) blockperf may hold, 0 for unlimited"""
+        memory_budget = os.getenv(
+            "BLOCKPERF_MEMORY_BUDGET",
+            self.config_parser.get(SHARED_SECTION, "memory_budget", fallback=0),
+        )
+        return int(memory_budget) * 1024 * 1024
+
+    @property
+    def watchdog_read_timeout(self) -> int:
+        """Seconds reading the source may hang (with or without new lines)
+        before it is stalled, 0 to not watch it. See blockperf.watchdog"""
+        return int(
+            os.getenv(
+                "BLOCKPERF_WATCHDOG_READ_TIMEOUT",
+                self.config_parser.get(
+                    SHARED_SECTION, "watchdog_read_timeout", fallback=300
+                ),
+            )
+        )
+
+    @property
+    def watchdog_sample_timeout(self) -> int:
+        """Seconds since the slot of the last sample after which sampling is
+        stalled, 0 to not watch it."""
+        return int(
+            os.getenv(
+                "BLOCKPERF_WATCHDOG_SAMPLE_TIMEOUT",
+                self.config_parser.get(
+                    SHARED_SECTION, "watchdog_sample_timeout", fallback=900
+                ),
+            )
+        )
+
+    @property
+    def watchdog_sink_timeout(self) -> int:
+        """Seconds a sink may take to publish a sample, 0 to not watch them"""
+        return int(
+            os.getenv(
+                "BLOCKPERF_WATCHDOG_SINK_TIMEOUT",
+                self.config_parser.get(
+                    SHARED_SECTION, "watchdog_sink_timeout", fallback=300
+                ),
+            )
+        )
+
+    @property
+    def tracemalloc(self) -> bool:
+        """Trace allocations from the start, not just after the first SIGUSR1"""
+        tracemalloc = os.getenv(
+            "BLOCKPERF_TRACEMALLOC",
+            self.config_parser.get(SHARED_SECTION, "tracemalloc", fallback="false"),
+        )
+        return tracemalloc.lower() in ("1", "true", "yes", "on")
+
+    @property
+    def runtime(self) -> str:
+        """Either "threads" (default) or "asyncio" to run on a single event loop"""
+        runtime = os.getenv(
+            "BLOCKPERF_RUNTIME",
+            self.config_parser.get(SHARED_SECTION, "runtime", fallback="threads"),
+        )
+        if runtime not in ("threads", "asyncio"):
+            raise ConfigError(f"Unknown runtime {runtime}, use threads or asyncio")
+        return runtime
+
+    @property
+    def parse_worker(self) -> bool:
+        """Tail and parse the logfile in a separate process"""
+        parse_worker = os.getenv(
+            "BLOCKPERF_PARSE_WORKER",
+            self.config_parser.get(SHARED_SECTION, "parse_worker", fallback="false"),
+        )
+        return parse_worker.lower() in ("1", "true", "yes", "on")
+
+    @property
+    def sinks(self) -> list:
+        """The sinks samples are published to, see blockperf.sinks"""
+        sinks = os.getenv(
+            "BLOCKPERF_SINKS",
+            self.config_parser.get(SHARED_SECTION, "sinks", fallback="mqtt"),
+        )
+        _sinks = [sink.strip() for sink in sinks.split(",") if sink.strip()]
+        for sink in _sinks:
+            if sink not in SINKS:
+                raise ConfigError(f"Unknown sink {sink}, use {', '.join(SINKS)}")
+        return _sinks
+
+    @property
+    def sink_file(self) -> Union[Path, None]:
+        """File the file sink appends the samples to"""
+        sink_file = os.getenv(
+            "BLOCKPERF_SINK_FILE",
+            self.config_parser.get(SHARED_SECTION, "sink_file", fallback=""),
+        )
+        if not sink_file:
+            return None
+        return Path(sink_file)
+
+    @property
+    def sink_url(self) -> str:
+        """Url the http sink posts the samples to"""
+        return os.getenv(
+            "BLOCKPERF_SINK_URL",
+            self.config_parser.get(SHARED_SECTION, "sink_url", fallback=""),
+        )
 
     @property
     def masked_addresses(self) -> list:
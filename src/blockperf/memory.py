@@ -0,0 +1,132 @@
+"""
+Approximate accounting of the memory blockperf holds and heap introspection.
+
+Python can not tell the size of an object graph cheaply, so the memory is
+estimated from the number of objects held times their typical size.
+EVENT_MEMORY is an upper bound of what tracemalloc reports for a parsed
+LogEvent, tests/test_memory.py checks it still is. PAYLOAD_MEMORY is a rough
+guess for the few dozen short fields of a sample.
+
+Every relay gets its own share of the budget for its events, what is left
+after the fixed allocations (e.g. the ring of the parse worker) split evenly.
+A relay only ever evicts its own blocks for exceeding its own share.
+
+Sending SIGUSR1 to blockperf starts tracemalloc, every further SIGUSR1 logs
+the top allocations since then. Tracing costs cpu and memory itself, so it
+is not enabled unless asked for (or BLOCKPERF_TRACEMALLOC is set).
+"""
+
+import logging
+import signal
+import tracemalloc
+from typing import Callable, Union
+
+logger = logging.getLogger(__name__)
+
+# Approximate bytes held by a single LogEvent, with its json data
+EVENT_MEMORY = 2500
+# Approximate bytes of a sample waiting to be published
+PAYLOAD_MEMORY = 1000
+# Number of allocation sites logged
+TRACEMALLOC_TOP = 20
+# Frames stored per allocation, more tell more but cost more
+TRACEMALLOC_FRAMES = 1
+
+
+class MemoryBudget:
+    """The memory held by all buffers of the process.
+
+    Every buffer registers a callable that returns its (approximate) size.
+    Fixed accounts can never be freed. Whoever can free memory registers a
+    share, checks exceeded() with its name and degrades if it is. A limit
+    of 0 means there is no limit.
+    """
+
+    limit: int
+    accounts: dict
+    fixed: set
+    shares: set
+
+    def __init__(self, limit: int = 0) -> None:
+        self.limit = limit
+        self.accounts = {}
+        self.fixed = set()
+        self.shares = set()
+
+    def account(self, name: str, size_of: Callable[[], int], fixed=False) -> None:
+        self.accounts[name] = size_of
+        if fixed:
+            self.fixed.add(name)
+            if self.limit and self.fixed_used() >= self.limit:
+                logger.warning(
+                    "Memory budget of %s bytes is below the fixed usage of %s "
+                    "bytes, it is ignored",
+                    self.limit,
+                    self.fixed_used(),
+                )
+
+    def share(self, name: str, size_of: Callable[[], int]) -> None:
+        """Accounts memory that is freed by its owner to stay in its share"""
+        self.accounts[name] = size_of
+        self.shares.add(name)
+
+    def usage(self) -> dict:
+        return {name: size_of() for name, size_of in self.accounts.items()}
+
+    def used(self) -> int:
+        return sum(self.usage().values())
+
+    def fixed_used(self) -> int:
+        return sum(self.accounts[name]() for name in self.fixed)
+
+    def share_limit(self) -> int:
+        """The bytes every share may use, 0 if there is no limit (or
+        nothing left after the fixed accounts)"""
+        if not self.limit or not self.shares:
+            return 0
+        return max(0, self.limit - self.fixed_used()) // len(self.shares)
+
+    def exceeded(self, name: Union[str, None] = None) -> bool:
+        """Whether the share name (or the whole process) uses more than
+        it may"""
+        if name is None:
+            return bool(self.limit) and self.used() > self.limit
+        share_limit = self.share_limit()
+        return bool(share_limit) and self.accounts[name]() > share_limit
+
+
+# The budget of this process, shared by all relays
+budget = MemoryBudget()
+
+
+def tracemalloc_top(limit: int = TRACEMALLOC_TOP) -> str:
+    """Returns the top allocation sites since tracemalloc was started"""
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+    )
+    stats = snapshot.statistics("lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced {current / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB)"]
+    for stat in stats[:limit]:
+        lines.append(str(stat))
+    return "\n".join(lines)
+
+
+def handle_sigusr1(signum, frame) -> None:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        logger.info("Started tracemalloc, send SIGUSR1 again for a snapshot")
+        return
+    usage = ", ".join(f"{name}: {size}" for name, size in budget.usage().items())
+    logger.info("Accounted memory %s (%s)", budget.used(), usage)
+    logger.info("Top allocations\n%s", tracemalloc_top())
+
+
+def install_signal_handler(start_tracing: bool = False) -> None:
+    """Installs handle_sigusr1(), must be called from the main thread"""
+    if start_tracing and not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    signal.signal(signal.SIGUSR1, handle_sigusr1)
@@ -0,0 +1,70 @@
+"""
+Counting of the nodes mempool traces.
+
+The mempool traces (a tx was added, rejected, txs were removed) are by far
+the most frequent lines the node logs, but none of them is needed for a
+sample. Instead of decoding their json they are recognized by a plain
+substring test and counted right away, the only fields taken from them
+(the size of the mempool and the number of txs removed) are picked out of
+the raw line with precompiled regular expressions.
+
+The counts are cumulative, the throughput per second is what prometheus'
+rate() makes of them.
+"""
+
+import re
+
+# Any mempool line has this in its kind (legacy) or namespace (new format)
+MEMPOOL = "Mempool"
+ADDED = ('"TraceMempoolAddedTx"', '"Mempool.AddedTx"')
+REJECTED = ('"TraceMempoolRejectedTx"', '"Mempool.RejectedTx"')
+REMOVED = ('"TraceMempoolRemoveTxs"', '"Mempool.RemoveTxs"')
+MEMPOOL_SIZE = re.compile(r'"mempoolSize":\{([^}]*)\}')
+NUM_TXS = re.compile(r'"numTxs":(\d+)')
+BYTES = re.compile(r'"bytes":(\d+)')
+# Every removed tx is logged with its txid
+TXID = '"txid"'
+
+
+def _is(line: str, kinds: tuple) -> bool:
+    return kinds[0] in line or kinds[1] in line
+
+
+class MempoolCounter:
+    """Cumulative counts of the txs added, rejected and removed and the
+    latest size of the mempool."""
+
+    __slots__ = ("added", "rejected", "removed", "txs", "bytes")
+
+    def __init__(self) -> None:
+        self.added = 0
+        self.rejected = 0
+        self.removed = 0
+        self.txs = 0
+        self.bytes = 0
+
+    def totals(self) -> tuple:
+        return (self.added, self.rejected, self.removed, self.txs, self.bytes)
+
+    def count(self, line: str) -> bool:
+        """Counts the line if it is a mempool trace, returns whether it was"""
+        if MEMPOOL not in line:
+            return False
+        if _is(line, ADDED):
+            self.added += 1
+        elif _is(line, REJECTED):
+            self.rejected += 1
+        elif _is(line, REMOVED):
+            self.removed += line.count(TXID)
+        else:
+            return False
+        if size := MEMPOOL_SIZE.search(line):
+            if num_txs := NUM_TXS.search(size.group(1)):
+                self.txs = int(num_txs.group(1))
+            if _bytes := BYTES.search(size.group(1)):
+                self.bytes = int(_bytes.group(1))
+        return True
+
+    def filter(self, lines: list) -> list:
+        """Counts the mempool traces in lines, returns all other lines"""
+        return [line for line in lines if not self.count(line)]
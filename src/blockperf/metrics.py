@@ -1,66 +1,315 @@
 import logging
 import os
+import threading
+from typing import TYPE_CHECKING
 
-from prometheus_client import Counter, Gauge, start_http_server
+if TYPE_CHECKING:
+    from prometheus_client import Counter, Gauge
 
 logger = logging.getLogger(__name__)
 
+# quantiles of the block response delta exported per peer
+PEER_QUANTILES = (0.5, 0.9)
+
 
 class Metrics:
+    """Prometheus metrics of a single relay.
+
+    The prometheus metrics and the http server are shared by all relays, they
+    are set up once on the class by the first instance. Each instance sets
+    its values with its own relay label. The http server is started with
+    serve() by whoever runs the apps.
+    """
+
     enabled: bool = False
-    header_delta: Gauge = None
-    block_request_delta: Gauge = None
-    block_response_delta: Gauge = None
-    block_adopt_delta: Gauge = None
-    block_delay: Gauge = None
-    block_no: Gauge = None
-    valid_samples: Counter = None
-    invalid_samples: Counter = None
-
-    def __init__(self):
+    port: int = 0
+    serving: bool = False
+    relay: str = ""
+    header_delta: "Gauge" = None
+    block_request_delta: "Gauge" = None
+    block_response_delta: "Gauge" = None
+    block_adopt_delta: "Gauge" = None
+    block_adopt_delta_by_snapshot: "Gauge" = None
+    block_validate_delta: "Gauge" = None
+    block_select_delta: "Gauge" = None
+    snapshot_samples: "Counter" = None
+    block_delay: "Gauge" = None
+    stage_delta: "Gauge" = None
+    block_no: "Gauge" = None
+    valid_samples: "Counter" = None
+    invalid_samples: "Counter" = None
+    published_suppressed: "Counter" = None
+    inflight_blocks: "Gauge" = None
+    evicted_incomplete: "Counter" = None
+    memory_accounted: "Gauge" = None
+    dropped_headers: "Counter" = None
+    redundant_fetches: "Counter" = None
+    wasted_bytes: "Counter" = None
+    header_fan_in: "Gauge" = None
+    mempool_added_txs: "Counter" = None
+    mempool_rejected_txs: "Counter" = None
+    mempool_removed_txs: "Counter" = None
+    mempool_txs: "Gauge" = None
+    mempool_bytes: "Gauge" = None
+    sink_dropped: "Counter" = None
+    sink_queued: "Gauge" = None
+    broker_connect_seconds: "Gauge" = None
+    broker_reconnect_seconds: "Gauge" = None
+    broker_reconnects: "Counter" = None
+    broker_tls_resumed: "Counter" = None
+    stalled: "Gauge" = None
+    peer_first_header_ratio: "Gauge" = None
+    peer_header_lag: "Gauge" = None
+    peer_block_response_delta: "Gauge" = None
+    peer_deltaq_g: "Gauge" = None
+    # peers that currently have a label set in the peer metrics
+    exported_peers: set = set()
+    _setup_lock = threading.Lock()
+
+    def __init__(self, relay: str = ""):
         port = os.getenv("BLOCKPERF_METRICS_PORT", None)
         # If not given or not a number, dont setup anything
         if not port or not port.isdigit():
             return
-        port = int(port)
         self.enabled = True
-        self.header_delta = Gauge(
+        self.relay = relay
+        self.exported_peers = set()
+        with Metrics._setup_lock:
+            if Metrics.header_delta is None:
+                Metrics._setup(int(port))
+
+    @classmethod
+    def _setup(cls, port: int):
+        """Creates all prometheus metrics"""
+        # Only import prometheus_client if metrics are actually enabled
+        from prometheus_client import Counter, Gauge
+
+        cls.port = port
+        cls.header_delta = Gauge(
             "blockperf_header_delta",
             "time from when a block was forged until received (ms)",
+            ["relay"],
         )
-        self.block_request_delta = Gauge(
+        cls.block_request_delta = Gauge(
             "blockperf_block_req_delta",
             "time between the header was received until the block request was sent (ms)",
+            ["relay"],
         )
-        self.block_response_delta = Gauge(
+        cls.block_response_delta = Gauge(
             "blockperf_block_rsp_delta",
             "time between the block request was sent until the block responce was received (ms)",
+            ["relay"],
+        )
+        cls.block_adopt_delta = Gauge(
+            "blockperf_block_adopt_delta", "time for adopting the block (ms)", ["relay"]
+        )
+        cls.block_validate_delta = Gauge(
+            "blockperf_block_validate_delta",
+            "time from receiving the block until chain selection validated it (ms)",
+            ["relay"],
+        )
+        cls.block_select_delta = Gauge(
+            "blockperf_block_select_delta",
+            "time from validating the block until the node switched to it (ms)",
+            ["relay"],
+        )
+        cls.block_adopt_delta_by_snapshot = Gauge(
+            "blockperf_block_adopt_delta_by_snapshot",
+            "time for adopting the block (ms), by whether a ledger snapshot was taken meanwhile",
+            ["relay", "snapshot"],
+        )
+        cls.snapshot_samples = Counter(
+            "blockperf_snapshot_samples",
+            "samples whose block was adopted while a ledger snapshot was taken",
+            ["relay"],
+        )
+        cls.stage_delta = Gauge(
+            "blockperf_stage_delta",
+            "delta of a stage (header, request, response) the moment it completed for a block, adopted or not (ms)",
+            ["relay", "stage"],
+        )
+        cls.block_delay = Gauge(
+            "blockperf_block_delay", "Total block delay (ms)", ["relay"]
+        )
+        cls.block_no = Gauge(
+            "blockperf_block_no", "Block number of latest sample", ["relay"]
+        )
+        cls.valid_samples = Counter(
+            "blockperf_valid_samples", "valid samples collected", ["relay"]
+        )
+        cls.invalid_samples = Counter(
+            "blockperf_invalid_samples", "invalid samples discarded", ["relay"]
+        )
+        cls.published_suppressed = Counter(
+            "blockperf_published_suppressed",
+            "complete samples not published, because the published filter had them",
+            ["relay"],
+        )
+        cls.inflight_blocks = Gauge(
+            "blockperf_inflight_blocks",
+            "blocks events are currently held for",
+            ["relay"],
+        )
+        cls.evicted_incomplete = Counter(
+            "blockperf_evicted_incomplete",
+            "blocks evicted before a sample could be created",
+            ["relay"],
+        )
+        cls.memory_accounted = Gauge(
+            "blockperf_memory_accounted_bytes",
+            "approximate memory held by the events of inflight blocks",
+            ["relay"],
+        )
+        cls.dropped_headers = Counter(
+            "blockperf_dropped_headers",
+            "redundant headers dropped to stay within the memory budget",
+            ["relay"],
+        )
+        cls.redundant_fetches = Counter(
+            "blockperf_redundant_fetches",
+            "blocks downloaded again after they were downloaded from another peer",
+            ["relay"],
         )
-        self.block_adopt_delta = Gauge(
-            "blockperf_block_adopt_delta", "time for adopting the block (ms)"
+        cls.wasted_bytes = Counter(
+            "blockperf_wasted_bytes",
+            "bytes of the blocks downloaded redundantly",
+            ["relay"],
         )
-        self.block_delay = Gauge("blockperf_block_delay", "Total block delay (ms)")
-        self.block_no = Gauge("blockperf_block_no", "Block number of latest sample")
-        self.valid_samples = Counter(
-            "blockperf_valid_samples", "valid samples collected"
+        cls.header_fan_in = Gauge(
+            "blockperf_header_fan_in",
+            "peers that announced the header of the latest sample until it was adopted",
+            ["relay"],
         )
-        self.invalid_samples = Counter(
-            "blockperf_invalid_samples", "invalid samples discarded"
+        cls.mempool_added_txs = Counter(
+            "blockperf_mempool_added_txs", "txs added to the mempool", ["relay"]
         )
-        start_http_server(port)
+        cls.mempool_rejected_txs = Counter(
+            "blockperf_mempool_rejected_txs", "txs rejected by the mempool", ["relay"]
+        )
+        cls.mempool_removed_txs = Counter(
+            "blockperf_mempool_removed_txs", "txs removed from the mempool", ["relay"]
+        )
+        cls.mempool_txs = Gauge(
+            "blockperf_mempool_txs", "txs currently in the mempool", ["relay"]
+        )
+        cls.mempool_bytes = Gauge(
+            "blockperf_mempool_bytes", "size of the txs in the mempool", ["relay"]
+        )
+        # The sinks are shared by all relays, their metrics are labeled with
+        # the sinks name instead. A sink creates its Metrics with its name.
+        cls.sink_dropped = Counter(
+            "blockperf_sink_dropped",
+            "samples dropped by a sink, because its queue was full or writing failed",
+            ["sink"],
+        )
+        cls.sink_queued = Gauge(
+            "blockperf_sink_queued",
+            "samples waiting in the queue of a sink",
+            ["sink"],
+        )
+        cls.broker_connect_seconds = Gauge(
+            "blockperf_broker_connect_seconds",
+            "duration of the last successful connect to the broker (tcp and tls)",
+            ["sink"],
+        )
+        cls.broker_reconnect_seconds = Gauge(
+            "blockperf_broker_reconnect_seconds",
+            "how long the connection to the broker was down the last time",
+            ["sink"],
+        )
+        cls.broker_reconnects = Counter(
+            "blockperf_broker_reconnects",
+            "connections to the broker established again after losing it",
+            ["sink"],
+        )
+        cls.broker_tls_resumed = Counter(
+            "blockperf_broker_tls_resumed",
+            "connections to the broker that resumed the previous tls session",
+            ["sink"],
+        )
+        # The stages of the watchdog are labeled with their name
+        cls.stalled = Gauge(
+            "blockperf_stalled",
+            "1 if the stage of the pipeline stalled, see blockperf.watchdog",
+            ["stage"],
+        )
+        cls.peer_first_header_ratio = Gauge(
+            "blockperf_peer_first_header_ratio",
+            "share of headers this peer announced first",
+            ["relay", "peer"],
+        )
+        cls.peer_header_lag = Gauge(
+            "blockperf_peer_header_lag",
+            "average header lag of this peer versus the fastest peer (ms)",
+            ["relay", "peer"],
+        )
+        cls.peer_block_response_delta = Gauge(
+            "blockperf_peer_block_rsp_delta",
+            "recent block response delta quantiles of this peer (ms)",
+            ["relay", "peer", "quantile"],
+        )
+        cls.peer_deltaq_g = Gauge(
+            "blockperf_peer_deltaq_g",
+            "latest deltaq G of this peer",
+            ["relay", "peer"],
+        )
+
+    @classmethod
+    def serve(cls):
+        """Starts prometheus http server (in its own thread), if enabled."""
+        with cls._setup_lock:
+            if not cls.port or cls.serving:
+                return
+            from prometheus_client import start_http_server
+
+            start_http_server(cls.port)
+            cls.serving = True
 
-    def set(self, metric, value):
-        """Calls set() on given metric with given value"""
+    def set(self, metric, value, *labels):
+        """Calls set() on given metric with given value, labels are the
+        values of the metrics labels after relay (if it has any)"""
         if not self.enabled:
             return
-        logger.info("set %s to %s", metric, value)
+        logger.debug("set %s to %s", metric, value)
         prom_metric = getattr(self, metric)
-        prom_metric.set(value)
+        prom_metric.labels(self.relay, *labels).set(value)
 
-    def inc(self, metric):
+    def inc(self, metric, amount=1, *labels):
         """Calls inc() on given metric"""
         if not self.enabled:
             return
-        logger.info("inc %s", metric)
+        logger.debug("inc %s", metric)
         prom_metric = getattr(self, metric)
-        prom_metric.inc()
+        prom_metric.labels(self.relay, *labels).inc(amount)
+
+    def set_peers(self, peer_stats: list):
+        """Exports the given PeerStat instances as labeled metrics.
+
+        Only the given peers have a label, the labels of all peers exported
+        previously but not given now are removed. That keeps the number of
+        timeseries bound by the length of peer_stats.
+        """
+        if not self.enabled:
+            return
+        relay = self.relay
+        peers = set()
+        for peer_stat in peer_stats:
+            peer = peer_stat.peer
+            peers.add(peer)
+            self.peer_first_header_ratio.labels(relay, peer).set(
+                peer_stat.first_header_ratio
+            )
+            self.peer_header_lag.labels(relay, peer).set(peer_stat.header_lag)
+            for quantile in PEER_QUANTILES:
+                self.peer_block_response_delta.labels(relay, peer, str(quantile)).set(
+                    peer_stat.response_delta_quantile(quantile)
+                )
+            self.peer_deltaq_g.labels(relay, peer).set(peer_stat.deltaq_g)
+
+        for peer in self.exported_peers - peers:
+            self.peer_first_header_ratio.remove(relay, peer)
+            self.peer_header_lag.remove(relay, peer)
+            for quantile in PEER_QUANTILES:
+                self.peer_block_response_delta.remove(relay, peer, str(quantile))
+            self.peer_deltaq_g.remove(relay, peer)
+        self.exported_peers = peers
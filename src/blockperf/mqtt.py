@@ -1,9 +1,24 @@
 """MQTT Client
+
+Connecting is done in the background, reading the logs goes on meanwhile
+and the samples queue up in the mqtt sink until the client is connected.
+Failed connects and lost connections are retried with an exponential back
+off with full jitter (see Backoff), so many relays do not all hammer the
+broker at the same time after it was down.
+
+Every handshake needs the client certificate to be verified, the TLS
+session of the previous connection is therefore resumed on reconnect if
+the broker allows it (see ResumingContext).
 """
 
 import json
 import logging
+import random
+import ssl
 import sys
+import threading
+import time
+from typing import Union
 
 from paho.mqtt.client import MQTTMessageInfo
 from paho.mqtt.properties import Properties as Properties
@@ -18,15 +33,61 @@ except ImportError:
         "https://pypi.org/project/paho-mqtt/\n\n"
     )
 
+from blockperf.metrics import Metrics
+
 PUBLISH_TIMEOUT = 30  # publish timeout in seconds
 MESSAGE_EXPIRY_INTERVAL = 3600
+# Bounds of the delay (seconds) between connection attempts
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 120
 
 logger = logging.getLogger(__name__)
 
 
+class Backoff:
+    """Exponential back off with full jitter: the n-th delay is a random
+    value between min_delay and min_delay * 2**n (but at most max_delay)."""
+
+    def __init__(
+        self,
+        min_delay: float = RECONNECT_MIN_DELAY,
+        max_delay: float = RECONNECT_MAX_DELAY,
+    ) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempts = 0
+
+    def next(self) -> float:
+        """The delay before the next attempt"""
+        ceiling = min(self.max_delay, self.min_delay * 2**self.attempts)
+        self.attempts += 1
+        return random.uniform(self.min_delay, ceiling)
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+class ResumingContext(ssl.SSLContext):
+    """SSLContext that resumes the session of the last connection. Paho
+    wraps every new socket with the context, session is set once connected.
+    A broker that does not resume it just does a full handshake."""
+
+    session: Union[ssl.SSLSession, None] = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None:
+            kwargs.setdefault("session", self.session)
+        return super().wrap_socket(sock, *args, **kwargs)
+
+
 class MQTTClient(mqtt.Client):
     """MQTT Client"""
 
+    # When the current connection attempt started and the connection was
+    # lost (time.monotonic())
+    connect_started: float = 0.0
+    disconnected_at: float = 0.0
+
     def __init__(
         self,
         ca_certfile: str,
@@ -35,19 +96,81 @@ class MQTTClient(mqtt.Client):
         host: str,
         port: int,
         keepalive: int,
+        loop_start: bool = True,
     ) -> None:
+        """Creates the client and starts connecting in its network thread.
+        Pass loop_start=False to drive the network loop from elsewhere, the
+        caller then needs to connect() itself."""
         super().__init__(protocol=mqtt.MQTTv5)
-        self.tls_set(
-            ca_certs=ca_certfile,
-            certfile=client_certfile,
-            keyfile=client_keyfile,
-        )
-        logger.info("Connecting to %s:%s", host, port)
-        self.connect(host=host, port=port, keepalive=keepalive)
-        self.loop_start()
+        # Verifies the broker (and its hostname) as tls_set() would
+        self.tls_context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        if ca_certfile:
+            self.tls_context.load_verify_locations(cafile=ca_certfile)
+        else:
+            self.tls_context.load_default_certs()
+        self.tls_context.load_cert_chain(client_certfile, client_keyfile)
+        self.tls_set_context(self.tls_context)
+        self.connected = threading.Event()
+        self.broker = (host, port, keepalive)
+        self.backoff = Backoff()
+        self.metrics = Metrics("mqtt")
+        if not loop_start:
+            return
+        # Connecting (dns, tcp and tls handshake) is done in the network
+        # thread, so the caller can go on with reading the logs meanwhile
+        threading.Thread(target=self.network_loop, name="mqtt", daemon=True).start()
+
+    def reconnect(self):
+        """Every connection attempt (also the first) ends up here"""
+        self.connect_started = time.monotonic()
+        return super().reconnect()
+
+    def network_loop(self) -> None:
+        """Connects and runs paho's network loop, reconnecting with the
+        jittered back off whenever the connection fails or is lost. Runs
+        in its own thread, instead of loop_start() whose reconnects wait
+        without jitter.
+
+        Only this thread writes to the socket: paho writes a publish() right
+        away in the callers (sink) thread, unless its network loop runs in
+        loop_start()'s thread or an external loop registered for writes.
+        With the callback registered it queues the packet and wakes loop()
+        instead, which then writes it from here."""
+        self.on_socket_register_write = self.on_socket_writable
+        host, port, keepalive = self.broker
+        while True:
+            logger.info("Connecting to %s:%s", host, port)
+            try:
+                self.connect(host, port, keepalive)
+            except OSError as exc:
+                logger.warning("Connecting to broker failed: %s", exc)
+            else:
+                while self.loop(timeout=1.0) == mqtt.MQTT_ERR_SUCCESS:
+                    pass
+            # on_connect() resets the backoff, the first retry is quick
+            time.sleep(self.backoff.next())
+
+    def on_socket_writable(self, client, userdata, sock) -> None:
+        """Packets are waiting to be written, loop() selects the socket for
+        writing anyway, nothing to do"""
 
     def on_connect(self, client, userdata, flags, reasonCode, properties):
         logger.info("Connected: %s ", str(reasonCode))
+        if reasonCode == 0:
+            now = time.monotonic()
+            self.backoff.reset()
+            self.metrics.set("broker_connect_seconds", now - self.connect_started)
+            if self.disconnected_at:
+                self.metrics.set("broker_reconnect_seconds", now - self.disconnected_at)
+                self.metrics.inc("broker_reconnects")
+                self.disconnected_at = 0.0
+            sock = self.socket()
+            if isinstance(sock, ssl.SSLSocket):
+                if sock.session_reused:
+                    logger.info("Resumed TLS session")
+                    self.metrics.inc("broker_tls_resumed")
+                self.tls_context.session = sock.session
+            self.connected.set()
 
     def on_connect_fail(self, client, obj):
         logger.warning("Connection Failed")
@@ -55,6 +178,9 @@ class MQTTClient(mqtt.Client):
     def on_disconnect(self, client, userdata, reasonCode, properties) -> None:  # type: ignore
         """Called when disconnected from broker
         See paho.mqtt.client.py on_disconnect()"""
+        if self.connected.is_set():
+            self.disconnected_at = time.monotonic()
+        self.connected.clear()
         logger.warning("Connection disconnected %s", reasonCode)
 
     def on_publish(self, client, userdata, mid) -> None:  # type: ignore
@@ -76,25 +202,38 @@ class MQTTClient(mqtt.Client):
         """
         logger.debug("%s - %s", level, buf)
 
-    def publish(self, topic: str, payload: dict):  # type: ignore
-        """
+    def publish(self, topic: str, payload: dict) -> bool:  # type: ignore
+        """Publishes payload to topic, waiting for the broker.
+
+        Returns whether the message was published. It is lost if not, e.g.
+        when the connection dropped in the middle of a batch (messages are
+        published with qos 0, never resent).
 
         MQTTClient publish:
         publish(self, topic: str, payload: _Payload | None = None, qos: int = 0, retain: bool = False, properties: Properties | None = None) -> MQTTMessageInfo:
         """
+        if not self.connected.wait(PUBLISH_TIMEOUT):
+            logger.warning("Not connected to broker, publishing %s anyway", topic)
         try:
-            json_payload = json.dumps(payload)
-            publish_properties = Properties(PacketTypes.PUBLISH)
-            publish_properties.MessageExpiryInterval = MESSAGE_EXPIRY_INTERVAL
-            logger.info("Publishing sample to %s", topic)
-            # call the actuall clients publish method and receive the message_info
-            message_info: MQTTMessageInfo = super().publish(
-                topic=topic, payload=json_payload, properties=publish_properties
-            )
+            message_info = self.publish_nowait(topic, payload)
             # The message_info might not yet have been published,
             # wait_for_publish() blocks until TIMEOUT for that message to be published
             message_info.wait_for_publish(PUBLISH_TIMEOUT)
+            return message_info.is_published()
         except ValueError as exc:
             logger.exception(exc, exc_info=True)
         except RuntimeError as exc:
             logger.exception(exc, exc_info=True)
+        return False
+
+    def publish_nowait(self, topic: str, payload: dict) -> MQTTMessageInfo:
+        """Hands the payload to paho and returns without waiting for it to be
+        actually send to the broker."""
+        json_payload = json.dumps(payload)
+        publish_properties = Properties(PacketTypes.PUBLISH)
+        publish_properties.MessageExpiryInterval = MESSAGE_EXPIRY_INTERVAL
+        logger.info("Publishing sample to %s", topic)
+        # call the actuall clients publish method and receive the message_info
+        return super().publish(
+            topic=topic, payload=json_payload, properties=publish_properties
+        )
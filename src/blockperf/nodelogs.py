@@ -1,4 +1,22 @@
 """
+Parsing of the lines the node logs.
+
+Nodes log in one of two formats. The legacy iohk-monitoring format has the
+kind of event in data.kind and the peer as data.peer.local/remote. Nodes
+using the new tracing system (trace-dispatcher, cardano-tracer) name the
+event by its namespace in ns and the peer by its connectionId, e.g.
+
+    {"at": "2024-03-14T10:06:55.123456789Z",
+     "ns": "BlockFetch.Client.CompletedBlockFetch",
+     "data": {"block": "...", "delay": 0.21, "kind": "CompletedBlockFetch",
+              "peer": {"connectionId": "10.0.0.1:3001 1.2.3.4:3001"},
+              "size": 870},
+     "sev": "Info", "thread": "42", "host": "relay1"}
+
+The format is detected from the first lines, see detect_format(). Lines of
+the new format are handled by an extractor for their namespace. It picks
+exactly the fields needed and creates the LogEvent from them with
+LogEvent.of(), only legacy lines are dug out of their nested data.
 """
 
 import json
@@ -10,6 +28,8 @@ from typing import Union
 
 logger = logging.getLogger(__name__)
 
+AT_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
+
 
 class LogEventKind(Enum):
     """All events from the log file are of a specific kind."""
@@ -87,6 +107,153 @@ class LogEventKind(Enum):
     UNKNOWN = "Unknown"
 
 
+# Looking up the kind by value, without iterating over all kinds every time
+KINDS = {kind.value: kind for kind in LogEventKind}
+
+
+class LogFormat(Enum):
+    """The formats the node may log in"""
+
+    LEGACY = "legacy"
+    TRACE_DISPATCHER = "trace-dispatcher"
+
+
+def detect_format(lines: list) -> Union[LogFormat, None]:
+    """Returns the format of the first line that tells, None if none does.
+    Both formats have ns, the legacy one as a list, the new one as string."""
+    for line in lines:
+        try:
+            json_data = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            continue
+        if not isinstance(json_data, dict):
+            continue
+        ns = json_data.get("ns")
+        if isinstance(ns, str):
+            return LogFormat.TRACE_DISPATCHER
+        if isinstance(json_data.get("data"), dict) and "kind" in json_data["data"]:
+            return LogFormat.LEGACY
+    return None
+
+
+def _at(at: str) -> str:
+    """The new tracing system logs nanoseconds, which strptime can not parse.
+    Returns at with microseconds (and always a fraction)."""
+    seconds, _, fraction = at.rstrip("Z").partition(".")
+    return f"{seconds}.{fraction[:6] or '0'}Z"
+
+
+def parse_at(at: str) -> datetime:
+    """Parses the at of a line in either format"""
+    try:
+        return datetime.strptime(at, AT_FORMAT)
+    except ValueError:
+        return datetime.strptime(_at(at), AT_FORMAT)
+
+
+def point_hash(point: Union[dict, str]) -> str:
+    """The hash of a point, which the node logs either as object with a hash
+    or rendered as string like "<hash>@<slot>" or "<hash> at slot <slot>"."""
+    if isinstance(point, dict):
+        return str(point.get("hash", ""))
+    return point.split("@")[0].split(" ")[0]
+
+
+def _peer(connection_id: str) -> tuple:
+    """The (local_addr, local_port, remote_addr, remote_port) of a
+    connectionId, which is the local and remote address separated by a
+    space, e.g. "10.0.0.1:3001 1.2.3.4:3001" or "[::1]:3001 [2001:db8::1]:3001"."""
+    local, _, remote = connection_id.partition(" ")
+    local_addr, _, local_port = local.rpartition(":")
+    remote_addr, _, remote_port = remote.rpartition(":")
+    return local_addr.strip("[]"), local_port, remote_addr.strip("[]"), remote_port
+
+
+def _block_no(block_no: Union[int, dict]) -> int:
+    """In prior version blockNo was a dict, that held and unBlockNo key
+    Since 8.x its only data.blockNo"""
+    if type(block_no) is dict:
+        # If its a dict, it must have unBlockNo key
+        if "unBlockNo" not in block_no:
+            raise ValueError("blockNo is a dict but does not have unBlockNo")
+        return block_no["unBlockNo"]
+    return block_no
+
+
+def _downloaded_header(at: datetime, data: dict) -> "LogEvent":
+    return LogEvent.of(
+        LogEventKind.TRACE_DOWNLOADED_HEADER,
+        data["block"],
+        at,
+        slot_num=data["slot"],
+        block_num=_block_no(data["blockNo"]),
+        peer=_peer(data["peer"]["connectionId"]),
+    )
+
+
+def _send_fetch_request(at: datetime, data: dict) -> "LogEvent":
+    return LogEvent.of(
+        LogEventKind.SEND_FETCH_REQUEST,
+        data["head"],
+        at,
+        deltaq_g=data.get("deltaq", {}).get("G", 0.0),
+        peer=_peer(data["peer"]["connectionId"]),
+    )
+
+
+def _completed_block_fetch(at: datetime, data: dict) -> "LogEvent":
+    return LogEvent.of(
+        LogEventKind.COMPLETED_BLOCK_FETCH,
+        data["block"],
+        at,
+        size=data["size"],
+        delay=data["delay"],
+        peer=_peer(data["peer"]["connectionId"]),
+    )
+
+
+def _valid_candidate(at: datetime, data: dict) -> "LogEvent":
+    return LogEvent.of(LogEventKind.ADD_BLOCK_VALIDATION, point_hash(data["block"]), at)
+
+
+def _try_switch_to_a_fork(at: datetime, data: dict) -> "LogEvent":
+    return LogEvent.of(LogEventKind.TRY_SWITCH_TO_A_FORK, point_hash(data["block"]), at)
+
+
+def _added_to_current_chain(at: datetime, data: dict) -> "LogEvent":
+    newtip = data["newtip"].split("@")[0]
+    return LogEvent.of(
+        LogEventKind.ADDED_TO_CURRENT_CHAIN,
+        newtip,
+        at,
+        newtip=newtip,
+        chain_length_delta=data.get("chainLengthDelta", 1),
+    )
+
+
+def _switched_to_a_fork(at: datetime, data: dict) -> "LogEvent":
+    newtip = data["newtip"].split("@")[0]
+    return LogEvent.of(
+        LogEventKind.SWITCHED_TO_A_FORK,
+        newtip,
+        at,
+        newtip=newtip,
+        chain_length_delta=data.get("chainLengthDelta", 0),
+    )
+
+
+# Namespace of the new tracing system -> extractor of the event
+TRACE_DISPATCHER_EXTRACTORS = {
+    "ChainSync.Client.DownloadedHeader": _downloaded_header,
+    "BlockFetch.Client.SendFetchRequest": _send_fetch_request,
+    "BlockFetch.Client.CompletedBlockFetch": _completed_block_fetch,
+    "ChainDB.AddBlockEvent.AddBlockValidation.ValidCandidate": _valid_candidate,
+    "ChainDB.AddBlockEvent.TrySwitchToAFork": _try_switch_to_a_fork,
+    "ChainDB.AddBlockEvent.AddedToCurrentChain": _added_to_current_chain,
+    "ChainDB.AddBlockEvent.SwitchedToAFork": _switched_to_a_fork,
+}
+
+
 class LogEvent:
     """A LogEvent represents a single line in the nodes log file.
 
@@ -105,6 +272,13 @@ class LogEvent:
     to determine the time it took from asking for a block until actually
     receiving it.
 
+    TrySwitchToAFork
+    Chain selection started to validate a fork that ends with the block.
+
+    ValidCandidate (AddBlockValidation)
+    Chain selection validated the candidate chain that ends with the block.
+    Anything after this is switching to that chain.
+
     AddedToCurrentChain
     The node has added a block to its chain.
 
@@ -113,36 +287,38 @@ class LogEvent:
     """
 
     at: datetime
-    atstr: str
+    kind: LogEventKind = LogEventKind.UNKNOWN
+    block_hash: str = ""
+    block_num: int = 0
+    size: int = 0
+    delay: float = 0.0
+    slot_num: int = 0
+    deltaq_g: float = 0.0
+    chain_length_delta: int = 0
+    newtip: str = ""
+    local_addr: str = ""
+    local_port: str = ""
+    remote_addr: str = ""
+    remote_port: str = ""
+    # The data of a legacy line, events built with of() do not have it
     data: dict
-    size: int
-    delay: float
-    slot_num: int
-    deltaq_g: float
-    chain_length_delta: int
-    newtip: str
-    local_addr: str
-    local_port: str
-    remote_addr: str
-    remote_port: str
 
     def __init__(self, event_data: dict) -> None:
         """Create a LogEvent with `from_logline` method by passing in the json string
-        as written to the nodes log."""
+        as written to the nodes log (in the legacy format)."""
 
         if _at := event_data.get("at", None):
-            self.at = datetime.strptime(_at, "%Y-%m-%dT%H:%M:%S.%f%z")
-
-        if hasattr(self, "at"):
-            self.atstr = self.at.strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
+            self.at = datetime.strptime(_at, AT_FORMAT)
 
         self.data = event_data.get("data", {})
         if not self.data:
             logger.error("%s has not data", self)
 
+        self.kind = KINDS.get(self.data.get("kind"), LogEventKind.UNKNOWN)
         self.size = self.data.get("size", 0)
         self.delay = self.data.get("delay", 0.0)
         self.slot_num = self.data.get("slot", 0)
+        self.block_num = _block_no(self.data.get("blockNo", 0))
         self.deltaq_g = self.data.get("deltaq", {}).get("G", 0.0)
         self.chain_length_delta = self.data.get("chainLengthDelta", 0)
 
@@ -150,6 +326,24 @@ class LogEvent:
         if self.newtip:
             self.newtip = self.newtip.split("@")[0]
 
+        if self.kind == LogEventKind.SEND_FETCH_REQUEST:
+            self.block_hash = str(self.data.get("head", ""))
+        elif self.kind in (
+            LogEventKind.COMPLETED_BLOCK_FETCH,
+            LogEventKind.TRACE_DOWNLOADED_HEADER,
+        ):
+            self.block_hash = str(self.data.get("block", ""))
+        elif self.kind in (
+            LogEventKind.ADDED_TO_CURRENT_CHAIN,
+            LogEventKind.SWITCHED_TO_A_FORK,
+        ):
+            self.block_hash = self.newtip
+        elif self.kind in (
+            LogEventKind.TRY_SWITCH_TO_A_FORK,
+            LogEventKind.ADD_BLOCK_VALIDATION,
+        ):
+            self.block_hash = point_hash(self.data.get("block", ""))
+
         if self.kind in (
             LogEventKind.TRACE_DOWNLOADED_HEADER,
             LogEventKind.SEND_FETCH_REQUEST,
@@ -164,13 +358,51 @@ class LogEvent:
                 self.data.get("peer", {}).get("remote", {}).get("port", "")
             )
 
+    @classmethod
+    def of(
+        cls,
+        kind: LogEventKind,
+        block_hash: str,
+        at: datetime,
+        slot_num: int = 0,
+        block_num: int = 0,
+        size: int = 0,
+        delay: float = 0.0,
+        deltaq_g: float = 0.0,
+        chain_length_delta: int = 0,
+        newtip: str = "",
+        peer: Union[tuple, None] = None,
+    ) -> "LogEvent":
+        """Creates a LogEvent from its fields, without any data to parse.
+        Used for the lines of the new tracing system and the records of the
+        parse worker. peer is (local_addr, local_port, remote_addr, remote_port)."""
+        event = cls.__new__(cls)
+        event.kind = kind
+        event.block_hash = block_hash
+        event.at = at
+        event.slot_num = slot_num
+        event.block_num = block_num
+        event.size = size
+        event.delay = delay
+        event.deltaq_g = deltaq_g
+        event.chain_length_delta = chain_length_delta
+        event.newtip = newtip
+        if peer:
+            (
+                event.local_addr,
+                event.local_port,
+                event.remote_addr,
+                event.remote_port,
+            ) = peer
+        return event
+
     def __repr__(self):
         _kind = self.kind.value
         if "." in _kind:
             _kind = f"{_kind.split('.')[1]}"
         _repr = f"LogEvent {_kind}"
 
-        if self.kind == LogEventKind.UNKNOWN:
+        if self.kind == LogEventKind.UNKNOWN and hasattr(self, "data"):
             _repr += f" {self.data.get('kind')}"
 
         if self.block_hash:
@@ -185,6 +417,7 @@ class LogEvent:
         logline: str,
         masked_addresses: list = [],
         bad_before: Union[int, None] = None,
+        log_format: LogFormat = LogFormat.LEGACY,
     ) -> Union["LogEvent", None]:
         """Takes a single line from the logs and creates a LogEvent.
         Will return None if the LogEvent could not be created due to various reason.
@@ -199,15 +432,33 @@ class LogEvent:
         _event = None
         try:
             json_data = json.loads(logline)
-            _event = cls(json_data)
         except json.decoder.JSONDecodeError:
             logger.error("Invalid JSON %s", logline)
             return None
 
+        if log_format == LogFormat.TRACE_DISPATCHER:
+            extract = TRACE_DISPATCHER_EXTRACTORS.get(json_data.get("ns"))
+            if not extract:
+                return None
+            try:
+                at = datetime.strptime(_at(json_data["at"]), AT_FORMAT)
+                _event = extract(at, json_data["data"])
+            except (AttributeError, KeyError, TypeError, ValueError):
+                logger.error("Unexpected %s", logline)
+                return None
+        else:
+            try:
+                _event = cls(json_data)
+            except (AttributeError, TypeError, ValueError):
+                logger.error("Unexpected %s", logline)
+                return None
+
         if _event.kind not in (
             LogEventKind.TRACE_DOWNLOADED_HEADER,
             LogEventKind.SEND_FETCH_REQUEST,
             LogEventKind.COMPLETED_BLOCK_FETCH,
+            LogEventKind.TRY_SWITCH_TO_A_FORK,
+            LogEventKind.ADD_BLOCK_VALIDATION,
             LogEventKind.ADDED_TO_CURRENT_CHAIN,
             LogEventKind.SWITCHED_TO_A_FORK,
         ):
@@ -221,51 +472,10 @@ class LogEvent:
 
         return _event
 
-    @property
-    def block_hash(self) -> str:
-        block_hash = ""
-        if self.kind == LogEventKind.SEND_FETCH_REQUEST:
-            block_hash = self.data.get("head", "")
-        elif self.kind in (
-            LogEventKind.COMPLETED_BLOCK_FETCH,
-            LogEventKind.TRACE_DOWNLOADED_HEADER,
-        ):
-            block_hash = self.data.get("block", "")
-        elif self.kind in (
-            LogEventKind.ADDED_TO_CURRENT_CHAIN,
-            LogEventKind.SWITCHED_TO_A_FORK,
-        ):
-            newtip = self.data.get("newtip", "")
-            block_hash = newtip.split("@")[0]
-        return str(block_hash)
-
     @property
     def block_hash_short(self) -> str:
         return self.block_hash[0:10]
 
     @property
-    def kind(self) -> LogEventKind:
-        if not hasattr(self, "_kind"):
-            _value = self.data.get("kind")
-            for kind in LogEventKind:
-                if _value == kind.value:
-                    self._kind = LogEventKind(_value)
-                    break
-            else:
-                self._kind = LogEventKind(LogEventKind.UNKNOWN)
-        return self._kind
-
-    @property
-    def block_num(self) -> int:
-        """
-        In prior version blockNo was a dict, that held and unBlockNo key
-        Since 8.x its only data.blockNo
-        """
-        _blockNo = self.data.get("blockNo", 0)
-        if type(_blockNo) is dict:
-            # If its a dict, it must have unBlockNo key
-            assert (
-                "unBlockNo" in _blockNo
-            ), "blockNo is a dict but does not have unBlockNo"
-            _blockNo = _blockNo.get("unBlockNo", 0)
-        return _blockNo
+    def atstr(self) -> str:
+        return self.at.strftime("%Y-%m-%d %H:%M:%S,%f")[:-3]
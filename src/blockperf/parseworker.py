@@ -0,0 +1,373 @@
+"""
+Tailing and parsing the nodes logfile in a separate process.
+
+Decoding the json of every logline is the most cpu intensive part of
+blockperf. The ParseWorker moves it (and the tailing) into its own process,
+which writes the LogEvents of interest as fixed width records into a ring
+buffer in shared memory. The main process reads the records straight from
+that buffer, nothing is pickled or send through a pipe.
+
+The ring has a single producer (the worker) and a single consumer. Its
+header holds the total number of records written and read so far, each side
+only ever writes its own counter. A record is written before the write
+counter is increased, so the consumer never sees a half written record.
+
+The mempool totals and the snapshot intervals are overwritten in place, the
+consumer reads them whenever it likes. Each has its own sequence counter in
+front (a seqlock): the worker increases it before and after writing, so it
+is odd while the values are written. The consumer reads again if it was odd
+or changed while reading, it never sees a mix of old and new values.
+"""
+
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Union
+
+from blockperf.mempool import MempoolCounter
+from blockperf.nodelogs import LogEvent, LogEventKind, LogFormat, detect_format
+from blockperf.snapshots import SNAPSHOTS, SnapshotRing
+from blockperf.store import pack_addr, unpack_addr
+from blockperf.tailer import LogfileTailer
+
+logger = logging.getLogger(__name__)
+
+# kind, block_hash, slot_num, block_num, at (us), size, delay, deltaq_g,
+# remote_addr, remote_port, local_addr, local_port
+EVENT = struct.Struct("<B32sQQqIdd16sH16sH")
+# written, read, seek requested, read attempts of the worker
+HEADER = struct.Struct("<QQQQ")
+# The sequence counter in front of the mempool totals and the snapshots
+SEQUENCE = struct.Struct("<Q")
+# The totals of the MempoolCounter of the worker
+MEMPOOL = struct.Struct("<QQQQQ")
+# The intervals of the SnapshotRing of the worker, the number of intervals
+# followed by start_ms, end_ms and exact of each
+SNAPSHOT_RING = struct.Struct("<Q" + "qq?" * SNAPSHOTS)
+MEMPOOL_OFFSET = HEADER.size
+SNAPSHOTS_OFFSET = MEMPOOL_OFFSET + SEQUENCE.size + MEMPOOL.size
+# The records follow the header, the mempool totals and the snapshots
+RECORDS = SNAPSHOTS_OFFSET + SEQUENCE.size + SNAPSHOT_RING.size
+RING_CAPACITY = 16384
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# The kinds LogEvent.from_logline() lets through, by their index in a record
+EVENT_KINDS = (
+    LogEventKind.TRACE_DOWNLOADED_HEADER,
+    LogEventKind.SEND_FETCH_REQUEST,
+    LogEventKind.COMPLETED_BLOCK_FETCH,
+    LogEventKind.ADDED_TO_CURRENT_CHAIN,
+    LogEventKind.SWITCHED_TO_A_FORK,
+    LogEventKind.TRY_SWITCH_TO_A_FORK,
+    LogEventKind.ADD_BLOCK_VALIDATION,
+)
+PEER_KINDS = EVENT_KINDS[:3]
+ADOPT_KINDS = EVENT_KINDS[3:5]
+
+
+def _port(port) -> int:
+    try:
+        return int(port)
+    except (ValueError, TypeError):
+        return 0
+
+
+def _addr(packed: bytes) -> str:
+    return unpack_addr(packed) if any(packed) else ""
+
+
+def pack_event(event: LogEvent) -> Union[bytes, None]:
+    """Returns the record for given event, None if it can not be stored,
+    e.g. a field is missing (None) or out of the range of its record field."""
+    remote_addr, remote_port, local_addr, local_port = bytes(16), 0, bytes(16), 0
+    try:
+        kind = EVENT_KINDS.index(event.kind)
+        block_hash = bytes.fromhex(event.block_hash)
+        if event.kind in PEER_KINDS:
+            remote_addr, remote_port = pack_addr(event.remote_addr), event.remote_port
+            local_addr, local_port = pack_addr(event.local_addr), event.local_port
+        at = event.at - EPOCH
+        return EVENT.pack(
+            kind,
+            block_hash,
+            event.slot_num,
+            event.block_num,
+            (at.days * 86400 + at.seconds) * 1_000_000 + at.microseconds,
+            event.size,
+            event.delay,
+            event.deltaq_g,
+            remote_addr,
+            _port(remote_port),
+            local_addr,
+            _port(local_port),
+        )
+    except (ValueError, TypeError, struct.error):
+        logger.warning("Can not pack %s", event)
+        return None
+
+
+def unpack_event(buffer, offset: int = 0) -> LogEvent:
+    """Recreates the LogEvent from the record at offset in buffer"""
+    (
+        kind,
+        block_hash,
+        slot_num,
+        block_num,
+        at,
+        size,
+        delay,
+        deltaq_g,
+        remote_addr,
+        remote_port,
+        local_addr,
+        local_port,
+    ) = EVENT.unpack_from(buffer, offset)
+    _kind = EVENT_KINDS[kind]
+    _block_hash = block_hash.hex()
+    peer = None
+    if _kind in PEER_KINDS:
+        peer = (
+            _addr(local_addr),
+            str(local_port),
+            _addr(remote_addr),
+            str(remote_port),
+        )
+    return LogEvent.of(
+        _kind,
+        _block_hash,
+        EPOCH + timedelta(microseconds=at),
+        slot_num=slot_num,
+        block_num=block_num,
+        size=size,
+        delay=delay,
+        deltaq_g=deltaq_g,
+        newtip=_block_hash if _kind in ADOPT_KINDS else "",
+        peer=peer,
+    )
+
+
+class EventRing:
+    """Ring buffer of event records in shared memory.
+
+    Created by the consumer with create=True, the worker attaches to it by
+    its name.
+    """
+
+    shm: SharedMemory
+    capacity: int
+
+    def __init__(
+        self,
+        capacity: int = RING_CAPACITY,
+        name: Union[str, None] = None,
+        create: bool = False,
+    ) -> None:
+        self.capacity = capacity
+        size = RECORDS + capacity * EVENT.size
+        self.shm = SharedMemory(name=name, create=create, size=size)
+        if create:
+            HEADER.pack_into(self.shm.buf, 0, 0, 0, 0, 0)
+            SEQUENCE.pack_into(self.shm.buf, MEMPOOL_OFFSET, 0)
+            SEQUENCE.pack_into(self.shm.buf, SNAPSHOTS_OFFSET, 0)
+            self.put_mempool((0, 0, 0, 0, 0))
+            self.put_snapshots([])
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _offset(self, position: int) -> int:
+        return RECORDS + (position % self.capacity) * EVENT.size
+
+    def put(self, record: bytes) -> bool:
+        """Appends record, returns False if the ring is full"""
+        written, read, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+        if written - read >= self.capacity:
+            return False
+        offset = self._offset(written)
+        self.shm.buf[offset : offset + EVENT.size] = record
+        struct.pack_into("<Q", self.shm.buf, 0, written + 1)
+        return True
+
+    def read_events(self) -> list:
+        """Returns the events of all records written since the last call"""
+        written, read, _, _ = HEADER.unpack_from(self.shm.buf, 0)
+        buf = self.shm.buf
+        events = [
+            unpack_event(buf, self._offset(position))
+            for position in range(read, written)
+        ]
+        struct.pack_into("<Q", buf, 8, written)
+        return events
+
+    def request_seek(self) -> None:
+        """Drops all records not yet read and asks the worker to skip
+        everything written to the logfile so far."""
+        written = HEADER.unpack_from(self.shm.buf, 0)[0]
+        struct.pack_into("<QQ", self.shm.buf, 8, written, 1)
+
+    def seek_requested(self) -> bool:
+        """Returns whether a seek was requested and clears that request"""
+        if HEADER.unpack_from(self.shm.buf, 0)[2]:
+            struct.pack_into("<Q", self.shm.buf, 16, 0)
+            return True
+        return False
+
+    def count_read(self) -> None:
+        """Counts an attempt of the worker to read lines, with or without
+        any lines read"""
+        reads = HEADER.unpack_from(self.shm.buf, 0)[3]
+        struct.pack_into("<Q", self.shm.buf, 24, reads + 1)
+
+    def reads(self) -> int:
+        return HEADER.unpack_from(self.shm.buf, 0)[3]
+
+    def _put_guarded(self, offset: int, layout: struct.Struct, *values) -> None:
+        """Writes values behind the sequence counter at offset, which is odd
+        while writing"""
+        sequence = SEQUENCE.unpack_from(self.shm.buf, offset)[0]
+        SEQUENCE.pack_into(self.shm.buf, offset, sequence + 1)
+        layout.pack_into(self.shm.buf, offset + SEQUENCE.size, *values)
+        SEQUENCE.pack_into(self.shm.buf, offset, sequence + 2)
+
+    def _get_guarded(self, offset: int, layout: struct.Struct) -> tuple:
+        """Reads the values behind the sequence counter at offset, again
+        until they were not written to meanwhile"""
+        while True:
+            sequence = SEQUENCE.unpack_from(self.shm.buf, offset)[0]
+            values = layout.unpack_from(self.shm.buf, offset + SEQUENCE.size)
+            if not sequence % 2 and (
+                SEQUENCE.unpack_from(self.shm.buf, offset)[0] == sequence
+            ):
+                return values
+            time.sleep(0)
+
+    def put_mempool(self, totals: tuple) -> None:
+        self._put_guarded(MEMPOOL_OFFSET, MEMPOOL, *totals)
+
+    def mempool_totals(self) -> tuple:
+        return self._get_guarded(MEMPOOL_OFFSET, MEMPOOL)
+
+    def put_snapshots(self, intervals) -> None:
+        intervals = list(intervals)[-SNAPSHOTS:]
+        values = [value for interval in intervals for value in interval]
+        values += [0, 0, False] * (SNAPSHOTS - len(intervals))
+        self._put_guarded(SNAPSHOTS_OFFSET, SNAPSHOT_RING, len(intervals), *values)
+
+    def snapshots(self) -> list:
+        """The intervals of the latest snapshots, oldest first"""
+        count, *values = self._get_guarded(SNAPSHOTS_OFFSET, SNAPSHOT_RING)
+        return [tuple(values[index : index + 3]) for index in range(0, count * 3, 3)]
+
+    def close(self, unlink: bool = False) -> None:
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def parse_worker(
+    node_logfile: Path,
+    masked_addresses: list,
+    bad_before: int,
+    ring_name: str,
+    capacity: int,
+    parent_pid: int,
+):
+    """Entrypoint of the worker process. Tails the logfile, parses every line
+    and writes the events of interest into the ring. Mempool traces are only
+    counted, see MempoolCounter. Snapshots are handed over in their own
+    slot of the ring, see SnapshotRing."""
+    ring = EventRing(capacity, name=ring_name)
+    tailer = LogfileTailer(node_logfile)
+    mempool = MempoolCounter()
+    snapshots = SnapshotRing()
+    log_format = None
+    # Stop once the main process is gone (and the worker has been reparented)
+    while os.getppid() == parent_pid:
+        if ring.seek_requested():
+            tailer.seek_end()
+        lines = tailer.read_lines()
+        if not log_format:
+            log_format = detect_format(lines)
+        for line in snapshots.filter(mempool.filter(lines)):
+            event = LogEvent.from_logline(
+                line, masked_addresses, bad_before, log_format or LogFormat.LEGACY
+            )
+            if not event or not (record := pack_event(event)):
+                continue
+            # Ring is full, wait for the main process to catch up. The
+            # logfile itself buffers in the meantime.
+            while not ring.put(record):
+                time.sleep(0.05)
+        # The worker is alive, even if the node has nothing to say
+        ring.count_read()
+        if lines:
+            ring.put_mempool(mempool.totals())
+            ring.put_snapshots(snapshots.intervals)
+        else:
+            time.sleep(0.5)
+    ring.close()
+
+
+class ParseWorker:
+    """Runs parse_worker() in its own process and reads its events."""
+
+    ring: EventRing
+    process: multiprocessing.process.BaseProcess
+
+    def __init__(
+        self,
+        node_logfile: Path,
+        masked_addresses: list,
+        bad_before: int,
+        capacity: int = RING_CAPACITY,
+    ) -> None:
+        self.ring = EventRing(capacity, create=True)
+        # Spawn a fresh interpreter, forking a process that may already run
+        # other threads (e.g. AppGroup, paho) is asking for trouble.
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=parse_worker,
+            args=(
+                node_logfile,
+                masked_addresses,
+                bad_before,
+                self.ring.name,
+                capacity,
+                os.getpid(),
+            ),
+            name="blockperf-parser",
+            daemon=True,
+        )
+        self.process.start()
+        logger.info("Started parse worker %s", self.process.pid)
+
+    def read_events(self) -> list:
+        if not self.process.is_alive():
+            raise RuntimeError(f"Parse worker exited with {self.process.exitcode}")
+        return self.ring.read_events()
+
+    def mempool_totals(self) -> tuple:
+        """The totals of the mempool traces counted by the worker"""
+        return self.ring.mempool_totals()
+
+    def reads(self) -> int:
+        """The number of times the worker tried to read lines so far"""
+        return self.ring.reads()
+
+    def snapshots(self) -> list:
+        """The intervals of the snapshots seen by the worker"""
+        return self.ring.snapshots()
+
+    def seek_end(self) -> None:
+        self.ring.request_seek()
+
+    def close(self) -> None:
+        self.process.terminate()
+        self.process.join()
+        self.ring.close(unlink=True)
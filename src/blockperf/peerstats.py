@@ -0,0 +1,152 @@
+"""
+Rolling per peer propagation statistics.
+
+Every BlockSample carries all the events recorded for a block from all peers.
+Instead of forgetting them once the sample is published, PeerStats folds them
+into a small aggregate per upstream peer. The number of peers tracked is
+capped; the least recently seen peer is dropped once the cap is reached. That
+way hundreds of churning peers can not grow memory (or the prometheus label
+set) without bounds.
+"""
+
+import collections
+import logging
+from typing import Union
+
+from blockperf.blocksample import BlockSample
+from blockperf.nodelogs import LogEvent, LogEventKind
+
+logger = logging.getLogger(__name__)
+
+# How many of the most recent block response deltas are kept per peer
+RESPONSE_DELTA_WINDOW = 64
+
+
+class PeerStat:
+    """Aggregated statistics of a single upstream peer."""
+
+    __slots__ = (
+        "peer",
+        "headers",
+        "first_headers",
+        "header_lag_total",
+        "blocks",
+        "response_deltas",
+        "deltaq_g",
+    )
+
+    def __init__(self, peer: str) -> None:
+        self.peer = peer
+        # Number of sampled blocks this peer announced a header for
+        self.headers = 0
+        # Number of sampled blocks this peer was the first to announce
+        self.first_headers = 0
+        # Sum of the header lag (ms) versus the fastest peer
+        self.header_lag_total = 0
+        # Number of blocks fetched from this peer
+        self.blocks = 0
+        self.response_deltas: collections.deque = collections.deque(
+            maxlen=RESPONSE_DELTA_WINDOW
+        )
+        self.deltaq_g = 0.0
+
+    def __repr__(self):
+        return f"PeerStat {self.peer} headers: {self.headers} blocks: {self.blocks}"
+
+    @property
+    def first_header_ratio(self) -> float:
+        """Share of announced headers where this peer was the fastest"""
+        if not self.headers:
+            return 0.0
+        return self.first_headers / self.headers
+
+    @property
+    def header_lag(self) -> float:
+        """Average header lag in miliseconds versus the fastest peer"""
+        if not self.headers:
+            return 0.0
+        return self.header_lag_total / self.headers
+
+    def response_delta_quantile(self, quantile: float) -> int:
+        """Nearest rank quantile of the recent block response deltas"""
+        if not self.response_deltas:
+            return 0
+        deltas = sorted(self.response_deltas)
+        index = min(len(deltas) - 1, int(quantile * len(deltas)))
+        return deltas[index]
+
+
+class PeerStats:
+    """Bounded LRU collection of PeerStat instances, keyed by "addr:port"."""
+
+    def __init__(self, max_peers: int = 200) -> None:
+        self.max_peers = max_peers
+        self.peers: collections.OrderedDict = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def get(self, peer: str) -> Union[PeerStat, None]:
+        return self.peers.get(peer)
+
+    def _peer_stat(self, peer: str) -> PeerStat:
+        """Returns the PeerStat for peer and marks it as most recently used"""
+        if peer in self.peers:
+            self.peers.move_to_end(peer)
+            return self.peers[peer]
+        peer_stat = self.peers[peer] = PeerStat(peer)
+        if len(self.peers) > self.max_peers:
+            removed, _ = self.peers.popitem(last=False)
+            logger.debug("Removed %s from peer stats", removed)
+        return peer_stat
+
+    def add_sample(self, sample: BlockSample) -> None:
+        """Folds all events of the given sample into the per peer aggregates.
+
+        * Each peer that announced the header gets its lag versus the first
+          header recorded, the first one gets a win.
+        * Each peer that completed a block fetch gets the response delta
+          from its own fetch request and the deltaq G of that request.
+        """
+        if not (fth := sample.first_trace_header):
+            return
+
+        first_headers: dict = {}
+        fetch_requests: dict = {}
+        completed_blocks: dict = {}
+        # Events are ordered by time, the first one seen per peer is kept
+        for event in sample.trace_events:
+            if event.kind == LogEventKind.TRACE_DOWNLOADED_HEADER:
+                first_headers.setdefault(_peer_of(event), event)
+            elif event.kind == LogEventKind.SEND_FETCH_REQUEST:
+                fetch_requests.setdefault(_peer_of(event), event)
+            elif event.kind == LogEventKind.COMPLETED_BLOCK_FETCH:
+                completed_blocks.setdefault(_peer_of(event), event)
+
+        fastest_peer = _peer_of(fth)
+        for peer, header in first_headers.items():
+            peer_stat = self._peer_stat(peer)
+            peer_stat.headers += 1
+            if peer == fastest_peer:
+                peer_stat.first_headers += 1
+            peer_stat.header_lag_total += _delta_ms(header, fth)
+
+        for peer, completed_block in completed_blocks.items():
+            if not (fetch_request := fetch_requests.get(peer)):
+                continue
+            peer_stat = self._peer_stat(peer)
+            peer_stat.blocks += 1
+            peer_stat.response_deltas.append(_delta_ms(completed_block, fetch_request))
+            peer_stat.deltaq_g = fetch_request.deltaq_g
+
+    def top(self, k: int) -> list:
+        """Returns the k peers that announced the most headers."""
+        return sorted(self.peers.values(), key=lambda p: p.headers, reverse=True)[:k]
+
+
+def _peer_of(event: LogEvent) -> str:
+    return f"{event.remote_addr}:{event.remote_port}"
+
+
+def _delta_ms(later: LogEvent, earlier: LogEvent) -> int:
+    return int((later.at - earlier.at).total_seconds() * 1000)
@@ -0,0 +1,151 @@
+"""
+Remembers which blocks have been published, across restarts.
+
+The hashes are kept in a rotating bloom filter of two generations. New
+hashes are added to the current generation, lookups check both. Once the
+current generation holds CAPACITY hashes, the previous one is dropped and
+the current becomes the previous. So at least the last CAPACITY published
+hashes are always remembered, in a fixed few KB no matter how long
+blockperf runs.
+
+A bloom filter may tell a hash was published when it was not. With the
+default sizes that happens for about 1 in 3000 blocks. The assembler knows
+the blocks it published itself exactly, it only asks the filter about
+blocks it can not know of, e.g. the ones published before a restart.
+
+If given a path, the filter is loaded from it on start and written there
+at most every SAVE_INTERVAL seconds once it changed, see save_due(). Adding
+a hash never writes, the sweeper does (see snapshot()), so publishing a
+sample does not wait for the disk. A crash loses the hashes of the last few
+blocks, which are adopted long before blockperf is back and not sampled
+again anyway.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+# Bits of a generation, 4 KiB
+BITS = 32768
+# Number of bits set per hash
+HASHES = 4
+# Hashes per generation before rotating
+CAPACITY = 1000
+# count of current generation, index of current generation
+HEADER = struct.Struct("<II")
+# Seconds between two saves of a changed filter
+SAVE_INTERVAL = 30
+
+
+class PublishedFilter:
+    path: Union[Path, None]
+    generations: list
+    current: int
+    count: int
+    # Changed since the last save, and when that was (time.monotonic())
+    dirty: bool = False
+    saved_at: float = 0.0
+
+    def __init__(self, path: Union[Path, None] = None) -> None:
+        self.path = path
+        self.generations = [bytearray(BITS // 8), bytearray(BITS // 8)]
+        self.current = 0
+        self.count = 0
+        if path and path.exists():
+            self.load()
+
+    @staticmethod
+    def bits_of(block_hash: str) -> tuple:
+        digest = hashlib.blake2b(block_hash.encode(), digest_size=4 * HASHES).digest()
+        return tuple(i % BITS for i in struct.unpack(f"<{HASHES}I", digest))
+
+    def __contains__(self, block_hash: str) -> bool:
+        bits = self.bits_of(block_hash)
+        return any(
+            all(generation[bit >> 3] & (1 << (bit & 7)) for bit in bits)
+            for generation in self.generations
+        )
+
+    def add(self, block_hash: str) -> None:
+        if self.count >= CAPACITY:
+            self.rotate()
+        generation = self.generations[self.current]
+        for bit in self.bits_of(block_hash):
+            generation[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+        self.dirty = True
+
+    def save_due(self) -> None:
+        """Saves the filter if it changed and the last save is at least
+        SAVE_INTERVAL ago. A failing save is logged and retried later."""
+        if data := self.snapshot():
+            self.write(data)
+
+    def snapshot(self) -> Union[bytes, None]:
+        """Returns the filter as saved, if a save is due, and takes it as
+        saved. Lets a caller copy it while holding its lock and write() it
+        once the lock is released."""
+        if not self.path or not self.dirty:
+            return None
+        if time.monotonic() - self.saved_at < SAVE_INTERVAL:
+            return None
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        return self.to_bytes()
+
+    def write(self, data: bytes) -> None:
+        """Saves a snapshot(), a failing save is logged and retried later"""
+        try:
+            self.save(data)
+        except OSError as exc:
+            logger.warning("Could not save published filter: %s", exc)
+            self.dirty = True
+
+    def rotate(self) -> None:
+        """Drops the previous generation, the current becomes the previous"""
+        self.current ^= 1
+        self.generations[self.current] = bytearray(BITS // 8)
+        self.count = 0
+        logger.debug("Rotated published filter")
+
+    def load(self) -> None:
+        assert self.path, "No path to load from"
+        data = self.path.read_bytes()
+        if len(data) != HEADER.size + BITS // 4:
+            logger.warning("Ignoring published filter %s of wrong size", self.path)
+            return
+        self.count, self.current = HEADER.unpack_from(data)
+        self.current &= 1
+        offset = HEADER.size
+        for index in (0, 1):
+            self.generations[index] = bytearray(data[offset : offset + BITS // 8])
+            offset += BITS // 8
+
+    def to_bytes(self) -> bytes:
+        return b"".join((HEADER.pack(self.count, self.current), *self.generations))
+
+    def save(self, data: Union[bytes, None] = None) -> None:
+        """Writes the filter (or the given snapshot of it) atomically, a
+        crash leaves the previous version. The temporary file is unique, so
+        savers never trip over each other."""
+        assert self.path, "No path to save to"
+        if data is None:
+            data = self.to_bytes()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fp = tempfile.NamedTemporaryFile(
+            dir=self.path.parent, prefix=self.path.name, suffix=".tmp", delete=False
+        )
+        try:
+            with fp:
+                fp.write(data)
+            os.replace(fp.name, self.path)
+        except BaseException:
+            os.unlink(fp.name)
+            raise
@@ -0,0 +1,302 @@
+"""
+Sinks the samples are published to.
+
+Every sink runs in its own thread and has its own bounded queue. Publishing
+a sample only puts it into the queue of every sink, so a slow (or dead)
+sink never blocks the others or the reading of the logs. If a queue is
+full, its oldest sample is dropped and counted in blockperf_sink_dropped.
+
+The thread of a sink takes all samples queued at once and writes them as
+a batch, which lets the file sink fsync once per batch and the http sink
+post them in a single request.
+
+Which sinks are used is configured with BLOCKPERF_SINKS, a comma separated
+list of:
+
+    mqtt    Publish to the broker (default)
+    file    Append json lines to BLOCKPERF_SINK_FILE
+    stdout  Write json lines to stdout
+    http    POST json lines to BLOCKPERF_SINK_URL
+"""
+
+import abc
+import http.client
+import json
+import logging
+import os
+import queue
+import ssl
+import sys
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, TextIO, Union
+from urllib.parse import urlsplit
+
+from blockperf.memory import PAYLOAD_MEMORY, budget
+from blockperf.metrics import Metrics
+from blockperf.watchdog import watchdog
+
+if TYPE_CHECKING:
+    from blockperf.mqtt import MQTTClient
+
+logger = logging.getLogger(__name__)
+
+SINKS = ("mqtt", "file", "stdout", "http")
+# Samples waiting in a sinks queue, older ones are dropped once it is full
+SINK_QUEUE_SIZE = 1000
+# Samples written at once at most
+BATCH_SIZE = 100
+HTTP_TIMEOUT = 10
+# Seconds between the warnings while the mqtt sink waits for the broker
+BROKER_WAIT = 30
+
+
+def json_line(topic: str, payload: dict) -> str:
+    return json.dumps({"topic": topic, "payload": payload}) + "\n"
+
+
+class Sink(abc.ABC):
+    """Base of all sinks, subclasses implement write(). A sink without it
+    can not be created, instead of failing in its thread."""
+
+    name: str = "sink"
+    queue: queue.Queue
+    metrics: Metrics
+    thread: Union[threading.Thread, None] = None
+
+    def __init__(self, queue_size: int = SINK_QUEUE_SIZE) -> None:
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = Metrics(self.name)
+        budget.account(f"{self.name} sink", lambda: self.queue.qsize() * PAYLOAD_MEMORY)
+
+    @property
+    def stage(self) -> str:
+        """The stage of the sink in the watchdog"""
+        return f"{self.name} sink"
+
+    def start(self) -> threading.Thread:
+        self.thread = threading.Thread(
+            target=self.run, name=f"{self.name}-sink", daemon=True
+        )
+        self.thread.start()
+        return self.thread
+
+    def submit(self, topic: str, payload: dict) -> None:
+        """Queues the sample, never blocks"""
+        while True:
+            try:
+                self.queue.put_nowait((topic, payload))
+                return
+            except queue.Full:
+                pass
+            try:
+                self.queue.get_nowait()
+                logger.warning("%s sink queue full, dropping oldest sample", self.name)
+                self.metrics.inc("sink_dropped")
+            except queue.Empty:
+                pass
+
+    def next_batch(self) -> list:
+        """Waits for the next sample, returns it with all queued after it"""
+        batch = [self.queue.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.next_batch()
+            watchdog.beat(self.stage)
+            try:
+                self.write(batch)
+            except Exception:
+                logger.exception(
+                    "%s sink failed to write %s samples", self.name, len(batch)
+                )
+                self.metrics.inc("sink_dropped", len(batch))
+            # Waiting for the next batch is no stall
+            watchdog.idle(self.stage)
+            self.metrics.set("sink_queued", self.queue.qsize())
+
+    @abc.abstractmethod
+    def write(self, batch: list) -> None:
+        """Writes the (topic, payload) tuples in batch"""
+
+    def close(self) -> None:
+        pass
+
+
+class MQTTSink(Sink):
+    """Publishes every sample to the broker, waiting for each to be
+    acknowledged. The client is created once the sink is started and
+    connects in the background."""
+
+    name = "mqtt"
+    client: "MQTTClient"
+
+    def __init__(self, connect: Callable[[], "MQTTClient"], **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.connect = connect
+
+    def start(self) -> threading.Thread:
+        self.client = self.connect()
+        return super().start()
+
+    def write(self, batch: list) -> None:
+        # While disconnected the batch is kept and new samples queue up
+        # (dropping the oldest once full), the client reconnects meanwhile.
+        while not self.client.connected.wait(BROKER_WAIT):
+            watchdog.idle(self.stage)
+            logger.warning(
+                "Waiting for the broker, %s samples queued", self.queue.qsize()
+            )
+        lost = 0
+        for topic, payload in batch:
+            # Every publish may wait for the broker, a batch much longer
+            watchdog.beat(self.stage)
+            if not self.client.publish(topic, payload):
+                lost += 1
+        if lost:
+            logger.warning("Lost %s samples publishing to the broker", lost)
+            self.metrics.inc("sink_dropped", lost)
+
+
+class StreamSink(Sink):
+    """Writes every sample as a json line to a stream"""
+
+    name = "stdout"
+    stream: TextIO
+
+    def __init__(self, stream: TextIO = sys.stdout, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.stream = stream
+
+    def write(self, batch: list) -> None:
+        self.stream.write(
+            "".join(json_line(topic, payload) for topic, payload in batch)
+        )
+        self.stream.flush()
+
+
+class FileSink(Sink):
+    """Appends every sample as a json line to a file.
+
+    The lines of a batch are written at once and the file is fsynced once
+    per batch, not once per sample. A crash loses at most the batch being
+    written.
+    """
+
+    name = "file"
+    path: Path
+    fp: Union[TextIO, None] = None
+
+    def __init__(self, path: Path, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, batch: list) -> None:
+        if not self.fp:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.fp = open(self.path, "a", encoding="utf-8")
+        self.fp.write("".join(json_line(topic, payload) for topic, payload in batch))
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self) -> None:
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+class HTTPSink(Sink):
+    """POSTs the samples of a batch as json lines to url.
+
+    The connection is kept alive and reused for all requests, the tcp (and
+    tls) handshake is only done again after the server closed it. A batch
+    that fails on a reused connection is retried once on a fresh one.
+    """
+
+    name = "http"
+    url: str
+    connection: Union[http.client.HTTPConnection, None] = None
+
+    def __init__(self, url: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.url = url
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported url {url}")
+        self.scheme, self.host, self.port = parts.scheme, parts.hostname, parts.port
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += f"?{parts.query}"
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.host,
+                self.port,
+                timeout=HTTP_TIMEOUT,
+                context=ssl.create_default_context(),
+            )
+        return http.client.HTTPConnection(self.host, self.port, timeout=HTTP_TIMEOUT)
+
+    def post(self, body: bytes) -> int:
+        if not self.connection:
+            self.connection = self.connect()
+        self.connection.request(
+            "POST",
+            self.path,
+            body=body,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        response = self.connection.getresponse()
+        # Read it all, otherwise the connection can not be reused
+        response.read()
+        if response.will_close:
+            self.close()
+        return response.status
+
+    def write(self, batch: list) -> None:
+        body = "".join(json_line(topic, payload) for topic, payload in batch).encode()
+        reused = self.connection is not None
+        try:
+            status = self.post(body)
+        except (OSError, http.client.HTTPException) as exc:
+            self.close()
+            if not reused:
+                raise
+            logger.debug("Retrying on a new connection after %s", exc)
+            status = self.post(body)
+        if status >= 300:
+            logger.warning("%s answered %s to %s samples", self.url, status, len(batch))
+            self.metrics.inc("sink_dropped", len(batch))
+
+    def close(self) -> None:
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+def open_sink(
+    kind: str,
+    connect_mqtt: Union[Callable[[], "MQTTClient"], None] = None,
+    sink_file: Union[Path, None] = None,
+    sink_url: str = "",
+) -> Sink:
+    """Returns the (not yet started) sink of the given kind, see SINKS"""
+    if kind == "mqtt":
+        assert connect_mqtt, "No mqtt client to publish with"
+        return MQTTSink(connect_mqtt)
+    if kind == "file":
+        assert sink_file, "No file to write the samples to"
+        return FileSink(sink_file)
+    if kind == "stdout":
+        return StreamSink()
+    if kind == "http":
+        assert sink_url, "No url to post the samples to"
+        return HTTPSink(sink_url)
+    raise ValueError(f"Unknown sink {kind}")
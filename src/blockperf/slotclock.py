@@ -0,0 +1,148 @@
+"""
+Conversion between slots and time.
+
+A network starts in the Byron era, whose slots are 20 seconds long and whose
+epochs are 10k slots long. At the transition epoch the Shelley era starts,
+with slots of slotLength (1 second on all public networks). Everything
+needed is in the Byron and Shelley genesis files, except the transition
+epoch. That is known for the public networks and configured with
+TestShelleyHardForkAtEpoch in the node config for private testnets.
+
+All times are integer milliseconds since the epoch.
+"""
+
+import logging
+from datetime import datetime
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+MAINNET_MAGIC = 764824073
+
+# network magic -> (name, byron start time, byron k, transition epoch)
+KNOWN_NETWORKS = {
+    MAINNET_MAGIC: ("mainnet", 1506203091, 2160, 208),
+    1: ("preprod", 1654041600, 2160, 4),
+    2: ("preview", 1666656000, 432, 0),
+    4: ("sanchonet", 1686789000, 432, 0),
+}
+BYRON_SLOT_MS = 20000
+
+
+class SlotClock:
+    transition_epoch: int
+    byron_epoch_length: int
+    shelley_start_slot: int
+    shelley_start_ms: int
+    byron_start_ms: int
+    byron_slot_ms: int
+    slot_ms: int
+
+    def __init__(
+        self,
+        system_start_ms: int,
+        byron_slot_ms: int,
+        byron_epoch_length: int,
+        transition_epoch: int,
+        slot_ms: int = 1000,
+    ) -> None:
+        self.byron_start_ms = system_start_ms
+        self.byron_slot_ms = byron_slot_ms
+        self.byron_epoch_length = byron_epoch_length
+        self.transition_epoch = transition_epoch
+        self.slot_ms = slot_ms
+        self.shelley_start_slot = transition_epoch * byron_epoch_length
+        self.shelley_start_ms = (
+            system_start_ms + self.shelley_start_slot * byron_slot_ms
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"SlotClock(shelley_start_slot={self.shelley_start_slot}, "
+            f"shelley_start_ms={self.shelley_start_ms}, slot_ms={self.slot_ms})"
+        )
+
+    @classmethod
+    def from_genesis(
+        cls,
+        byron_genesis: Union[dict, None],
+        shelley_genesis: dict,
+        transition_epoch: int,
+    ) -> "SlotClock":
+        """Creates the clock from the (parsed) genesis files. Without a byron
+        genesis the network is taken to start in the Shelley era."""
+        slot_ms = int(float(shelley_genesis.get("slotLength", 1)) * 1000)
+        if not byron_genesis:
+            system_start = datetime.fromisoformat(
+                shelley_genesis["systemStart"].replace("Z", "+00:00")
+            )
+            return cls(
+                int(system_start.timestamp() * 1000), BYRON_SLOT_MS, 0, 0, slot_ms
+            )
+        return cls(
+            int(byron_genesis["startTime"]) * 1000,
+            int(byron_genesis["blockVersionData"]["slotDuration"]),
+            10 * int(byron_genesis["protocolConsts"]["k"]),
+            transition_epoch,
+            slot_ms,
+        )
+
+    @classmethod
+    def for_network(cls, network_magic: int) -> "SlotClock":
+        """Creates the clock of a known public network"""
+        _, byron_start, k, transition_epoch = KNOWN_NETWORKS[network_magic]
+        return cls(byron_start * 1000, BYRON_SLOT_MS, 10 * k, transition_epoch)
+
+    def slot_time_ms(self, slot_num: int) -> int:
+        """Returns the time slot_num started at"""
+        if slot_num >= self.shelley_start_slot:
+            return (
+                self.shelley_start_ms
+                + (slot_num - self.shelley_start_slot) * self.slot_ms
+            )
+        return self.byron_start_ms + slot_num * self.byron_slot_ms
+
+    def slot_at_ms(self, time_ms: int) -> int:
+        """Returns the slot at time_ms, the inverse of slot_time_ms()"""
+        if time_ms >= self.shelley_start_ms:
+            return (
+                self.shelley_start_slot
+                + (time_ms - self.shelley_start_ms) // self.slot_ms
+            )
+        return (time_ms - self.byron_start_ms) // self.byron_slot_ms
+
+    def epoch_of(self, slot_num: int, epoch_length: int) -> int:
+        """Returns the epoch of slot_num, epoch_length is the number of slots
+        of a Shelley epoch (epochLength in the genesis)"""
+        if slot_num >= self.shelley_start_slot:
+            return (
+                self.transition_epoch
+                + (slot_num - self.shelley_start_slot) // epoch_length
+            )
+        return slot_num // self.byron_epoch_length
+
+
+# The clocks of all networks, by network magic
+_clocks: dict = {}
+
+
+def register(network_magic: int, clock: SlotClock) -> None:
+    """Sets the clock used for network_magic, e.g. one from the genesis files"""
+    _clocks[network_magic] = clock
+
+
+def clock_of(network: Union[int, str]) -> SlotClock:
+    """Returns the clock of the network given by magic or name (e.g. preview).
+    Known networks have a clock without registering one."""
+    if isinstance(network, str):
+        for magic, (name, *_) in KNOWN_NETWORKS.items():
+            if name == network:
+                network = magic
+                break
+        else:
+            raise ValueError(f"Unknown network {network}")
+    if network not in _clocks:
+        if network not in KNOWN_NETWORKS:
+            raise ValueError(f"No slot clock for {network} available")
+        _clocks[network] = SlotClock.for_network(network)
+    return _clocks[network]
@@ -0,0 +1,109 @@
+"""
+Tracking of the ledger snapshots the node takes.
+
+While the node writes a snapshot of its ledger to disk, adopting a block
+may take considerably longer. Samples whose time from the first header to
+the adoption overlaps a snapshot are tagged, so a slow adoption caused by
+the node itself can be told apart from slow propagation in the network.
+
+Depending on its version the node logs a snapshot differently:
+
+  * Only once after the snapshot was written, without any timing. The
+    snapshot is then assumed to have taken SNAPSHOT_MS before that.
+  * Once when it starts (enclosedTime is "RisingEdge") and once when it is
+    done, with the seconds it took as enclosedTime. Until the second line
+    arrives the snapshot is assumed to take up to SNAPSHOT_MS.
+
+Snapshots are rare (every few thousand blocks), the lines are recognized by
+a plain substring test, like the mempool traces, and only those are decoded.
+The intervals are kept in a small ring, oldest first.
+"""
+
+import json
+import logging
+from collections import deque
+from typing import Union
+
+from blockperf.nodelogs import parse_at
+
+logger = logging.getLogger(__name__)
+
+# Legacy kind is TraceSnapshotEvent.TookSnapshot, the new namespace
+# ChainDB.LedgerEvent.TookSnapshot
+TOOK_SNAPSHOT = "TookSnapshot"
+RISING_EDGE = "RisingEdge"
+# Assumed duration of a snapshot whose duration is not (yet) known
+SNAPSHOT_MS = 5000
+# Snapshots kept, samples are created within seconds so a few are plenty
+SNAPSHOTS = 8
+
+
+def _ms(at: str) -> int:
+    return int(parse_at(at).timestamp() * 1000)
+
+
+def enclosed_time(data: dict) -> Union[float, str, None]:
+    """Returns the seconds a snapshot took, RISING_EDGE if it just started or
+    None if the line does not tell. The falling edge is logged either as
+    plain number or as {"tag": "FallingEdge", "contents": seconds}."""
+    enclosed = data.get("enclosedTime")
+    if isinstance(enclosed, dict):
+        enclosed = enclosed.get("contents", enclosed.get("tag"))
+    if isinstance(enclosed, (int, float)) or enclosed == RISING_EDGE:
+        return enclosed
+    return None
+
+
+class SnapshotRing:
+    """The intervals (start_ms, end_ms, exact) of the latest snapshots"""
+
+    __slots__ = ("intervals",)
+
+    def __init__(self, capacity: int = SNAPSHOTS) -> None:
+        self.intervals: deque = deque(maxlen=capacity)
+
+    def add(self, start_ms: int, end_ms: int, exact: bool = True) -> None:
+        """Adds the interval of a snapshot. An exact one replaces the
+        assumed interval of the same snapshot (from its rising edge)."""
+        if exact and self.intervals:
+            last_start, _, last_exact = self.intervals[-1]
+            if not last_exact and last_start <= end_ms:
+                self.intervals.pop()
+        self.intervals.append((start_ms, end_ms, exact))
+
+    def update(self, intervals: list) -> None:
+        """Replaces all intervals, e.g. with the ones of the parse worker"""
+        self.intervals.clear()
+        self.intervals.extend(intervals)
+
+    def add_line(self, line: str) -> bool:
+        """Adds the snapshot of the line if it is a TookSnapshot trace,
+        returns whether it was"""
+        if TOOK_SNAPSHOT not in line:
+            return False
+        try:
+            json_data = json.loads(line)
+            at = _ms(json_data["at"])
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, ValueError):
+            logger.warning("Invalid snapshot line %s", line)
+            return True
+        data = json_data.get("data")
+        enclosed = enclosed_time(data) if isinstance(data, dict) else None
+        if enclosed is None:
+            self.add(at - SNAPSHOT_MS, at, exact=False)
+        elif enclosed == RISING_EDGE:
+            self.add(at, at + SNAPSHOT_MS, exact=False)
+        else:
+            self.add(at - int(enclosed * 1000), at)
+        logger.info("Ledger snapshot %s", self.intervals[-1])
+        return True
+
+    def filter(self, lines: list) -> list:
+        """Adds the snapshots in lines, returns all other lines"""
+        return [line for line in lines if not self.add_line(line)]
+
+    def overlaps(self, start_ms: int, end_ms: int) -> bool:
+        """Whether any snapshot overlaps the interval from start to end"""
+        return any(
+            start <= end_ms and end >= start_ms for start, end, _ in self.intervals
+        )
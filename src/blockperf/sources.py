@@ -0,0 +1,256 @@
+"""
+Sources of the nodes log lines.
+
+A source hands out the lines the node logged since the last call, without
+ever blocking, just like LogfileTailer does. Waiting for new lines is up to
+the caller. Every source has the same three methods:
+
+    read_lines()  All (complete) lines received since the last call
+    seek_end()    Skip everything received so far
+    close()       Release whatever the source holds open
+
+Which source an App reads from is configured with BLOCKPERF_SOURCE:
+
+    file      Tail the nodes logfile (default), see LogfileTailer
+    journald  Read the journal of the nodes service unit
+    stdin     Read what is piped into blockperf, e.g. the nodes stdout
+    socket    Listen on a unix socket the node (or socat) writes to
+"""
+
+import logging
+import os
+import socket
+import sys
+from pathlib import Path
+from typing import Union
+
+from blockperf.tailer import LogfileTailer
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ("file", "journald", "stdin", "socket")
+# Bytes read from a stream at once
+READ_SIZE = 65536
+# Lines longer than this are dropped, the node never logs anything that long
+MAX_LINE = 1024 * 1024
+
+
+class LineBuffer:
+    """Splits chunks of bytes read from a stream into lines. A line that is
+    not yet complete is kept until the rest of it is fed."""
+
+    def __init__(self) -> None:
+        self.partial = b""
+
+    def feed(self, data: bytes) -> list:
+        *lines, self.partial = (self.partial + data).split(b"\n")
+        if len(self.partial) > MAX_LINE:
+            logger.warning("Dropping line longer than %s bytes", MAX_LINE)
+            self.partial = b""
+        return [line.decode("utf-8", "replace") + "\n" for line in lines if line]
+
+    def clear(self) -> None:
+        self.partial = b""
+
+
+class StdinSource:
+    """Reads the lines piped into blockperf, e.g.
+
+        cardano-node run ... | blockperf run
+
+    stdin is switched to non blocking, so read_lines() returns right away
+    if the node has not written anything. Once the node closes the pipe
+    there is nothing more to read and read_lines() keeps returning [].
+    """
+
+    def __init__(self, fd: Union[int, None] = None) -> None:
+        self.fd = sys.stdin.fileno() if fd is None else fd
+        os.set_blocking(self.fd, False)
+        self.buffer = LineBuffer()
+        self.eof = False
+
+    def read_lines(self) -> list:
+        lines: list = []
+        while not self.eof:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                logger.warning("Stdin closed, no more lines to read")
+                self.eof = True
+                break
+            lines.extend(self.buffer.feed(data))
+        return lines
+
+    def seek_end(self) -> None:
+        self.read_lines()
+        self.buffer.clear()
+
+    def close(self) -> None:
+        pass
+
+
+class UnixSocketSource:
+    """Listens on a unix socket and reads the lines of every connection.
+
+    The node can not write to a socket by itself, its stdout is piped into
+    the socket instead, e.g.
+
+        cardano-node run ... | socat - UNIX-CONNECT:/run/blockperf/node.sock
+
+    That way the node and blockperf can be restarted independently. Several
+    connections may write at the same time, each is buffered on its own so
+    their lines never get mixed up.
+    """
+
+    path: Path
+    server: socket.socket
+    connections: dict
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        if path.is_socket():
+            # Left behind by a previous run
+            path.unlink()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(str(path))
+        self.server.listen()
+        self.server.setblocking(False)
+        # connection -> LineBuffer
+        self.connections = {}
+        logger.info("Listening on %s", path)
+
+    def accept(self) -> None:
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            connection.setblocking(False)
+            self.connections[connection] = LineBuffer()
+            logger.info("Accepted connection on %s", self.path)
+
+    def read_lines(self) -> list:
+        self.accept()
+        lines: list = []
+        for connection, buffer in list(self.connections.items()):
+            while True:
+                try:
+                    data = connection.recv(READ_SIZE)
+                except BlockingIOError:
+                    break
+                except OSError as exc:
+                    logger.warning("Connection on %s failed: %s", self.path, exc)
+                    data = b""
+                if not data:
+                    logger.info("Connection on %s closed", self.path)
+                    connection.close()
+                    del self.connections[connection]
+                    break
+                lines.extend(buffer.feed(data))
+        return lines
+
+    def seek_end(self) -> None:
+        self.read_lines()
+        for buffer in self.connections.values():
+            buffer.clear()
+
+    def close(self) -> None:
+        for connection in self.connections:
+            connection.close()
+        self.connections = {}
+        self.server.close()
+        if self.path.is_socket():
+            self.path.unlink()
+
+
+class JournaldSource:
+    """Reads the messages the nodes service unit logged to the journal.
+
+    The cursor of the last entry read is written to cursor_file, so after a
+    restart reading resumes right after it and nothing logged in between is
+    lost. Without a cursor (or with seek_end) reading starts at the end of
+    the journal. The cursor is written once per read_lines(), not for every
+    single entry.
+    """
+
+    unit: str
+    cursor_file: Union[Path, None]
+    cursor: Union[str, None] = None
+
+    def __init__(self, unit: str, cursor_file: Union[Path, None] = None) -> None:
+        try:
+            from systemd import journal
+        except ImportError:
+            sys.exit(
+                "The journald source needs the systemd-python package.\n"
+                "pip install blockperf[journald]\n\n"
+            )
+        self.unit = unit
+        self.cursor_file = cursor_file
+        self.reader = journal.Reader()
+        self.reader.add_match(_SYSTEMD_UNIT=unit)
+        self.reader.log_level(journal.LOG_DEBUG)
+        if cursor_file and cursor_file.exists():
+            self.cursor = cursor_file.read_text().strip()
+        if self.cursor:
+            logger.info("Resuming journal of %s at %s", unit, self.cursor)
+            self.reader.seek_cursor(self.cursor)
+            # seek_cursor() positions on the entry read last, skip it
+            self.reader.get_next()
+        else:
+            self.seek_end()
+
+    def read_lines(self) -> list:
+        lines = []
+        while entry := self.reader.get_next():
+            self.cursor = entry["__CURSOR"]
+            message = entry.get("MESSAGE", "")
+            if isinstance(message, bytes):
+                message = message.decode("utf-8", "replace")
+            lines.append(f"{message}\n")
+        if lines:
+            self.save_cursor()
+        return lines
+
+    def save_cursor(self) -> None:
+        if not self.cursor_file or not self.cursor:
+            return
+        self.cursor_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cursor_file.with_suffix(".tmp")
+        tmp_path.write_text(self.cursor)
+        os.replace(tmp_path, self.cursor_file)
+
+    def seek_end(self) -> None:
+        self.reader.seek_tail()
+        # seek_tail() positions after the last entry, step back on it so
+        # the next get_next() returns the first new one
+        if entry := self.reader.get_previous():
+            self.cursor = entry["__CURSOR"]
+            self.save_cursor()
+
+    def close(self) -> None:
+        self.save_cursor()
+        self.reader.close()
+
+
+def open_source(
+    kind: str,
+    node_logfile: Union[Path, None] = None,
+    node_service_unit: str = "cardano-node.service",
+    journald_cursor_file: Union[Path, None] = None,
+    source_socket: Union[Path, None] = None,
+):
+    """Returns the source of the given kind, see SOURCES"""
+    if kind == "file":
+        assert node_logfile, "Node logfile not found"
+        return LogfileTailer(node_logfile)
+    if kind == "journald":
+        return JournaldSource(node_service_unit, journald_cursor_file)
+    if kind == "stdin":
+        return StdinSource()
+    if kind == "socket":
+        assert source_socket, "No socket to listen on"
+        return UnixSocketSource(source_socket)
+    raise ValueError(f"Unknown source {kind}")
@@ -0,0 +1,208 @@
+"""
+Vectorized analysis of the samples in the local store.
+
+The fixed width records of the store map directly onto a numpy structured
+dtype. All records of all segments are loaded as columns without creating a
+python object per sample and every aggregate is computed on whole columns.
+"""
+
+import csv
+import logging
+import sys
+from pathlib import Path
+from typing import Union
+
+from blockperf.store import (
+    FLAG_INCOMPLETE,
+    RECORD,
+    SampleStore,
+    pack_addr,
+    unpack_addr,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    sys.exit(
+        "Blockperf stats needs the numpy package.\n" "pip install blockperf[stats]\n\n"
+    )
+
+logger = logging.getLogger(__name__)
+
+RECORD_DTYPE = np.dtype(
+    [
+        ("slot_time_ms", "<i8"),
+        ("slot_num", "<u8"),
+        ("block_num", "<u8"),
+        ("block_hash", "V32"),
+        ("block_size", "<u4"),
+        ("header_delta", "<i4"),
+        ("block_request_delta", "<i4"),
+        ("block_response_delta", "<i4"),
+        ("block_adopt_delta", "<i4"),
+        ("block_g", "<f8"),
+        ("header_remote_addr", "V16"),
+        ("header_remote_port", "<u2"),
+        ("block_remote_addr", "V16"),
+        ("block_remote_port", "<u2"),
+        ("flags", "<u4"),
+    ]
+)
+assert RECORD_DTYPE.itemsize == RECORD.size, "dtype does not match store record"
+
+DELTAS = (
+    "header_delta",
+    "block_request_delta",
+    "block_response_delta",
+    "block_adopt_delta",
+)
+PERCENTILES = (50, 90, 99)
+
+
+def load(
+    store: SampleStore,
+    since: Union[float, None] = None,
+    until: Union[float, None] = None,
+    peer: Union[str, None] = None,
+) -> np.ndarray:
+    """Returns all records of the store as one structured array, filtered by
+    slot time in [since, until) and header or block peer. Records of blocks
+    never adopted are left out, their deltas are not all known."""
+    columns = [
+        np.fromfile(path, dtype=RECORD_DTYPE, count=path.stat().st_size // RECORD.size)
+        for _, path in store.segments()
+    ]
+    if not columns:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    samples = np.concatenate(columns)
+
+    mask = (samples["flags"] & FLAG_INCOMPLETE) == 0
+    if since is not None:
+        mask &= samples["slot_time_ms"] >= int(since * 1000)
+    if until is not None:
+        mask &= samples["slot_time_ms"] < int(until * 1000)
+    if peer:
+        packed_peer = np.void(pack_addr(peer))
+        mask &= (samples["header_remote_addr"] == packed_peer) | (
+            samples["block_remote_addr"] == packed_peer
+        )
+    return samples[mask]
+
+
+def _grouped(keys: np.ndarray):
+    """Returns the unique keys, the order that sorts by key and the offsets
+    each group starts at in that order."""
+    order = np.argsort(keys, kind="stable")
+    unique, starts = np.unique(keys[order], return_index=True)
+    return unique, order, starts
+
+
+def _percentiles(
+    group_ids: np.ndarray, values: np.ndarray, starts: np.ndarray, percentile: int
+) -> np.ndarray:
+    """Linear interpolated percentile of values for every group at once.
+
+    group_ids must be the ids of the groups sorted (as returned by _grouped)
+    and starts the offset each group starts at. Sorting by group and value
+    puts each groups values next to each other, so the percentile positions
+    can be computed for all groups with plain array arithmetic.
+    """
+    if not len(values):
+        return np.empty(0)
+    sorted_values = values[np.lexsort((values, group_ids))].astype(np.float64)
+    counts = np.diff(starts, append=len(values))
+    position = (counts - 1) * (percentile / 100)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    lower, upper = sorted_values[starts + low], sorted_values[starts + high]
+    return lower + (upper - lower) * (position - low)
+
+
+def hourly(samples: np.ndarray) -> dict:
+    """Per hour (of slot time) sample counts and percentiles of all deltas."""
+    hours = samples["slot_time_ms"] // 3_600_000
+    unique, order, starts = _grouped(hours)
+    table: dict = {
+        "hour": (unique * 3600).astype("datetime64[s]"),
+        "samples": np.diff(starts, append=len(order)),
+    }
+    for delta in DELTAS:
+        for percentile in PERCENTILES:
+            table[f"{delta}_p{percentile}"] = _percentiles(
+                hours, samples[delta], starts, percentile
+            )
+    return table
+
+
+def peers(samples: np.ndarray) -> dict:
+    """Per block peer sample counts, mean header delta and percentiles of the
+    block response delta."""
+    keys = samples[["block_remote_addr", "block_remote_port"]]
+    unique, order, starts = _grouped(keys)
+    # Number each sample by the group (peer) it belongs to
+    group_ids = np.empty(len(order), dtype=np.int64)
+    group_ids[order] = np.repeat(
+        np.arange(len(starts)), np.diff(starts, append=len(order))
+    )
+    counts = np.bincount(group_ids, minlength=len(starts))
+    table: dict = {
+        "peer": np.array(
+            [f"{unpack_addr(addr)}:{port}" for addr, port in unique.tolist()],
+            dtype=str,
+        ),
+        "samples": counts,
+        "header_delta_mean": (
+            np.bincount(group_ids, weights=samples["header_delta"])
+            / np.maximum(counts, 1)
+        ),
+    }
+    for percentile in PERCENTILES:
+        table[f"block_response_delta_p{percentile}"] = _percentiles(
+            group_ids, samples["block_response_delta"], starts, percentile
+        )
+    return table
+
+
+def size_correlation(samples: np.ndarray) -> float:
+    """Pearson correlation of block_size and block_response_delta"""
+    if len(samples) < 2:
+        return 0.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = np.corrcoef(
+            samples["block_size"].astype(np.float64),
+            samples["block_response_delta"].astype(np.float64),
+        )[0, 1]
+    return float(np.nan_to_num(corr))
+
+
+def format_table(table: dict) -> str:
+    names = list(table.keys())
+    lines = ["\t".join(names)]
+    for row in zip(*table.values()):
+        lines.append("\t".join(_format(value) for value in row))
+    return "\n".join(lines)
+
+
+def _format(value) -> str:
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.1f}"
+    return str(value)
+
+
+def export(table: dict, path: Path) -> None:
+    """Writes table to path, as parquet if it ends in .parquet otherwise csv"""
+    if path.suffix == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit(
+                "Exporting parquet needs the pyarrow package.\n"
+                "pip install blockperf[parquet]\n\n"
+            )
+        pq.write_table(pa.table(table), path)
+        return
+    with open(path, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(table.keys())
+        writer.writerows(zip(*table.values()))
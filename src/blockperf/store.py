@@ -0,0 +1,218 @@
+"""
+Local append only store of BlockSamples.
+
+Each sample is written as a single fixed width record into a segment file.
+Segments cover a fixed time range (by slot time of the sample) and are named
+after the start of that range, e.g.: samples-1693526400.bin. Segments that
+fall out of the retention window are deleted. Reading a segment is done by
+memory mapping it and unpacking the records in place, no text is parsed.
+"""
+
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, NamedTuple, Union
+
+from blockperf.blocksample import BlockSample
+
+logger = logging.getLogger(__name__)
+
+# slot_time_ms, slot_num, block_num, block_hash, block_size, header_delta,
+# block_request_delta, block_response_delta, block_adopt_delta, block_g,
+# header_remote_addr, header_remote_port, block_remote_addr, block_remote_port,
+# flags
+RECORD = struct.Struct("<qQQ32sIiiiid16sH16sHI")
+SEGMENT_SECONDS = 86400
+SEGMENT_PREFIX = "samples-"
+SEGMENT_SUFFIX = ".bin"
+# Bits of the flags of a record
+# The node took a ledger snapshot while the block was adopted
+FLAG_SNAPSHOT = 1
+# The block was never adopted (or not all events were seen), the record has
+# the stages known when it was evicted, the others are 0
+FLAG_INCOMPLETE = 2
+
+
+def pack_addr(addr: str) -> bytes:
+    """Returns the 16 byte (ipv6) representation of given ip address.
+    IPv4 addresses are stored as ipv4 mapped ipv6 addresses. Anything that
+    is not an ip address is stored as ::"""
+    try:
+        ip = ipaddress.ip_address(addr)
+    except ValueError:
+        return bytes(16)
+    if ip.version == 4:
+        return ipaddress.IPv6Address(f"::ffff:{ip}").packed
+    return ip.packed
+
+
+def truncate_partial(path: Path, record_size: int, header: int = 0) -> None:
+    """Cuts off a partially written record (e.g. the process was killed in
+    the middle of a write) at the end of the segment in path, so the records
+    appended to it stay aligned. The records follow header bytes."""
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return
+    whole = 0
+    if size >= header:
+        whole = header + (size - header) // record_size * record_size
+    if whole != size:
+        logger.warning("Truncating partial record (%s bytes) of %s", size - whole, path)
+        os.truncate(path, whole)
+
+
+def unpack_addr(packed: bytes) -> str:
+    ip = ipaddress.IPv6Address(packed)
+    if ip.ipv4_mapped:
+        return str(ip.ipv4_mapped)
+    return str(ip)
+
+
+class SampleRecord(NamedTuple):
+    """A single sample as read back from the store."""
+
+    slot_time_ms: int
+    slot_num: int
+    block_num: int
+    block_hash: bytes
+    block_size: int
+    header_delta: int
+    block_request_delta: int
+    block_response_delta: int
+    block_adopt_delta: int
+    block_g: float
+    header_remote_addr: bytes
+    header_remote_port: int
+    block_remote_addr: bytes
+    block_remote_port: int
+    flags: int
+
+    @classmethod
+    def from_sample(cls, sample: BlockSample, flags: int = 0) -> "SampleRecord":
+        return cls._make(RECORD.unpack(record_of(sample, flags)))
+
+    def __str__(self):
+        slot_time = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.gmtime(self.slot_time_ms / 1000)
+        )
+        return (
+            f"{slot_time} {self.block_num} {self.block_hash.hex()[0:10]} "
+            f"slot {self.slot_num} size {self.block_size} "
+            f"header +{self.header_delta} ms from "
+            f"{unpack_addr(self.header_remote_addr)}:{self.header_remote_port} "
+            f"req +{self.block_request_delta} ms "
+            f"rsp +{self.block_response_delta} ms from "
+            f"{unpack_addr(self.block_remote_addr)}:{self.block_remote_port} "
+            f"adopt +{self.block_adopt_delta} ms"
+            f"{' snapshot' if self.flags & FLAG_SNAPSHOT else ''}"
+            f"{' incomplete' if self.flags & FLAG_INCOMPLETE else ''}"
+        )
+
+
+def record_of(sample: BlockSample, flags: int = 0) -> bytes:
+    """Packs the given sample into its fixed width record."""
+    return RECORD.pack(
+        sample.slot_time_ms,
+        sample.slot_num,
+        sample.block_num,
+        bytes.fromhex(sample.block_hash),
+        sample.block_size,
+        sample.header_delta,
+        sample.block_request_delta,
+        sample.block_response_delta,
+        sample.block_adopt_delta,
+        sample.block_g,
+        pack_addr(sample.header_remote_addr),
+        int(sample.header_remote_port or 0),
+        pack_addr(sample.block_remote_addr),
+        int(sample.block_remote_port or 0),
+        flags,
+    )
+
+
+class SampleStore:
+    """Appends samples to and reads them back from the segments in store_dir"""
+
+    store_dir: Path
+    retention: int
+    segment: Union[Path, None] = None
+
+    def __init__(self, store_dir: Path, retention_days: int = 30) -> None:
+        self.store_dir = Path(store_dir)
+        self.retention = retention_days * 86400
+
+    def segment_of(self, slot_time_ms: int) -> Path:
+        start = slot_time_ms // 1000 // SEGMENT_SECONDS * SEGMENT_SECONDS
+        return self.store_dir.joinpath(f"{SEGMENT_PREFIX}{start}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list:
+        """Returns (start, path) of all segments in the store, oldest first"""
+        segments = []
+        for path in self.store_dir.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"):
+            start = path.name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]
+            if start.isdigit():
+                segments.append((int(start), path))
+        return sorted(segments)
+
+    def append(self, sample: BlockSample, flags: int = 0) -> None:
+        """Appends the sample to the segment its slot time belongs to."""
+        record = record_of(sample, flags)
+        segment = self.segment_of(RECORD.unpack_from(record)[0])
+        if segment != self.segment:
+            # Rotating into a new segment is a good time to clean up old ones
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            truncate_partial(segment, RECORD.size)
+            self.segment = segment
+            self.remove_expired()
+        with open(segment, "ab") as fp:
+            fp.write(record)
+
+    def remove_expired(self, now: Union[float, None] = None) -> None:
+        """Removes all segments that are entirely outside the retention"""
+        oldest = (now or time.time()) - self.retention
+        for start, path in self.segments():
+            if start + SEGMENT_SECONDS < oldest:
+                logger.info("Removing expired segment %s", path)
+                path.unlink(missing_ok=True)
+
+    def query(
+        self,
+        since: Union[float, None] = None,
+        until: Union[float, None] = None,
+        peer: Union[str, None] = None,
+    ) -> Iterator[SampleRecord]:
+        """Yields all records with a slot time in [since, until) that were
+        received from the given peer (either header or block)."""
+        since_ms = int(since * 1000) if since is not None else None
+        until_ms = int(until * 1000) if until is not None else None
+        packed_peer = pack_addr(peer) if peer else None
+        for start, path in self.segments():
+            if until is not None and start >= until:
+                continue
+            if since is not None and start + SEGMENT_SECONDS <= since:
+                continue
+            for fields in self.read_segment(path):
+                if since_ms is not None and fields[0] < since_ms:
+                    continue
+                if until_ms is not None and fields[0] >= until_ms:
+                    continue
+                if packed_peer and packed_peer not in (fields[10], fields[12]):
+                    continue
+                yield SampleRecord(*fields)
+
+    @staticmethod
+    def read_segment(path: Path) -> Iterator[tuple]:
+        """Memory maps the given segment and unpacks all complete records"""
+        with open(path, "rb") as fp:
+            size = fp.seek(0, 2) // RECORD.size * RECORD.size
+            if not size:
+                return
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # A partially written record at the end is ignored
+                for offset in range(0, size, RECORD.size):
+                    yield RECORD.unpack_from(mm, offset)
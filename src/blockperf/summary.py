@@ -0,0 +1,216 @@
+"""
+Windowed summaries of the samples, for relays that can not afford to
+publish every single sample.
+
+The samples of a window (e.g. a minute or an epoch) are folded into a
+Summary: the number of samples, min, max and percentiles of each delta and
+the peers that most often delivered the first header or the block. Each
+delta goes into a histogram with fixed buckets and the peers are counted
+with the space saving algorithm in a fixed number of counters, so a
+summary takes the same memory no matter how many samples or peers there
+are. The percentiles are the upper bound of the bucket they fall into.
+
+A window is closed (and its summary published) once the first sample of a
+later window arrives. Samples that arrive late for a window already closed
+are counted in the current one.
+"""
+
+import bisect
+import logging
+from typing import Callable, Union
+
+from blockperf import __version__ as blockperf_version
+from blockperf.blocksample import BlockSample
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the histogram buckets, the last bucket is unbound
+BUCKETS = (
+    10,
+    20,
+    50,
+    100,
+    200,
+    300,
+    400,
+    500,
+    750,
+    1000,
+    1500,
+    2000,
+    3000,
+    5000,
+    10000,
+    20000,
+    60000,
+)
+PERCENTILES = (0.5, 0.9, 0.99)
+DELTAS = (
+    "header_delta",
+    "block_request_delta",
+    "block_response_delta",
+    "block_adopt_delta",
+    "block_validate_delta",
+    "block_select_delta",
+)
+# Only known for samples of nodes that trace chain selection
+SELECTION_DELTAS = ("block_validate_delta", "block_select_delta")
+# Counters of the space saving algorithm, more give better counts
+PEER_COUNTERS = 64
+# Peers listed in a summary
+TOP_PEERS = 5
+
+
+class Histogram:
+    """Counts values into the fixed BUCKETS, remembers min and max exactly"""
+
+    __slots__ = ("counts", "count", "min", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.min = 0
+        self.max = 0
+
+    def add(self, value: int) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        if not self.count or value < self.min:
+            self.min = value
+        if not self.count or value > self.max:
+            self.max = value
+        self.count += 1
+
+    def percentile(self, percentile: float) -> int:
+        """Upper bound of the bucket the percentile falls into, but never
+        more than the max"""
+        if not self.count:
+            return 0
+        rank = max(1, int(percentile * self.count + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index == len(BUCKETS):
+                    return self.max
+                return min(BUCKETS[index], self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        _dict = {"min": self.min, "max": self.max}
+        for percentile in PERCENTILES:
+            _dict[f"p{int(percentile * 100)}"] = self.percentile(percentile)
+        return _dict
+
+
+class TopPeers:
+    """Approximate counts of the most frequent peers in a fixed number of
+    counters (space saving). Once all counters are taken, a new peer takes
+    over the counter of the least counted one, including its count. So
+    counts may be overestimated, but frequent peers are never missed."""
+
+    __slots__ = ("capacity", "counts")
+
+    def __init__(self, capacity: int = PEER_COUNTERS) -> None:
+        self.capacity = capacity
+        self.counts: dict = {}
+
+    def add(self, peer: str) -> None:
+        if peer in self.counts:
+            self.counts[peer] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[peer] = 1
+        else:
+            least = min(self.counts, key=self.counts.__getitem__)
+            self.counts[peer] = self.counts.pop(least) + 1
+
+    def top(self, k: int = TOP_PEERS) -> list:
+        peers = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return [{"peer": peer, "count": count} for peer, count in peers[:k]]
+
+
+class Summary:
+    """The aggregate of all samples of a single window"""
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        self.samples = 0
+        self.deltas = {delta: Histogram() for delta in DELTAS}
+        self.header_peers = TopPeers()
+        self.block_peers = TopPeers()
+
+    def add(self, sample: BlockSample) -> None:
+        self.samples += 1
+        for delta, histogram in self.deltas.items():
+            if delta in SELECTION_DELTAS and not sample.chain_selection:
+                continue
+            histogram.add(getattr(sample, delta))
+        if sample.header_remote_addr:
+            self.header_peers.add(
+                f"{sample.header_remote_addr}:{sample.header_remote_port}"
+            )
+        if sample.block_remote_addr:
+            self.block_peers.add(
+                f"{sample.block_remote_addr}:{sample.block_remote_port}"
+            )
+
+    def payload(self) -> dict:
+        return {
+            "window": self.window,
+            "samples": self.samples,
+            "headerDelta": self.deltas["header_delta"].to_dict(),
+            "blockReqDelta": self.deltas["block_request_delta"].to_dict(),
+            "blockRspDelta": self.deltas["block_response_delta"].to_dict(),
+            "blockAdoptDelta": self.deltas["block_adopt_delta"].to_dict(),
+            "blockValidateDelta": self.deltas["block_validate_delta"].to_dict(),
+            "blockSelectDelta": self.deltas["block_select_delta"].to_dict(),
+            "headerPeers": self.header_peers.top(),
+            "blockPeers": self.block_peers.top(),
+        }
+
+
+class Summarizer:
+    """Folds samples into the summary of their window.
+
+    window_of returns the window of a sample, e.g. the start of its minute
+    or its epoch. window_length tells what the window is in the payload.
+    """
+
+    window_of: Callable[[BlockSample], int]
+    summary: Union[Summary, None] = None
+
+    def __init__(
+        self,
+        window_of: Callable[[BlockSample], int],
+        window_length: str,
+        network_magic: int,
+    ) -> None:
+        self.window_of = window_of
+        self.window_length = window_length
+        self.network_magic = network_magic
+
+    def add(self, sample: BlockSample) -> Union[dict, None]:
+        """Adds the sample, returns the payload of the previous window if the
+        sample is the first one of a later window."""
+        window = self.window_of(sample)
+        payload = None
+        if self.summary and window > self.summary.window:
+            payload = self.payload()
+            self.summary = None
+        if not self.summary:
+            self.summary = Summary(window)
+        self.summary.add(sample)
+        return payload
+
+    def payload(self) -> dict:
+        assert self.summary, "Nothing summarized yet"
+        logger.info(
+            "Summary of %s samples in window %s",
+            self.summary.samples,
+            self.summary.window,
+        )
+        return {
+            "magic": str(self.network_magic),
+            "bpVersion": f"v{blockperf_version}",
+            "windowLength": self.window_length,
+            **self.summary.payload(),
+        }
@@ -0,0 +1,88 @@
+"""
+Tailing of the nodes logfile.
+"""
+
+import logging
+import os
+from pathlib import Path
+from typing import TextIO, Union
+
+logger = logging.getLogger(__name__)
+
+
+class LogfileTailer:
+    """Reads new lines from the nodes logfile without ever blocking.
+
+    The nodes logfile is actually a symlink and just opening up that symlink
+    will not work since it eventually will be relinked to a new file and the
+    file handle will be invalid.
+
+    Thats why i open the file the symlink points to. If no newlines are being
+    written to that file the symlink is checked again whether it has a new
+    target. If so the new logfile is opened and read from its beginning.
+
+    Waiting for new lines is up to the caller, which allows the tailer to be
+    used from threads as well as from an event loop.
+    """
+
+    node_logfile: Path
+    real_node_log: Union[Path, None] = None
+    fp: Union[TextIO, None] = None
+
+    def __init__(self, node_logfile: Path, seek_end: bool = True) -> None:
+        self.node_logfile = node_logfile
+        # Avoid reading through old node.log on fresh start
+        self._seek_end = seek_end
+
+    def get_real_node_logfile(self) -> Union[Path, None]:
+        """Return the path to the logfile that node.log points to"""
+        if not self.node_logfile.exists():
+            logger.warning("Node log file does not exist %s", self.node_logfile)
+            return None
+        try:
+            return Path(os.path.realpath(self.node_logfile, strict=True))
+        except OSError:
+            logger.warning("Real node log not found from link %s", self.node_logfile)
+            return None
+
+    def seek_end(self) -> None:
+        """Skip everything written so far, the next read_lines() only returns
+        lines written after this call."""
+        if self.fp:
+            self.fp.seek(0, 2)
+        else:
+            self._seek_end = True
+
+    def open(self, real_node_log: Path) -> None:
+        self.close()
+        self.fp = open(real_node_log, "r", 1, "utf-8")
+        self.real_node_log = real_node_log
+        logger.info("Opened %s", real_node_log)
+        if self._seek_end:
+            logger.debug("Seek to end of file")
+            self.fp.seek(0, 2)
+            self._seek_end = False
+
+    def close(self) -> None:
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+    def read_lines(self) -> list:
+        """Returns all lines written since the last call, which is an empty
+        list if there are none (yet)."""
+        if not self.fp:
+            if not (real_node_log := self.get_real_node_logfile()):
+                return []
+            self.open(real_node_log)
+
+        assert self.fp, "Node logfile not opened"
+        new_lines = self.fp.readlines()
+        # If no new_lines are returned check if the symlink changed
+        # If it did change, open the new file for the next read
+        if not new_lines:
+            real_node_log = self.get_real_node_logfile()
+            if real_node_log and real_node_log.name != self.real_node_log.name:
+                logger.info("Symlink changed")
+                self.open(real_node_log)
+        return new_lines
@@ -0,0 +1,145 @@
+"""
+Detecting stalls of blockperfs pipeline and telling systemd about them.
+
+Every stage of the pipeline beats a heartbeat whenever it makes progress:
+
+    <relay> read     the source was read, with or without new lines
+    <relay> sample   a sample was created, the beat is at its slot time
+    <name> sink      a sink started writing a batch
+
+A stage is stalled once its last beat is longer ago than its timeout. A
+stage that is idle for a good reason (no sample before the first one, a
+sink with nothing to write, skipping old slots) is not watched until its
+next beat.
+
+The watchdog thread checks the stages every few seconds. If none is
+stalled it pings systemds watchdog (WATCHDOG=1), otherwise it asks systemd
+to restart the service right away (WATCHDOG=trigger). The state of every
+stage is exported as blockperf_stalled. Run as a service with Type=notify
+and WatchdogSec= to have systemd act on it, see contrib/blockperf.service.
+Without a NOTIFY_SOCKET nothing is send, the stalls are only logged.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Union
+
+from blockperf.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks if systemd does not tell (WATCHDOG_USEC)
+CHECK_INTERVAL = 5
+
+
+def notify(message: str, notify_socket: Union[str, None] = None) -> bool:
+    """Sends message to systemd (sd_notify), returns whether it was send.
+    The socket is taken from NOTIFY_SOCKET if not given, a leading @ is an
+    abstract socket."""
+    notify_socket = notify_socket or os.getenv("NOTIFY_SOCKET")
+    if not notify_socket:
+        return False
+    if notify_socket.startswith("@"):
+        notify_socket = "\0" + notify_socket[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(message.encode(), notify_socket)
+    except OSError as exc:
+        logger.warning("Could not notify systemd: %s", exc)
+        return False
+    return True
+
+
+def check_interval() -> float:
+    """Half the interval systemd expects a ping in, as sd_watchdog_enabled()
+    recommends"""
+    watchdog_usec = os.getenv("WATCHDOG_USEC", "")
+    if watchdog_usec.isdigit() and int(watchdog_usec):
+        return int(watchdog_usec) / 1_000_000 / 2
+    return CHECK_INTERVAL
+
+
+class Watchdog:
+    """The heartbeats of all stages of this process"""
+
+    timeouts: dict
+    beats: dict
+    metrics: dict
+    stalled: set
+    thread: Union[threading.Thread, None] = None
+
+    def __init__(self) -> None:
+        self.timeouts = {}
+        self.beats = {}
+        self.metrics = {}
+        self.stalled = set()
+        self.lock = threading.Lock()
+
+    def watch(self, stage: str, timeout: int) -> None:
+        """Watches stage from its first beat on. A timeout of 0 does not."""
+        if not timeout:
+            return
+        self.timeouts[stage] = timeout
+        self.metrics[stage] = Metrics(stage)
+
+    def beat(self, stage: str, at: Union[float, None] = None) -> None:
+        """Stage made progress, at (in seconds since the epoch) defaults to
+        now. The stage is watched again if it was idle."""
+        if stage in self.timeouts:
+            with self.lock:
+                self.beats[stage] = at or time.time()
+
+    def idle(self, stage: str) -> None:
+        """Stage is idle for a reason, not watched until its next beat"""
+        with self.lock:
+            self.beats.pop(stage, None)
+
+    def check(self, now: Union[float, None] = None) -> list:
+        """Returns the stages that are stalled"""
+        now = now or time.time()
+        with self.lock:
+            beats = dict(self.beats)
+        stalled = [
+            stage for stage, beat in beats.items() if now - beat > self.timeouts[stage]
+        ]
+        for stage in set(stalled) - self.stalled:
+            logger.error(
+                "%s stalled, no progress for %s seconds", stage, int(now - beats[stage])
+            )
+        for stage in self.timeouts:
+            self.metrics[stage].set("stalled", int(stage in stalled))
+        self.stalled = set(stalled)
+        return stalled
+
+    def ping(self) -> None:
+        """Checks all stages and tells systemd"""
+        if stalled := self.check():
+            notify(f"STATUS=Stalled {', '.join(stalled)}")
+            notify("WATCHDOG=trigger")
+        else:
+            notify("WATCHDOG=1")
+
+    def start(self) -> None:
+        """Tells systemd blockperf is ready and starts the watchdog thread,
+        once per process."""
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="watchdog", daemon=True
+            )
+        notify("READY=1")
+        self.thread.start()
+
+    def run(self) -> None:
+        interval = check_interval()
+        while True:
+            time.sleep(interval)
+            self.ping()
+
+
+# The watchdog of this process, shared by all relays
+watchdog = Watchdog()
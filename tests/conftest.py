@@ -0,0 +1,112 @@
+"""Helpers to create LogEvents and BlockSamples for the tests"""
+
+import json
+
+import pytest
+
+from blockperf.blocksample import BlockSample
+from blockperf.nodelogs import LogEvent
+
+BLOCK_HASH = "dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246"
+
+
+def logevent(at: str, data: dict, remote: str = "") -> LogEvent:
+    if remote:
+        addr, port = remote.split(":")
+        data["peer"] = {
+            "local": {"addr": "192.168.0.137", "port": "3001"},
+            "remote": {"addr": addr, "port": port},
+        }
+    return LogEvent.from_logline(json.dumps({"at": at, "data": data}))
+
+
+def header(at: str, remote: str) -> LogEvent:
+    data = {
+        "block": BLOCK_HASH,
+        "blockNo": 9233842,
+        "kind": "ChainSyncClientEvent.TraceDownloadedHeader",
+        "slot": 102011373,
+    }
+    return logevent(at, data, remote)
+
+
+def fetch_request(at: str, remote: str, g: float) -> LogEvent:
+    data = {"deltaq": {"G": g}, "head": BLOCK_HASH, "kind": "SendFetchRequest"}
+    return logevent(at, data, remote)
+
+
+def completed_block(at: str, remote: str) -> LogEvent:
+    data = {"block": BLOCK_HASH, "kind": "CompletedBlockFetch", "size": 89587}
+    return logevent(at, data, remote)
+
+
+@pytest.fixture
+def sample():
+    """A complete sample with three peers, two of them delivered the block"""
+    return BlockSample(
+        [
+            header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001"),
+            header("2023-09-01T14:14:24.60Z", "66.45.255.78:6000"),
+            header("2023-09-01T14:14:24.68Z", "3.11.145.214:3002"),
+            fetch_request("2023-09-01T14:14:24.61Z", "66.45.255.78:6000", 0.08),
+            fetch_request("2023-09-01T14:14:24.62Z", "3.11.145.214:3002", 0.02),
+            completed_block("2023-09-01T14:14:24.71Z", "66.45.255.78:6000"),
+            completed_block("2023-09-01T14:14:24.82Z", "3.11.145.214:3002"),
+            adopted("2023-09-01T14:14:24.85Z"),
+        ],
+        764824073,
+    )
+
+
+def adopted(at: str) -> LogEvent:
+    data = {
+        "chainLengthDelta": 1,
+        "kind": "TraceAddBlockEvent.AddedToCurrentChain",
+        "newtip": f"{BLOCK_HASH}@102011373",
+    }
+    return logevent(at, data)
+
+
+def try_switch(at: str) -> LogEvent:
+    data = {
+        "block": {"hash": BLOCK_HASH, "kind": "Point", "slot": 102011373},
+        "kind": "TraceAddBlockEvent.TrySwitchToAFork",
+    }
+    return logevent(at, data)
+
+
+def valid_candidate(at: str) -> LogEvent:
+    data = {
+        "block": f"{BLOCK_HASH}@102011373",
+        "kind": "TraceAddBlockEvent.AddBlockValidation.ValidCandidate",
+    }
+    return logevent(at, data)
+
+
+@pytest.fixture
+def node_dir(tmp_path, monkeypatch):
+    """A directory with a node config, genesis, logfile and (empty) certificates
+    that satisfies AppConfig.check_blockperf_config()"""
+    tmp_path.joinpath("config.json").write_text(
+        json.dumps(
+            {
+                "ShelleyGenesisFile": "shelley-genesis.json",
+                "TraceChainSyncClient": True,
+                "TraceBlockFetchClient": True,
+                "TracingVerbosity": "NormalVerbosity",
+            }
+        )
+    )
+    tmp_path.joinpath("shelley-genesis.json").write_text(
+        json.dumps({"networkMagic": 764824073, "activeSlotsCoeff": 0.05})
+    )
+    for name in ("node.json", "cert.pem", "key.pem", "ca.pem"):
+        tmp_path.joinpath(name).touch()
+    monkeypatch.setenv("BLOCKPERF_NODE_CONFIG", str(tmp_path.joinpath("config.json")))
+    monkeypatch.setenv("BLOCKPERF_NODE_LOGFILE", str(tmp_path.joinpath("node.json")))
+    monkeypatch.setenv("BLOCKPERF_NAME", "testrelay")
+    monkeypatch.setenv("BLOCKPERF_RELAY_PUBLIC_IP", "1.2.3.4")
+    monkeypatch.setenv("BLOCKPERF_CLIENT_CERT", str(tmp_path.joinpath("cert.pem")))
+    monkeypatch.setenv("BLOCKPERF_CLIENT_KEY", str(tmp_path.joinpath("key.pem")))
+    monkeypatch.setenv("BLOCKPERF_AMAZON_CA", str(tmp_path.joinpath("ca.pem")))
+    return tmp_path
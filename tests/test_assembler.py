@@ -0,0 +1,169 @@
+from blockperf.assembler import SampleAssembler
+from blockperf.nodelogs import LogEventKind
+from conftest import logevent
+
+
+def test_samples(sample):
+    assembler = SampleAssembler(764824073, 10)
+    samples = list(assembler.samples(sample.trace_events))
+    assert len(samples) == 1
+    assert samples[0].block_hash == sample.block_hash
+    assert assembler.published_blocks == [sample.block_hash]
+
+
+def test_no_republish(sample):
+    assembler = SampleAssembler(764824073, 10)
+    events = sample.trace_events
+    assert len(list(assembler.samples(events + events))) == 1
+
+
+def test_incomplete(sample):
+    assembler = SampleAssembler(764824073, 10)
+    # Without the adoption no sample can be created
+    assert not list(assembler.samples(sample.trace_events[:-1]))
+    assert sample.block_hash in assembler.logevents
+
+
+def test_add_batch(sample):
+    assembler = SampleAssembler(764824073, 10)
+    events = sample.trace_events
+    assert assembler.add_batch(events[:-1]) == []
+    new_samples = assembler.add_batch(events[-1:] + events)
+    assert len(new_samples) == 1
+    # Every event is recorded, even the ones of a published block
+    assert sum(map(len, assembler.logevents[sample.block_hash].values())) == 16
+    assert list(assembler.working_hashes) == [sample.block_hash]
+
+
+def headers(slots: list) -> list:
+    return [
+        logevent(
+            "2023-09-01T14:14:24.58Z",
+            {
+                "block": f"{slot:064x}",
+                "kind": "ChainSyncClientEvent.TraceDownloadedHeader",
+                "slot": slot,
+            },
+        )
+        for slot in slots
+    ]
+
+
+def test_evict_by_slot():
+    assembler = SampleAssembler(764824073, max_block_age=100)
+    assembler.add_batch(headers([1000, 1050, 1101]))
+    # 1000 is more than 100 slots behind the tip
+    assert list(assembler.working_hashes) == [f"{1050:064x}", f"{1101:064x}"]
+    assert set(assembler.logevents) == set(assembler.working_hashes)
+    assert assembler.events_held == 2
+
+    # Without new events, the sweeper evicts by the current slot
+    assembler.evict(now_slot=1200)
+    assert list(assembler.working_hashes) == [f"{1101:064x}"]
+
+
+def test_hash_without_header_ages(sample):
+    assembler = SampleAssembler(764824073, max_block_age=100)
+    assembler.add_batch(headers([1000]) + sample.trace_events[3:4])
+    assert assembler.working_hashes[sample.block_hash] == 1000
+    assembler.evict(now_slot=1101)
+    assert not assembler.working_hashes
+
+
+def test_degrade_over_budget(sample):
+    assembler = SampleAssembler(764824073, max_events=10)
+    assert len(assembler.add_batch(sample.trace_events)) == 1
+    # Redundant headers are dropped first
+    assembler.add_batch(headers([102011370, 102011371, 102011372]))
+    assert assembler.events_held == 9
+    sample_events = assembler.logevents[sample.block_hash]
+    assert len(sample_events[LogEventKind.TRACE_DOWNLOADED_HEADER]) == 1
+    # Then the published block
+    assembler.add_batch(headers([102011373, 102011374]))
+    assert sample.block_hash not in assembler.logevents
+    assert assembler.events_held == 5
+    # Then the oldest
+    assembler.add_batch(headers(list(range(102011375, 102011381))))
+    assert assembler.events_held == 10
+    assert f"{102011370:064x}" not in assembler.working_hashes
+
+
+class CountingMetrics:
+    def __init__(self):
+        self.counts = {}
+
+    def inc(self, metric, amount=1, *labels):
+        self.counts[metric] = self.counts.get(metric, 0) + amount
+
+    def set(self, metric, value, *labels):
+        pass
+
+
+def test_fetch_counts(sample):
+    metrics = CountingMetrics()
+    assembler = SampleAssembler(764824073, max_events=10, metrics=metrics)
+    (new_sample,) = assembler.add_batch(sample.trace_events)
+    counts = new_sample.fetch_counts
+    assert (counts.headers, counts.requests, counts.completed) == (3, 2, 2)
+    assert (counts.redundant_fetches, counts.wasted_bytes) == (1, 89587)
+    assert metrics.counts == {"redundant_fetches": 1, "wasted_bytes": 89587}
+    # Downloads after the sample was created are counted too, and the counts
+    # survive dropping the redundant headers
+    assembler.add_batch(sample.trace_events[5:6] + headers([102011370, 102011371]))
+    assert (
+        len(
+            assembler.logevents[sample.block_hash][LogEventKind.TRACE_DOWNLOADED_HEADER]
+        )
+        == 1
+    )
+    assert assembler.fetch_counts[sample.block_hash].headers == 3
+    assert assembler.fetch_counts[sample.block_hash].completed == 3
+    assert metrics.counts == {
+        "redundant_fetches": 2,
+        "wasted_bytes": 2 * 89587,
+        "dropped_headers": 2,
+    }
+    assert new_sample.fetch_counts.completed == 2
+
+
+class StageMetrics(CountingMetrics):
+    def __init__(self):
+        super().__init__()
+        self.stages = []
+
+    def set(self, metric, value, *labels):
+        if metric == "stage_delta":
+            self.stages.append((*labels, value))
+
+
+def test_stages_observed_as_events_arrive(sample):
+    metrics = StageMetrics()
+    assembler = SampleAssembler(764824073, metrics=metrics)
+    events = sorted(sample.trace_events, key=lambda event: event.at)
+    # Only the first header, request and completion complete a stage
+    for event in events[:-1]:
+        assert assembler.add(event) is None
+    assert metrics.stages == [
+        ("header", sample.header_delta),
+        ("request", sample.block_request_delta),
+        ("response", sample.block_response_delta),
+    ]
+
+
+def test_incomplete_evicted(sample):
+    incomplete = []
+    assembler = SampleAssembler(764824073, 10, on_incomplete=incomplete.append)
+    # Never adopted
+    assembler.add_batch(sample.trace_events[:-1])
+    assembler.add_batch(headers([102011390]))
+    (evicted,) = incomplete
+    assert evicted.block_hash == sample.block_hash
+    assert not evicted.is_complete()
+    assert evicted.header_delta == sample.header_delta
+    assert evicted.block_response_delta == sample.block_response_delta
+    assert evicted.block_adopt_delta == 0
+    assert evicted.fetch_counts.completed == 2
+    # Published blocks are not incomplete
+    assembler.add_batch(sample.trace_events)
+    assembler.add_batch(headers([102011400]))
+    assert len(incomplete) == 1
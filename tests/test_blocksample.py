@@ -4,6 +4,7 @@ from blockperf.config import AppConfig, ConfigError
 from blockperf.blocksample import BlockSample
 from blockperf.nodelogs import LogEventKind, LogEvent
 from blockperf.blocksample import slot_time_of
+from conftest import try_switch, valid_candidate
 
 
 @pytest.fixture
@@ -193,6 +194,23 @@ def test_block_adopt_delta(sample01, empty_sample):
     assert sample01.block_adopt_delta == 60
 
 
+def test_block_validate_and_select_delta(sample, empty_sample):
+    assert sample.chain_selection is None
+    assert (sample.block_validate_delta, sample.block_select_delta) == (0, 0)
+    assert empty_sample.block_validate_delta == 0
+    events = sample.trace_events + [try_switch("2023-09-01T14:14:24.73Z")]
+    switched = BlockSample(events, 764824073)
+    assert switched.chain_selection.kind == LogEventKind.TRY_SWITCH_TO_A_FORK
+    assert (switched.block_validate_delta, switched.block_select_delta) == (20, 120)
+    # ValidCandidate is preferred, it is after the validation
+    events.append(valid_candidate("2023-09-01T14:14:24.83Z"))
+    validated = BlockSample(events, 764824073)
+    assert validated.chain_selection.kind == LogEventKind.ADD_BLOCK_VALIDATION
+    assert validated.block_validate_delta == 120
+    assert validated.block_select_delta == 20
+    assert validated.block_adopt_delta == sample.block_adopt_delta == 140
+
+
 def test_block_remote_addr(sample01, empty_sample):
     assert empty_sample.block_remote_addr == ""
     assert sample01.block_remote_addr == "3.11.145.214"
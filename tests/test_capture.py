@@ -0,0 +1,83 @@
+from blockperf.assembler import SampleAssembler
+from blockperf.capture import MAGIC, EventCapture, is_capture, read_capture
+from blockperf.cli import logfile_events
+from blockperf.parseworker import EVENT
+from conftest import BLOCK_HASH, adopted, completed_block, fetch_request, header
+
+
+def events():
+    return [
+        header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001"),
+        fetch_request("2023-09-01T14:14:24.61Z", "66.45.255.78:6000", 0.08),
+        completed_block("2023-09-01T14:14:24.71Z", "66.45.255.78:6000"),
+        adopted("2023-09-01T14:14:24.85Z"),
+    ]
+
+
+def test_capture_roundtrip(tmp_path):
+    capture = EventCapture(tmp_path, retention_days=100000)
+    capture.append(events()[:2])
+    capture.append(events()[2:])
+    capture.close()
+    (start, segment), *others = capture.segments()
+    assert not others
+    assert start == 1693526400
+    assert segment.stat().st_size == len(MAGIC) + 4 * EVENT.size
+    assert is_capture(segment)
+    captured = list(read_capture(segment))
+    assert [event.kind for event in captured] == [event.kind for event in events()]
+    assert all(event.block_hash == BLOCK_HASH for event in captured)
+    assert captured[0].at == events()[0].at
+
+
+def test_partial_event_is_truncated(tmp_path):
+    capture = EventCapture(tmp_path, retention_days=100000)
+    capture.append(events()[:2])
+    capture.close()
+    _, segment = capture.segments()[0]
+    with open(segment, "r+b") as fp:
+        fp.truncate(len(MAGIC) + EVENT.size + 10)
+    capture.append(events()[2:])
+    capture.close()
+    assert segment.stat().st_size == len(MAGIC) + 3 * EVENT.size
+    captured = [event.kind for event in read_capture(segment)]
+    assert captured == [event.kind for event in events()[:1] + events()[2:]]
+    # Not even the magic was written completely
+    segment.write_bytes(MAGIC[:3])
+    capture.append(events()[:1])
+    capture.close()
+    assert len(list(read_capture(segment))) == 1
+
+
+def test_capture_rotates_by_day(tmp_path):
+    capture = EventCapture(tmp_path, retention_days=100000)
+    capture.append(
+        [
+            header("2023-09-01T23:59:59.90Z", "3.216.77.109:3001"),
+            header("2023-09-02T00:00:00.10Z", "3.216.77.109:3001"),
+        ]
+    )
+    capture.close()
+    assert [start for start, _ in capture.segments()] == [1693526400, 1693612800]
+
+
+def test_capture_retention(tmp_path):
+    capture = EventCapture(tmp_path, retention_days=1)
+    capture.append(events())
+    capture.close()
+    # Removed the next time a segment is opened
+    capture.append([header("2023-09-05T10:00:00.00Z", "3.216.77.109:3001")])
+    assert [start for start, _ in capture.segments()] == [1693872000]
+
+
+def test_replay_capture(tmp_path):
+    capture = EventCapture(tmp_path, retention_days=100000)
+    capture.append(events())
+    capture.close()
+    _, segment = capture.segments()[0]
+    logfile = tmp_path.joinpath("node.json")
+    logfile.write_text("{}\n")
+    assert not is_capture(logfile)
+    samples = list(SampleAssembler(764824073).samples(logfile_events(segment)))
+    assert len(samples) == 1
+    assert samples[0].block_hash == BLOCK_HASH
@@ -0,0 +1,45 @@
+import argparse
+import logging
+
+import pytest
+
+from blockperf import cli
+
+
+def test_already_running(tmp_path, monkeypatch):
+    lockfile = tmp_path.joinpath("blockperf.lock")
+    monkeypatch.setattr(cli, "_lock_fd", None)
+    assert not cli.already_running(lockfile)
+    assert lockfile.read_text().strip().isdigit()
+    # The lock is held by the open file, another attempt must fail
+    assert cli.already_running(lockfile)
+
+
+def test_timestamp():
+    assert cli.timestamp("1693577664") == 1693577664.0
+    assert cli.timestamp("2023-09-01T14:14:24") == 1693577664.0
+    assert cli.timestamp("2023-09-01T16:14:24+02:00") == 1693577664.0
+    with pytest.raises(argparse.ArgumentTypeError):
+        cli.timestamp("yesterday")
+
+
+def test_rate_limit_filter():
+    rate_limit = cli.RateLimitFilter(rate=2)
+
+    def record(level, lineno, created):
+        _record = logging.LogRecord("test", level, "test.py", lineno, "msg", (), None)
+        _record.created = created
+        return _record
+
+    assert rate_limit.filter(record(logging.DEBUG, 1, 100.0))
+    assert rate_limit.filter(record(logging.DEBUG, 1, 100.1))
+    assert not rate_limit.filter(record(logging.DEBUG, 1, 100.2))
+    # Other lines and levels above debug are not limited
+    assert rate_limit.filter(record(logging.DEBUG, 2, 100.3))
+    assert rate_limit.filter(record(logging.INFO, 1, 100.4))
+    # The next second lets records through again, telling what was dropped
+    next_record = record(logging.DEBUG, 1, 101.0)
+    assert rate_limit.filter(next_record)
+    assert next_record.getMessage() == "msg (1 similar suppressed)"
+    # Lines that did not log in the current second are forgotten
+    assert list(rate_limit.sites) == [("test.py", 1)]
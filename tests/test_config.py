@@ -32,3 +32,82 @@ def _test_shelley_genesis_file():
 def test_active_slot_coef():
     with pytest.raises(SystemExit):
         app_config = AppConfig(None)
+
+
+def test_single_relay(node_dir):
+    relays = AppConfig.relays(None)
+    assert len(relays) == 1
+    assert relays[0].network_magic == 764824073
+    assert relays[0].topic == "cf/blockperf/v1/764824073/testrelay/1.2.3.4"
+
+
+def test_multiple_relays(node_dir):
+    node_dir.joinpath("node2.json").touch()
+    config_file = node_dir.joinpath("blockperf.ini")
+    config_file.write_text(
+        "[DEFAULT]\n"
+        "relay_public_port = 3001\n"
+        "[relay1]\n"
+        "[relay2]\n"
+        f"node_logfile = {node_dir.joinpath('node2.json')}\n"
+        "relay_public_ip = 5.6.7.8\n"
+        "relay_public_port = 6000\n"
+        "topic = custom/topic\n"
+    )
+    relay1, relay2 = AppConfig.relays(config_file)
+    # relay1 has no options of its own, everything comes from the environment
+    assert relay1.section == "relay1"
+    assert relay1.node_logfile == node_dir.joinpath("node.json")
+    assert relay1.relay_public_ip == "1.2.3.4"
+    assert relay1.relay_public_port == 3001
+    # relay2 options take precedence over the environment
+    assert relay2.node_logfile == node_dir.joinpath("node2.json")
+    assert relay2.relay_public_ip == "5.6.7.8"
+    assert relay2.relay_public_port == 6000
+    assert relay2.topic == "custom/topic"
+    assert relay2.name == "testrelay"
+
+
+def test_slot_clock_from_genesis(node_dir):
+    node_config = json.loads(node_dir.joinpath("config.json").read_text())
+    node_config["ByronGenesisFile"] = "byron-genesis.json"
+    node_config["TestShelleyHardForkAtEpoch"] = 2
+    node_dir.joinpath("config.json").write_text(json.dumps(node_config))
+    node_dir.joinpath("byron-genesis.json").write_text(
+        json.dumps(
+            {
+                "startTime": 1700000000,
+                "protocolConsts": {"k": 10},
+                "blockVersionData": {"slotDuration": "20000"},
+            }
+        )
+    )
+    slot_clock = AppConfig(None).slot_clock
+    # 2 byron epochs of 100 slots, each 20 seconds long
+    assert slot_clock.shelley_start_slot == 200
+    assert slot_clock.slot_time_ms(200) == (1700000000 + 4000) * 1000
+    assert slot_clock.slot_time_ms(201) == (1700000000 + 4001) * 1000
+
+
+def test_relay_paths(node_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv("BLOCKPERF_STORE_DIR", str(tmp_path))
+    monkeypatch.setenv("BLOCKPERF_PUBLISHED_FILE", str(tmp_path.joinpath("p.bin")))
+    monkeypatch.setenv("BLOCKPERF_CAPTURE_DIR", str(tmp_path.joinpath("capture")))
+    config_file = node_dir.joinpath("blockperf.ini")
+    config_file.write_text("[relay1]\n[relay 2]\n")
+    relay1, relay2 = AppConfig.relays(config_file)
+    # Shared paths are made per relay
+    assert relay1.store_dir == tmp_path.joinpath("relay1")
+    assert relay2.store_dir == tmp_path.joinpath("relay_2")
+    assert relay1.journald_cursor_file == tmp_path.joinpath("relay1", "journald.cursor")
+    assert relay2.published_file == tmp_path.joinpath("p-relay_2.bin")
+    assert relay1.capture_dir == tmp_path.joinpath("capture", "relay1")
+    assert relay2.capture_dir == tmp_path.joinpath("capture", "relay_2")
+    # A single relay keeps them as they are
+    assert AppConfig.relays(None)[0].store_dir == tmp_path
+    # Set in the relays sections, but the same
+    config_file.write_text(
+        f"[relay1]\nstore_dir={tmp_path}\n[relay2]\nstore_dir={tmp_path}\n"
+    )
+    with pytest.raises(ConfigError):
+        AppConfig.relays(config_file)
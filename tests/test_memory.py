@@ -0,0 +1,77 @@
+import logging
+import tracemalloc
+
+from blockperf.assembler import SampleAssembler
+from blockperf.memory import EVENT_MEMORY, MemoryBudget, tracemalloc_top
+from conftest import header
+
+
+def test_budget():
+    budget = MemoryBudget()
+    budget.account("a", lambda: 10)
+    budget.account("b", lambda: 20)
+    assert budget.used() == 30
+    assert budget.usage() == {"a": 10, "b": 20}
+    # Without a limit, there is no limit
+    assert not budget.exceeded()
+    budget.limit = 20
+    assert budget.exceeded()
+
+
+def test_assembler_within_budget(sample):
+    budget = MemoryBudget(limit=EVENT_MEMORY * 7)
+    assembler = SampleAssembler(764824073, memory_budget=budget)
+    assert len(assembler.add_batch(sample.trace_events)) == 1
+    # 8 events are too many, dropping the 2 redundant headers is enough
+    assert assembler.events_held == 6
+    assert sample.block_hash in assembler.logevents
+
+    budget.limit = EVENT_MEMORY * 5
+    assembler.evict()
+    assert assembler.events_held == 0
+
+
+def test_shares(caplog):
+    budget = MemoryBudget(limit=100)
+    budget.account("ring", lambda: 40, fixed=True)
+    budget.account("sink", lambda: 50)
+    budget.share("relay1", lambda: 35)
+    budget.share("relay2", lambda: 10)
+    # The whole process is over, but only relay1 is over its share
+    assert budget.exceeded()
+    assert budget.share_limit() == 30
+    assert budget.exceeded("relay1")
+    assert not budget.exceeded("relay2")
+    # A budget below what can never be freed is ignored
+    with caplog.at_level(logging.WARNING):
+        budget.account("ring", lambda: 120, fixed=True)
+    assert "below the fixed usage" in caplog.text
+    assert budget.share_limit() == 0
+    assert not budget.exceeded("relay1")
+
+
+def test_event_memory():
+    """EVENT_MEMORY is an upper bound of a parsed events memory"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        events = [
+            header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001") for _ in range(1000)
+        ]
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(events) == 1000
+    assert used / 1000 <= EVENT_MEMORY
+
+
+def test_tracemalloc_top():
+    tracemalloc.start()
+    try:
+        data = [bytearray(1000) for _ in range(100)]
+        top = tracemalloc_top(5)
+    finally:
+        tracemalloc.stop()
+    assert data
+    assert top.startswith("Traced")
+    assert len(top.splitlines()) <= 6
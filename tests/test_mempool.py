@@ -0,0 +1,31 @@
+from blockperf.mempool import MempoolCounter
+from blockperf.parseworker import EVENT, EventRing
+
+ADDED = '{"app":[],"at":"2023-09-01T14:14:24.55Z","data":{"kind":"TraceMempoolAddedTx","mempoolSize":{"bytes":12030,"numTxs":7},"tx":{"txid":"b1a6e2d3"}},"env":"8.1.1:ea2c0","ns":["cardano.node.Mempool"],"sev":"Info"}\n'
+REJECTED = '{"app":[],"at":"2023-09-01T14:14:24.56Z","data":{"err":{},"kind":"TraceMempoolRejectedTx","mempoolSize":{"bytes":12030,"numTxs":7},"tx":{"txid":"c2b7f3e4"}},"env":"8.1.1:ea2c0","ns":["cardano.node.Mempool"],"sev":"Info"}\n'
+REMOVED = '{"app":[],"at":"2023-09-01T14:14:24.57Z","data":{"kind":"TraceMempoolRemoveTxs","mempoolSize":{"bytes":1500,"numTxs":1},"txs":[{"txid":"b1a6e2d3"},{"txid":"d3c8a4f5"}]},"env":"8.1.1:ea2c0","ns":["cardano.node.Mempool"],"sev":"Info"}\n'
+ADDED_NEW_FORMAT = '{"at":"2024-03-14T10:06:55.123456789Z","ns":"Mempool.AddedTx","data":{"mempoolSize":{"bytes":2000,"numTxs":2},"tx":{"txid":"e4d9b5a6"}},"sev":"Info"}\n'
+HEADER = '{"app":[],"at":"2023-09-01T14:14:24.56Z","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","kind":"ChainSyncClientEvent.TraceDownloadedHeader"},"ns":["cardano.node.ChainSyncClient"]}\n'
+SYNCED = '{"app":[],"at":"2023-09-01T14:14:24.56Z","data":{"kind":"TraceMempoolSynced"},"ns":["cardano.node.Mempool"]}\n'
+
+
+def test_count_mempool_lines():
+    mempool = MempoolCounter()
+    lines = [ADDED, HEADER, REJECTED, ADDED, REMOVED, SYNCED]
+    assert mempool.filter(lines) == [HEADER, SYNCED]
+    assert mempool.totals() == (2, 1, 2, 1, 1500)
+    assert mempool.filter([ADDED_NEW_FORMAT]) == []
+    assert mempool.totals() == (3, 1, 2, 2, 2000)
+
+
+def test_ring_mempool_totals():
+    ring = EventRing(4, create=True)
+    try:
+        assert ring.mempool_totals() == (0, 0, 0, 0, 0)
+        ring.put_mempool((3, 1, 2, 2, 2000))
+        assert ring.mempool_totals() == (3, 1, 2, 2, 2000)
+        # The records are behind the totals
+        ring.put(b"\xff" * EVENT.size)
+        assert ring.mempool_totals() == (3, 1, 2, 2, 2000)
+    finally:
+        ring.close(unlink=True)
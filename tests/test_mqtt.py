@@ -0,0 +1,107 @@
+import socket
+import ssl
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from blockperf import mqtt
+from blockperf.mqtt import Backoff, MQTTClient, ResumingContext
+
+
+def test_backoff_grows_with_jitter():
+    backoff = Backoff(min_delay=1, max_delay=10)
+    for ceiling in (1, 2, 4, 8, 10, 10):
+        assert 1 <= backoff.next() <= ceiling
+    backoff.reset()
+    assert backoff.next() == 1
+
+
+def test_resuming_context_passes_session():
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    session = object()
+    with mock.patch.object(ssl.SSLContext, "wrap_socket") as wrap_socket:
+        context.wrap_socket("sock", server_hostname="broker")
+        wrap_socket.assert_called_with("sock", server_hostname="broker")
+        context.session = session
+        context.wrap_socket("sock", server_hostname="broker")
+        wrap_socket.assert_called_with(
+            "sock", server_hostname="broker", session=session
+        )
+
+
+def test_network_loop_backs_off(monkeypatch):
+    class Stop(Exception):
+        pass
+
+    delays = []
+
+    def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            raise Stop
+
+    monkeypatch.setattr(mqtt.time, "sleep", sleep)
+    attempts = []
+    loops = iter([mqtt.mqtt.MQTT_ERR_SUCCESS, mqtt.mqtt.MQTT_ERR_CONN_LOST])
+
+    def connect(host, port, keepalive):
+        attempts.append((host, port, keepalive))
+        if len(attempts) == 1:
+            raise OSError("refused")
+
+    client = SimpleNamespace(
+        broker=("broker", 8883, 180),
+        backoff=Backoff(min_delay=1, max_delay=10),
+        connect=connect,
+        on_socket_writable=None,
+        loop=lambda timeout: next(loops, mqtt.mqtt.MQTT_ERR_NO_CONN),
+    )
+    with pytest.raises(Stop):
+        MQTTClient.network_loop(client)
+    # Refused, connected until the connection was lost, then refused again
+    assert len(attempts) == 3
+    assert delays[0] == 1 and 1 <= delays[1] <= 2 and 1 <= delays[2] <= 4
+
+
+def test_publish_written_by_network_thread(tmp_path):
+    broker = socket.create_server(("127.0.0.1", 0))
+    received = bytearray()
+
+    def serve():
+        conn, _ = broker.accept()
+        with conn:
+            conn.recv(1024)  # CONNECT
+            conn.sendall(bytes([0x20, 3, 0, 0, 0]))  # CONNACK, success
+            while received.count(b'"n"') < 3:
+                data = conn.recv(1024)
+                if not data:
+                    break
+                received.extend(data)
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    with mock.patch.object(ResumingContext, "load_cert_chain"):
+        client = MQTTClient(
+            "", "cert", "key", *broker.getsockname(), 60, loop_start=False
+        )
+    client._ssl = False  # the fake broker does not speak tls
+    writers = set()
+    loop_write = client.loop_write
+
+    def record_writer():
+        writers.add(threading.current_thread().name)
+        return loop_write()
+
+    client.loop_write = record_writer
+    threading.Thread(target=client.network_loop, name="mqtt", daemon=True).start()
+    sink = threading.Thread(
+        target=lambda: [client.publish("topic", {"n": n}) for n in range(3)],
+        name="sink",
+    )
+    sink.start()
+    sink.join(10)
+    server.join(10)
+    assert received.count(b'"n"') == 3
+    assert writers == {"mqtt"}
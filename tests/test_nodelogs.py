@@ -1,7 +1,6 @@
 import pytest
 from blockperf.nodelogs import LogEventKind
-from blockperf.nodelogs import LogEvent
-
+from blockperf.nodelogs import LogEvent, LogFormat, detect_format, point_hash
 
 loglines = """
 {"app":[],"at":"2023-09-01T14:14:24.55Z","data":{"kind":"AddedFetchRequest","peer":{"local":{"addr":"192.168.0.137","port":"3001"},"remote":{"addr":"3.11.145.214","port":"3002"}}},"env":"8.1.1:ea2c0","host":"mainnetf","loc":null,"msg":"","ns":["cardano.node.BlockFetchClient"],"pid":"1662080","sev":"Info","thread":"201"}
@@ -144,3 +143,90 @@ def test_block_hash(empty_logevent):
     )
 
     assert event.block_hash_short == "dda846c34c"
+
+
+TRACE_DISPATCHER_LINES = [
+    '{"at":"2024-03-14T10:06:55.123456789Z","ns":"ChainSync.Client.DownloadedHeader","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","blockNo":9233842,"kind":"DownloadedHeader","peer":{"connectionId":"192.168.0.137:3001 66.45.255.78:3001"},"slot":102011373},"sev":"Info","thread":"42","host":"relay1"}',
+    '{"at":"2024-03-14T10:06:55.2Z","ns":"BlockFetch.Client.SendFetchRequest","data":{"head":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","kind":"SendFetchRequest","length":1,"peer":{"connectionId":"[::1]:3001 [2001:db8::1]:3002"}},"sev":"Info","thread":"43","host":"relay1"}',
+    '{"at":"2024-03-14T10:06:55.9Z","ns":"BlockFetch.Client.CompletedBlockFetch","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","delay":0.832114369,"kind":"CompletedBlockFetch","peer":{"connectionId":"192.168.0.137:3001 66.45.255.78:3001"},"size":870},"sev":"Info","thread":"43","host":"relay1"}',
+    '{"at":"2024-03-14T10:06:56Z","ns":"ChainDB.AddBlockEvent.AddedToCurrentChain","data":{"kind":"AddedToCurrentChain","newtip":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246@102011373"},"sev":"Notice","thread":"44","host":"relay1"}',
+]
+
+
+def test_detect_format():
+    assert detect_format([]) is None
+    assert detect_format(["not json"] + TRACE_DISPATCHER_LINES) == (
+        LogFormat.TRACE_DISPATCHER
+    )
+    assert detect_format(loglines.strip().splitlines()) == LogFormat.LEGACY
+
+
+def test_trace_dispatcher_format():
+    header, request, completed, adopted = (
+        LogEvent.from_logline(line, log_format=LogFormat.TRACE_DISPATCHER)
+        for line in TRACE_DISPATCHER_LINES
+    )
+    block_hash = "dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246"
+    assert header.kind == LogEventKind.TRACE_DOWNLOADED_HEADER
+    assert header.block_hash == block_hash
+    assert header.block_num == 9233842
+    assert header.slot_num == 102011373
+    assert header.at.microsecond == 123456
+    assert (header.remote_addr, header.remote_port) == ("66.45.255.78", "3001")
+    assert (header.local_addr, header.local_port) == ("192.168.0.137", "3001")
+    # Built from the fields directly, not from legacy shaped data
+    assert not hasattr(header, "data")
+    assert request.kind == LogEventKind.SEND_FETCH_REQUEST
+    assert request.block_hash == block_hash
+    assert (request.remote_addr, request.remote_port) == ("2001:db8::1", "3002")
+    assert completed.kind == LogEventKind.COMPLETED_BLOCK_FETCH
+    assert completed.size == 870
+    assert completed.delay == 0.832114369
+    assert adopted.kind == LogEventKind.ADDED_TO_CURRENT_CHAIN
+    assert adopted.block_hash == block_hash
+    assert adopted.at.second == 56
+
+
+def test_chain_selection_events():
+    block_hash = "dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246"
+    legacy = [
+        '{"app":[],"at":"2023-09-01T14:14:24.83Z","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246@102011373","kind":"TraceAddBlockEvent.AddBlockValidation.ValidCandidate"},"ns":["cardano.node.ChainDB"],"sev":"Info"}',
+        '{"app":[],"at":"2023-09-01T14:14:24.73Z","data":{"block":{"hash":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","kind":"Point","slot":102011373},"kind":"TraceAddBlockEvent.TrySwitchToAFork"},"ns":["cardano.node.ChainDB"],"sev":"Info"}',
+    ]
+    trace_dispatcher = [
+        '{"at":"2024-03-14T10:06:55.95Z","ns":"ChainDB.AddBlockEvent.AddBlockValidation.ValidCandidate","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246@102011373","kind":"ValidCandidate"},"sev":"Info"}',
+        '{"at":"2024-03-14T10:06:55.91Z","ns":"ChainDB.AddBlockEvent.TrySwitchToAFork","data":{"block":{"hash":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","kind":"Point","slot":102011373},"kind":"TrySwitchToAFork"},"sev":"Info"}',
+    ]
+    for lines, log_format in (
+        (legacy, LogFormat.LEGACY),
+        (trace_dispatcher, LogFormat.TRACE_DISPATCHER),
+    ):
+        valid, try_switch = (
+            LogEvent.from_logline(line, log_format=log_format) for line in lines
+        )
+        assert valid.kind == LogEventKind.ADD_BLOCK_VALIDATION
+        assert valid.block_hash == block_hash
+        assert try_switch.kind == LogEventKind.TRY_SWITCH_TO_A_FORK
+        assert try_switch.block_hash == block_hash
+    assert point_hash(f"{block_hash} at slot 102011373") == block_hash
+
+
+def test_trace_dispatcher_not_of_interest():
+    line = '{"at":"2024-03-14T10:06:55.1Z","ns":"Mempool.AddedTx","data":{"kind":"TraceMempoolAddedTx"},"sev":"Info"}'
+    assert not LogEvent.from_logline(line, log_format=LogFormat.TRACE_DISPATCHER)
+    # Lines missing fields are dropped, not raised
+    line = '{"at":"2024-03-14T10:06:55.1Z","ns":"BlockFetch.Client.CompletedBlockFetch","data":{"kind":"CompletedBlockFetch"},"sev":"Info"}'
+    assert not LogEvent.from_logline(line, log_format=LogFormat.TRACE_DISPATCHER)
+
+
+def test_malformed_block_no():
+    legacy = next(line for line in loglines.splitlines() if '"blockNo"' in line)
+    for line, log_format in (
+        (legacy, LogFormat.LEGACY),
+        (TRACE_DISPATCHER_LINES[0], LogFormat.TRACE_DISPATCHER),
+    ):
+        line = line.replace('"blockNo":9233842', '"blockNo":{"foo":1}')
+        # Dropped (and logged), not raised into the read loop
+        assert not LogEvent.from_logline(line, log_format=log_format)
+        line = line.replace('"blockNo":{"foo":1}', '"blockNo":{"unBlockNo":1}')
+        assert LogEvent.from_logline(line, log_format=log_format).block_num == 1
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+
+from blockperf.blocksample import BlockSample
+from blockperf.parseworker import (
+    MEMPOOL,
+    MEMPOOL_OFFSET,
+    SEQUENCE,
+    EventRing,
+    ParseWorker,
+    pack_event,
+    unpack_event,
+)
+from conftest import (
+    BLOCK_HASH,
+    adopted,
+    completed_block,
+    fetch_request,
+    header,
+    try_switch,
+    valid_candidate,
+)
+
+
+def events():
+    return [
+        header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001"),
+        fetch_request("2023-09-01T14:14:24.61Z", "66.45.255.78:6000", 0.08),
+        completed_block("2023-09-01T14:14:24.71Z", "66.45.255.78:6000"),
+        adopted("2023-09-01T14:14:24.85Z"),
+    ]
+
+
+def test_pack_unpack():
+    selection = [
+        try_switch("2023-09-01T14:14:24.73Z"),
+        valid_candidate("2023-09-01T14:14:24.83Z"),
+    ]
+    for event in events() + selection:
+        unpacked = unpack_event(pack_event(event))
+        assert unpacked.kind == event.kind
+        assert unpacked.block_hash == event.block_hash == BLOCK_HASH
+        assert unpacked.at == event.at
+        assert unpacked.atstr == event.atstr
+        assert unpacked.slot_num == event.slot_num
+        assert unpacked.block_num == event.block_num
+        assert unpacked.size == event.size
+        assert unpacked.deltaq_g == event.deltaq_g
+
+
+def test_pack_invalid():
+    event = header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001")
+    for field, value in (("block_num", None), ("slot_num", -1), ("size", 2**32)):
+        invalid = header("2023-09-01T14:14:24.58Z", "3.216.77.109:3001")
+        setattr(invalid, field, value)
+        assert pack_event(invalid) is None
+    assert pack_event(event)
+
+
+def test_same_sample():
+    sample = BlockSample(events(), 764824073)
+    unpacked = BlockSample(
+        [unpack_event(pack_event(event)) for event in events()], 764824073
+    )
+    assert unpacked.is_complete()
+    assert unpacked.header_delta == sample.header_delta
+    assert unpacked.block_response_delta == sample.block_response_delta
+    assert unpacked.block_remote_addr == "66.45.255.78"
+    assert unpacked.block_remote_port == "6000"
+    assert unpacked.block_g == 0.08
+
+
+def test_ring():
+    ring = EventRing(capacity=2, create=True)
+    try:
+        record = pack_event(events()[0])
+        assert ring.put(record)
+        assert ring.put(record)
+        assert not ring.put(record)
+        assert len(ring.read_events()) == 2
+        assert ring.read_events() == []
+        # The positions wrap around the capacity
+        assert ring.put(record)
+        ring.request_seek()
+        assert ring.read_events() == []
+        assert ring.seek_requested()
+        assert not ring.seek_requested()
+    finally:
+        ring.close(unlink=True)
+
+
+def test_guarded_read():
+    ring = EventRing(capacity=2, create=True)
+    try:
+        ring.put_mempool((1, 2, 3, 4, 5))
+        assert ring.mempool_totals() == (1, 2, 3, 4, 5)
+        # The worker is in the middle of writing, the read waits for it
+        sequence = SEQUENCE.unpack_from(ring.shm.buf, MEMPOOL_OFFSET)[0]
+        SEQUENCE.pack_into(ring.shm.buf, MEMPOOL_OFFSET, sequence + 1)
+
+        def finish():
+            time.sleep(0.1)
+            MEMPOOL.pack_into(
+                ring.shm.buf, MEMPOOL_OFFSET + SEQUENCE.size, 6, 7, 8, 9, 10
+            )
+            SEQUENCE.pack_into(ring.shm.buf, MEMPOOL_OFFSET, sequence + 2)
+
+        writer = threading.Thread(target=finish)
+        writer.start()
+        assert ring.mempool_totals() == (6, 7, 8, 9, 10)
+        writer.join()
+    finally:
+        ring.close(unlink=True)
+
+
+def test_worker(tmp_path):
+    logfile = tmp_path.joinpath("node.json")
+    logfile.write_text("")
+    worker = ParseWorker(logfile, [], 0)
+    try:
+        # Give the worker time to open the logfile (at its end)
+        time.sleep(2)
+        # Reading nothing still tells the worker is alive
+        assert worker.reads() > 0
+        with open(logfile, "a") as fp:
+            line = {
+                "at": "2023-09-01T14:14:24.58Z",
+                "data": {
+                    "block": BLOCK_HASH,
+                    "blockNo": 9233842,
+                    "kind": "ChainSyncClientEvent.TraceDownloadedHeader",
+                    "slot": 102011373,
+                },
+            }
+            fp.write(json.dumps(line) + "\n")
+            fp.write(json.dumps({"at": line["at"], "data": {"kind": "Other"}}) + "\n")
+        logevents: list = []
+        for _ in range(50):
+            logevents.extend(worker.read_events())
+            if logevents:
+                break
+            time.sleep(0.1)
+        assert len(logevents) == 1
+        assert logevents[0].block_num == 9233842
+    finally:
+        worker.close()
@@ -0,0 +1,41 @@
+from conftest import header
+
+from blockperf.blocksample import BlockSample
+from blockperf.peerstats import PeerStats
+
+
+def test_add_sample(sample):
+    peer_stats = PeerStats()
+    peer_stats.add_sample(sample)
+    assert len(peer_stats) == 3
+
+    fastest = peer_stats.get("3.216.77.109:3001")
+    assert fastest.headers == 1
+    assert fastest.first_header_ratio == 1.0
+    assert fastest.header_lag == 0.0
+    assert fastest.blocks == 0
+
+    slow = peer_stats.get("3.11.145.214:3002")
+    assert slow.first_header_ratio == 0.0
+    assert slow.header_lag == 100
+    assert slow.blocks == 1
+    assert slow.response_delta_quantile(0.5) == 200
+    assert slow.deltaq_g == 0.02
+
+
+def test_max_peers(sample):
+    peer_stats = PeerStats(max_peers=2)
+    peer_stats.add_sample(sample)
+    assert len(peer_stats) == 2
+    # The least recently seen peer is the one that was dropped
+    assert not peer_stats.get("3.216.77.109:3001")
+
+
+def test_top(sample):
+    peer_stats = PeerStats()
+    peer_stats.add_sample(sample)
+    peer_stats.add_sample(
+        BlockSample([header("2023-09-01T14:14:44.58Z", "66.45.255.78:6000")], 1)
+    )
+    top = peer_stats.top(1)
+    assert [p.peer for p in top] == ["66.45.255.78:6000"]
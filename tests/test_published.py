@@ -0,0 +1,109 @@
+import threading
+
+from blockperf import published
+from blockperf.assembler import SampleAssembler
+from blockperf.published import PublishedFilter
+from conftest import logevent
+
+
+def test_contains():
+    published_filter = PublishedFilter()
+    published_filter.add("aa" * 32)
+    assert "aa" * 32 in published_filter
+    assert "bb" * 32 not in published_filter
+
+
+def test_rotate(monkeypatch):
+    monkeypatch.setattr(published, "CAPACITY", 2)
+    published_filter = PublishedFilter()
+    for block_hash in ("a", "b", "c"):
+        published_filter.add(block_hash)
+    # a and b are in the previous generation, c in the current
+    assert all(h in published_filter for h in ("a", "b", "c"))
+    published_filter.add("d")
+    published_filter.add("e")
+    assert "a" not in published_filter
+    assert all(h in published_filter for h in ("c", "d", "e"))
+
+
+def test_persisted(tmp_path):
+    path = tmp_path.joinpath("state", "published.bin")
+    published_filter = PublishedFilter(path)
+    published_filter.add("a")
+    published_filter.save_due()
+    assert path.stat().st_size < 10000
+    assert "a" in PublishedFilter(path)
+    assert "b" not in PublishedFilter(path)
+
+
+def test_no_republish_after_restart(tmp_path, sample):
+    path = tmp_path.joinpath("published.bin")
+    assembler = SampleAssembler(764824073, published=PublishedFilter(path))
+    assert len(list(assembler.samples(sample.trace_events))) == 1
+    assert not path.exists()
+    # Saved by the sweeper, not while adding the events
+    assembler.save_published()
+    # A new assembler (restart) still knows the block has been published
+    assembler = SampleAssembler(764824073, published=PublishedFilter(path))
+    assert not list(assembler.samples(sample.trace_events))
+
+
+def test_filter_only_asked_for_blocks_before_start(monkeypatch, sample):
+    # A filter that (wrongly) has every hash
+    monkeypatch.setattr(PublishedFilter, "__contains__", lambda self, h: True)
+    assembler = SampleAssembler(764824073)
+    earlier = logevent(
+        "2023-09-01T14:14:20.00Z",
+        {
+            "block": "ee" * 32,
+            "blockNo": 9233841,
+            "kind": "ChainSyncClientEvent.TraceDownloadedHeader",
+            "slot": 102011300,
+        },
+        "3.216.77.109:3001",
+    )
+    assembler.add_batch([earlier])
+    # Seen from its first header on, the filter is not asked
+    assert len(assembler.add_batch(sample.trace_events)) == 1
+    # Without anything seen before, it may have been published before
+    assembler = SampleAssembler(764824073)
+    assert not assembler.add_batch(sample.trace_events)
+
+
+def test_saved_every_interval(tmp_path, monkeypatch):
+    path = tmp_path.joinpath("published.bin")
+    published_filter = PublishedFilter(path)
+    published_filter.add("a")
+    published_filter.save_due()
+    published_filter.add("b")
+    published_filter.save_due()
+    # Saved on the first save_due(), b only once the interval passed
+    assert "b" not in PublishedFilter(path)
+    assert published_filter.dirty
+    monkeypatch.setattr(published, "SAVE_INTERVAL", 0)
+    published_filter.save_due()
+    assert "b" in PublishedFilter(path)
+    # Every saver has its own temporary file, none is left behind
+    PublishedFilter(path).save()
+    assert [p.name for p in tmp_path.iterdir()] == ["published.bin"]
+
+
+def test_saved_without_the_lock(tmp_path, monkeypatch):
+    path = tmp_path.joinpath("published.bin")
+    assembler = SampleAssembler(764824073, published=PublishedFilter(path))
+    assembler.published.add("a")
+    adders_waited = []
+
+    def save(data):
+        # Events are added (in another thread) while the file is written
+        adder = threading.Thread(target=assembler.add_batch, args=([],))
+        adder.start()
+        adder.join(1)
+        adders_waited.append(adder.is_alive())
+        path.write_bytes(data)
+
+    monkeypatch.setattr(assembler.published, "save", save)
+    assembler.save_published()
+    assert adders_waited == [False]
+    assert "a" in PublishedFilter(path)
+    assert not assembler.published.dirty
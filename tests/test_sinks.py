@@ -0,0 +1,108 @@
+import io
+import json
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from blockperf.config import AppConfig, ConfigError
+from blockperf.sinks import FileSink, HTTPSink, MQTTSink, Sink, StreamSink
+
+
+def test_submit_drops_oldest():
+    sink = StreamSink(io.StringIO(), queue_size=2)
+    for block in range(3):
+        sink.submit("topic", {"block": block})
+    assert [payload["block"] for _, payload in sink.next_batch()] == [1, 2]
+
+
+def test_write_is_required():
+    class Forgetful(Sink):
+        name = "forgetful"
+
+    with pytest.raises(TypeError):
+        Forgetful()
+
+
+def test_mqtt_sink_counts_lost():
+    connected = threading.Event()
+    connected.set()
+    published = iter([True, False, True])
+    client = SimpleNamespace(
+        connected=connected, publish=lambda topic, payload: next(published)
+    )
+    sink = MQTTSink(lambda: client)
+    sink.client = client
+    dropped = []
+    sink.metrics = SimpleNamespace(inc=lambda metric, amount=1: dropped.append(amount))
+    sink.write([("a", {}), ("b", {}), ("c", {})])
+    assert dropped == [1]
+
+
+def test_stream_sink():
+    stream = io.StringIO()
+    sink = StreamSink(stream)
+    sink.write([("a", {"block": 1}), ("b", {"block": 2})])
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines == [
+        {"topic": "a", "payload": {"block": 1}},
+        {"topic": "b", "payload": {"block": 2}},
+    ]
+
+
+def test_file_sink(tmp_path):
+    path = tmp_path.joinpath("samples", "samples.jsonl")
+    sink = FileSink(path)
+    sink.write([("a", {"block": 1})])
+    sink.write([("b", {"block": 2})])
+    sink.close()
+    assert len(path.read_text().splitlines()) == 2
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received: list = []
+    connections: set = set()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        Handler.received.extend(body.decode().splitlines())
+        Handler.connections.add(self.client_address)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    Handler.received, Handler.connections = [], set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_sink(http_server):
+    sink = HTTPSink(f"http://127.0.0.1:{http_server.server_port}/samples")
+    sink.write([("a", {"block": 1}), ("b", {"block": 2})])
+    sink.write([("c", {"block": 3})])
+    assert [json.loads(line)["topic"] for line in Handler.received] == ["a", "b", "c"]
+    # Both batches were posted on the same connection
+    assert len(Handler.connections) == 1
+    sink.close()
+
+
+def test_sinks_config(node_dir, monkeypatch):
+    assert AppConfig(None).sinks == ["mqtt"]
+    monkeypatch.setenv("BLOCKPERF_SINKS", "stdout, file")
+    # The certificates are not needed without the mqtt sink
+    node_dir.joinpath("cert.pem").unlink()
+    assert AppConfig(None).sinks == ["stdout", "file"]
+    monkeypatch.setenv("BLOCKPERF_SINKS", "kafka")
+    with pytest.raises(ConfigError):
+        AppConfig(None)
@@ -0,0 +1,65 @@
+import pytest
+
+from blockperf.slotclock import MAINNET_MAGIC, SlotClock, clock_of
+
+BYRON_GENESIS = {
+    "startTime": 1654041600,
+    "protocolConsts": {"k": 2160},
+    "blockVersionData": {"slotDuration": "20000"},
+}
+
+
+def test_mainnet():
+    clock = clock_of(MAINNET_MAGIC)
+    # https://cardanoscan.io/block/9121756
+    assert clock.slot_time_ms(99692109) == 1691258400_000
+    # The first Shelley slot
+    assert clock.slot_time_ms(4492800) == 1596059091_000
+    # Byron slots are 20 seconds
+    assert clock.slot_time_ms(1) == 1506203111_000
+    assert clock_of("mainnet") is clock
+
+
+@pytest.mark.parametrize(
+    "network,start",
+    [(1, 1655683200), (2, 1666656000), (4, 1686789000)],
+)
+def test_public_networks(network, start):
+    # Slots since the shelley era are seconds since start
+    assert clock_of(network).slot_time_ms(50_000_000) == (start + 50_000_000) * 1000
+
+
+def test_slot_at_ms():
+    clock = clock_of("preprod")
+    for slot in (0, 86399, 86400, 50_000_000):
+        assert clock.slot_at_ms(clock.slot_time_ms(slot)) == slot
+        assert clock.slot_at_ms(clock.slot_time_ms(slot) + 999) == slot
+
+
+def test_from_genesis():
+    clock = SlotClock.from_genesis(BYRON_GENESIS, {"slotLength": 1}, 4)
+    assert clock.slot_time_ms(50_000_000) == clock_of(1).slot_time_ms(50_000_000)
+
+
+def test_private_testnet():
+    clock = SlotClock.from_genesis(
+        None, {"systemStart": "2024-01-01T00:00:00Z", "slotLength": 0.2}, 0
+    )
+    assert clock.slot_time_ms(0) == 1704067200_000
+    assert clock.slot_time_ms(10) == 1704067202_000
+
+
+def test_unknown_network():
+    with pytest.raises(ValueError):
+        clock_of(42)
+    with pytest.raises(ValueError):
+        clock_of("nonet")
+
+
+def test_epoch_of():
+    clock = SlotClock.for_network(MAINNET_MAGIC)
+    assert clock.epoch_of(0, 432000) == 0
+    assert clock.epoch_of(4492799, 432000) == 207
+    assert clock.epoch_of(4492800, 432000) == 208
+    # 2023-09-01
+    assert clock.epoch_of(102011373, 432000) == 433
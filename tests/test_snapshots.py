@@ -0,0 +1,65 @@
+from blockperf.app import App
+from blockperf.config import AppConfig
+from blockperf.parseworker import EventRing
+from blockperf.snapshots import SNAPSHOT_MS, SnapshotRing
+from blockperf.store import SampleRecord
+
+# 2023-09-01T14:14:24.58Z, when the first header of the sample arrived
+HEADER_MS = 1693577664580
+TOOK_SNAPSHOT = '{"app":[],"at":"2023-09-01T14:14:26.00Z","data":{"kind":"TraceSnapshotEvent.TookSnapshot","snapshot":{"kind":"DiskSnapshot","snapshotNo":102011300},"tip":"RealPoint (SlotNo 102011300) 4c6fa4cd"},"ns":["cardano.node.ChainDB"],"sev":"Info"}\n'
+RISING_EDGE = '{"at":"2023-09-01T14:14:20.123456789Z","ns":"ChainDB.LedgerEvent.TookSnapshot","data":{"enclosedTime":"RisingEdge","kind":"TookSnapshot","snapshot":{"kind":"DiskSnapshot","snapshotNo":102011300},"tip":"RealPoint (SlotNo 102011300) 4c6fa4cd"},"sev":"Info"}\n'
+FALLING_EDGE = '{"at":"2023-09-01T14:14:24.50Z","ns":"ChainDB.LedgerEvent.TookSnapshot","data":{"enclosedTime":4.38,"kind":"TookSnapshot","snapshot":{"kind":"DiskSnapshot","snapshotNo":102011300},"tip":"RealPoint (SlotNo 102011300) 4c6fa4cd"},"sev":"Info"}\n'
+HEADER = '{"app":[],"at":"2023-09-01T14:14:24.56Z","data":{"block":"dda846c34c0f219c26ded0994ef0beace1dea54487d60e0b4afe5f6f4fe3d246","kind":"ChainSyncClientEvent.TraceDownloadedHeader"},"ns":["cardano.node.ChainSyncClient"]}\n'
+
+
+def test_snapshot_without_timing():
+    snapshots = SnapshotRing()
+    assert snapshots.filter([HEADER, TOOK_SNAPSHOT]) == [HEADER]
+    assert list(snapshots.intervals) == [
+        (HEADER_MS + 1420 - SNAPSHOT_MS, HEADER_MS + 1420, False)
+    ]
+    assert snapshots.overlaps(HEADER_MS, HEADER_MS + 270)
+    assert not snapshots.overlaps(HEADER_MS + 1500, HEADER_MS + 1600)
+
+
+def test_snapshot_edges():
+    snapshots = SnapshotRing()
+    snapshots.add_line(RISING_EDGE)
+    # Still writing the snapshot, assumed to take up to SNAPSHOT_MS
+    assert list(snapshots.intervals) == [
+        (HEADER_MS - 4457, HEADER_MS - 4457 + SNAPSHOT_MS, False)
+    ]
+    assert snapshots.overlaps(HEADER_MS, HEADER_MS + 270)
+    # The falling edge tells how long it actually took
+    snapshots.add_line(FALLING_EDGE)
+    assert list(snapshots.intervals) == [(HEADER_MS - 4460, HEADER_MS - 80, True)]
+    assert not snapshots.overlaps(HEADER_MS, HEADER_MS + 270)
+
+
+def test_snapshot_ring_is_bound():
+    snapshots = SnapshotRing(capacity=2)
+    for start in (0, 10, 20):
+        snapshots.add(start, start + 5)
+    assert [start for start, _, _ in snapshots.intervals] == [10, 20]
+
+
+def test_event_ring_snapshots():
+    ring = EventRing(4, create=True)
+    try:
+        assert ring.snapshots() == []
+        ring.put_snapshots([(0, 5, True), (10, 15, False)])
+        assert ring.snapshots() == [(0, 5, True), (10, 15, False)]
+    finally:
+        ring.close(unlink=True)
+
+
+def test_sample_tagged(node_dir, tmp_path, monkeypatch, sample):
+    monkeypatch.setenv("BLOCKPERF_STORE_DIR", str(tmp_path.joinpath("store")))
+    app = App(AppConfig(None))
+    assert not app.snapshot_during(sample)
+    app.logevents_of([TOOK_SNAPSHOT])
+    assert app.snapshot_during(sample)
+    app.handle_sample(sample)
+    (record,) = app.store.query()
+    assert str(record).endswith("adopt +140 ms snapshot")
+    assert not str(SampleRecord.from_sample(sample)).endswith("snapshot")
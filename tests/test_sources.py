@@ -0,0 +1,62 @@
+import os
+import socket
+
+import pytest
+
+from blockperf.config import AppConfig, ConfigError
+from blockperf.sources import LineBuffer, StdinSource, UnixSocketSource
+
+
+def test_line_buffer():
+    buffer = LineBuffer()
+    assert buffer.feed(b'{"a": 1}\n{"b"') == ['{"a": 1}\n']
+    assert buffer.feed(b": 2}\n\n") == ['{"b": 2}\n']
+    assert buffer.feed(b"") == []
+
+
+def test_stdin_source():
+    read_fd, write_fd = os.pipe()
+    source = StdinSource(read_fd)
+    assert source.read_lines() == []
+    os.write(write_fd, b"first\nsec")
+    assert source.read_lines() == ["first\n"]
+    os.write(write_fd, b"ond\n")
+    assert source.read_lines() == ["second\n"]
+    os.write(write_fd, b"skipped\n")
+    source.seek_end()
+    os.close(write_fd)
+    assert source.read_lines() == []
+    assert source.eof
+    os.close(read_fd)
+
+
+def test_unix_socket_source(tmp_path):
+    path = tmp_path.joinpath("node.sock")
+    source = UnixSocketSource(path)
+    assert source.read_lines() == []
+    first = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    first.connect(str(path))
+    second = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    second.connect(str(path))
+    # Lines of different connections do not get mixed up
+    first.sendall(b"one\nhal")
+    second.sendall(b"two\n")
+    assert sorted(source.read_lines()) == ["one\n", "two\n"]
+    first.sendall(b"f\n")
+    first.close()
+    assert source.read_lines() == ["half\n"]
+    assert len(source.connections) == 1
+    second.close()
+    source.close()
+    assert not path.exists()
+
+
+def test_source_config(node_dir, monkeypatch):
+    assert AppConfig(None).source == "file"
+    monkeypatch.setenv("BLOCKPERF_SOURCE", "stdin")
+    # The logfile is not needed to read from stdin
+    node_dir.joinpath("node.json").unlink()
+    assert AppConfig(None).source == "stdin"
+    monkeypatch.setenv("BLOCKPERF_SOURCE", "syslog")
+    with pytest.raises(ConfigError):
+        AppConfig(None)
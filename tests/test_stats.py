@@ -0,0 +1,76 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from blockperf import stats  # noqa: E402
+from blockperf.store import FLAG_INCOMPLETE, SampleStore, pack_addr  # noqa: E402
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.default_rng(42)
+    samples = np.zeros(1000, dtype=stats.RECORD_DTYPE)
+    # Spread the samples over 3 hours and 4 peers
+    samples["slot_time_ms"] = 1693576800000 + rng.integers(0, 3 * 3600_000, 1000)
+    samples["block_size"] = rng.integers(1000, 90000, 1000)
+    samples["block_response_delta"] = samples["block_size"] // 100 + rng.integers(
+        0, 50, 1000
+    )
+    samples["header_delta"] = rng.integers(100, 3000, 1000)
+    peers = [np.void(pack_addr(f"10.0.0.{i}")) for i in range(4)]
+    samples["block_remote_addr"] = [peers[i % 4] for i in range(1000)]
+    samples["block_remote_port"] = 3001
+    return samples
+
+
+def test_hourly(samples):
+    table = stats.hourly(samples)
+    assert len(table["hour"]) == 3
+    assert table["samples"].sum() == 1000
+    hours = samples["slot_time_ms"] // 3_600_000
+    for i, hour in enumerate(np.unique(hours)):
+        values = samples["header_delta"][hours == hour]
+        assert table["header_delta_p90"][i] == pytest.approx(np.percentile(values, 90))
+
+
+def test_peers(samples):
+    table = stats.peers(samples)
+    assert list(table["peer"]) == [f"10.0.0.{i}:3001" for i in range(4)]
+    assert list(table["samples"]) == [250] * 4
+    values = samples["block_response_delta"][0::4]
+    assert table["block_response_delta_p50"][0] == pytest.approx(np.median(values))
+    assert table["header_delta_mean"][0] == pytest.approx(
+        samples["header_delta"][0::4].mean()
+    )
+
+
+def test_size_correlation(samples):
+    assert stats.size_correlation(samples) > 0.9
+    assert stats.size_correlation(samples[:1]) == 0.0
+
+
+def test_empty():
+    samples = np.empty(0, dtype=stats.RECORD_DTYPE)
+    assert not len(stats.hourly(samples)["hour"])
+    assert not len(stats.peers(samples)["peer"])
+
+
+def test_load(tmp_path, sample):
+    store = SampleStore(tmp_path)
+    store.append(sample)
+    store.append(sample)
+    assert len(stats.load(store)) == 2
+    assert len(stats.load(store, peer="66.45.255.78")) == 2
+    assert not len(stats.load(store, peer="10.0.0.1"))
+    assert not len(stats.load(store, since=1693577665))
+    # Blocks never adopted are no samples
+    store.append(sample, FLAG_INCOMPLETE)
+    assert len(stats.load(store)) == 2
+
+
+def test_export_csv(tmp_path, samples):
+    path = tmp_path.joinpath("peers.csv")
+    stats.export(stats.peers(samples), path)
+    lines = path.read_text().splitlines()
+    assert lines[0].startswith("peer,samples,header_delta_mean")
+    assert len(lines) == 5
@@ -0,0 +1,65 @@
+import time
+
+from blockperf.store import RECORD, SampleStore, unpack_addr
+
+# slot time of the sample fixture
+SLOT_TIME = 1693577664
+
+
+def test_append_and_query(tmp_path, sample):
+    store = SampleStore(tmp_path)
+    store.append(sample)
+    store.append(sample)
+
+    records = list(store.query())
+    assert len(records) == 2
+    record = records[0]
+    assert record.slot_time_ms == SLOT_TIME * 1000
+    assert record.block_num == 9233842
+    assert record.block_hash.hex() == sample.block_hash
+    assert record.header_delta == sample.header_delta
+    assert record.block_response_delta == 100
+    assert unpack_addr(record.header_remote_addr) == "3.216.77.109"
+    assert unpack_addr(record.block_remote_addr) == "66.45.255.78"
+    assert record.block_remote_port == 6000
+
+
+def test_query_filters(tmp_path, sample):
+    store = SampleStore(tmp_path)
+    store.append(sample)
+
+    assert list(store.query(since=SLOT_TIME, until=SLOT_TIME + 1))
+    assert not list(store.query(since=SLOT_TIME + 1))
+    assert not list(store.query(until=SLOT_TIME))
+    assert list(store.query(peer="66.45.255.78"))
+    assert not list(store.query(peer="3.11.145.214"))
+
+
+def test_partial_record_is_ignored(tmp_path, sample):
+    store = SampleStore(tmp_path)
+    store.append(sample)
+    with open(store.segment, "ab") as fp:
+        fp.write(b"\x00" * (RECORD.size // 2))
+    assert len(list(store.query())) == 1
+
+
+def test_partial_record_is_truncated(tmp_path, sample):
+    store = SampleStore(tmp_path, retention_days=100000)
+    store.append(sample)
+    store.append(sample)
+    # Killed in the middle of writing the second record
+    with open(store.segment, "r+b") as fp:
+        fp.truncate(RECORD.size + RECORD.size // 2)
+    store = SampleStore(tmp_path, retention_days=100000)
+    store.append(sample)
+    assert store.segment.stat().st_size == 2 * RECORD.size
+    assert [record.block_num for record in store.query()] == [9233842] * 2
+
+
+def test_remove_expired(tmp_path, sample):
+    store = SampleStore(tmp_path, retention_days=1)
+    store.append(sample)
+    store.remove_expired(now=SLOT_TIME)
+    assert len(store.segments()) == 1
+    store.remove_expired(now=time.time())
+    assert not store.segments()
@@ -0,0 +1,61 @@
+import pytest
+
+from blockperf.config import AppConfig, ConfigError
+from blockperf.summary import Histogram, Summarizer, TopPeers
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.to_dict() == {"min": 0, "max": 0, "p50": 0, "p90": 0, "p99": 0}
+    for value in [5] * 50 + [150] * 40 + [900] * 9 + [70000]:
+        histogram.add(value)
+    assert histogram.min == 5
+    assert histogram.max == 70000
+    assert histogram.percentile(0.5) == 10
+    assert histogram.percentile(0.9) == 200
+    assert histogram.percentile(0.99) == 1000
+    assert histogram.percentile(1.0) == 70000
+
+
+def test_histogram_percentile_below_bucket_bound():
+    histogram = Histogram()
+    histogram.add(-20)
+    histogram.add(120)
+    assert histogram.percentile(0.5) == 10
+    # Never more than the max
+    assert histogram.percentile(0.99) == 120
+
+
+def test_top_peers():
+    peers = TopPeers(capacity=2)
+    for peer in ["a", "a", "a", "b", "c"]:
+        peers.add(peer)
+    # c took over the counter of b
+    assert peers.top() == [{"peer": "a", "count": 3}, {"peer": "c", "count": 2}]
+    assert len(peers.counts) == 2
+
+
+def test_summarizer(sample):
+    windows = iter([1, 1, 2])
+    summarizer = Summarizer(lambda _: next(windows), "60", 764824073)
+    assert summarizer.add(sample) is None
+    assert summarizer.add(sample) is None
+    payload = summarizer.add(sample)
+    assert payload["window"] == 1
+    assert payload["windowLength"] == "60"
+    assert payload["samples"] == 2
+    assert payload["headerDelta"]["min"] == sample.header_delta
+    assert payload["headerPeers"] == [{"peer": "3.216.77.109:3001", "count": 2}]
+    assert payload["blockPeers"] == [{"peer": "66.45.255.78:6000", "count": 2}]
+    assert summarizer.summary.window == 2
+
+
+def test_publish_mode_config(node_dir, monkeypatch):
+    config = AppConfig(None)
+    assert (config.publish_mode, config.summary_window) == ("samples", "60")
+    monkeypatch.setenv("BLOCKPERF_PUBLISH_MODE", "both")
+    monkeypatch.setenv("BLOCKPERF_SUMMARY_WINDOW", "epoch")
+    assert (config.publish_mode, config.summary_window) == ("both", "epoch")
+    monkeypatch.setenv("BLOCKPERF_SUMMARY_WINDOW", "0")
+    with pytest.raises(ConfigError):
+        config.summary_window
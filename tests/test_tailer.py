@@ -0,0 +1,40 @@
+from blockperf.tailer import LogfileTailer
+
+
+def test_seek_end(tmp_path):
+    logfile = tmp_path.joinpath("node.json")
+    logfile.write_text("old\n")
+    tailer = LogfileTailer(logfile)
+    assert tailer.read_lines() == []
+    with open(logfile, "a") as fp:
+        fp.write("new\n")
+    assert tailer.read_lines() == ["new\n"]
+    assert tailer.read_lines() == []
+
+
+def test_from_start(tmp_path):
+    logfile = tmp_path.joinpath("node.json")
+    logfile.write_text("old\n")
+    tailer = LogfileTailer(logfile, seek_end=False)
+    assert tailer.read_lines() == ["old\n"]
+
+
+def test_missing_logfile(tmp_path):
+    tailer = LogfileTailer(tmp_path.joinpath("node.json"))
+    assert tailer.read_lines() == []
+
+
+def test_symlink_changed(tmp_path):
+    first, second = tmp_path.joinpath("node-1.json"), tmp_path.joinpath("node-2.json")
+    first.write_text("first\n")
+    link = tmp_path.joinpath("node.json")
+    link.symlink_to(first)
+    tailer = LogfileTailer(link)
+    assert tailer.read_lines() == []
+
+    second.write_text("second\n")
+    link.unlink()
+    link.symlink_to(second)
+    # The first read notices the new target, the next one reads from it
+    assert tailer.read_lines() == []
+    assert tailer.read_lines() == ["second\n"]
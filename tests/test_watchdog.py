@@ -0,0 +1,49 @@
+import socket
+
+from blockperf.watchdog import Watchdog, check_interval, notify
+
+
+def test_stalled_stages():
+    watchdog = Watchdog()
+    watchdog.watch("relay read", 60)
+    watchdog.watch("relay sample", 900)
+    # Not watched at all
+    watchdog.watch("stdout sink", 0)
+    watchdog.beat("stdout sink", at=1000)
+    # Not watched before the first beat
+    assert watchdog.check(now=2000) == []
+    watchdog.beat("relay read", at=1000)
+    watchdog.beat("relay sample", at=1000)
+    assert watchdog.check(now=1060) == []
+    assert watchdog.check(now=1061) == ["relay read"]
+    watchdog.idle("relay read")
+    assert watchdog.check(now=1901) == ["relay sample"]
+    assert watchdog.stalled == {"relay sample"}
+
+
+def test_notify(tmp_path, monkeypatch):
+    path = str(tmp_path.joinpath("notify"))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(path)
+        sock.settimeout(1)
+        assert notify("READY=1", path)
+        assert sock.recv(64) == b"READY=1"
+
+        monkeypatch.setenv("NOTIFY_SOCKET", path)
+        watchdog = Watchdog()
+        watchdog.watch("relay read", 60)
+        watchdog.beat("relay read")
+        watchdog.ping()
+        assert sock.recv(64) == b"WATCHDOG=1"
+        watchdog.beat("relay read", at=1000)
+        watchdog.ping()
+        assert sock.recv(64) == b"STATUS=Stalled relay read"
+        assert sock.recv(64) == b"WATCHDOG=trigger"
+
+    monkeypatch.delenv("NOTIFY_SOCKET")
+    assert not notify("WATCHDOG=1")
+
+
+def test_check_interval(monkeypatch):
+    monkeypatch.setenv("WATCHDOG_USEC", "60000000")
+    assert check_interval() == 30